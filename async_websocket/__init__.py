@@ -3,3 +3,11 @@ from .connection import AsyncWebsocketConnection
 from .server import AsyncWebsocketServer
 from .http import HttpHeader, HttpService, FileSystemMount
 from .client import client_connect_async
+from .client_manager import ClientManager, ClientSession, Backoff
+from .deflate import DeflateOptions
+from .stream import MessageStream
+from .metrics import Metrics, MetricsHooks, PrometheusMount
+from .heartbeat import Heartbeat
+from .pubsub import TopicRouter
+from .ratelimit import RateLimiter
+from .capture import TrafficRecorder, CaptureFile
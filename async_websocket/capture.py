@@ -0,0 +1,200 @@
+'''
+traffic capture.
+
+TrafficRecorder appends the frames of its connections to a binary log.
+records are buffered and written in batches, there is no flush per frame.
+
+recorder = TrafficRecorder(loop, 'traffic.cap')
+AsyncWebsocketServer(loop, callbacks, http_service, recorder=recorder)
+...
+recorder.close()
+
+the log is MAGIC followed by records of
+    unix time (float64), connection id (uint32), direction (uint8),
+    first header byte: fin, rsv and opcode (uint8), payload length (uint64), payload
+little endian. payloads are unmasked. OPEN records have the peer as payload.
+streaming chunks of one frame are recorded as fragments.
+
+CaptureFile reads a log through mmap. see benchmarks/replay_bench.py
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+import mmap
+import os
+import struct
+import time
+from typing import Iterator, List, NamedTuple, Optional
+
+from .constants import OPCODE, CONSTANTS
+from .exception import AsyncWebsocketError
+from .frame import Frame
+from .masking import mask
+
+# AWSCAP1 had uint32 payload length
+MAGIC = b'AWSCAP2\n'
+RECORD = struct.Struct('<dIBBQ')
+# received by this process
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+DIRECTION_OPEN = 2
+DIRECTION_CLOSE = 3
+FLUSH_INTERVAL = 0.5
+FLUSH_SIZE = 1024 * 1024
+
+_FIN = int(CONSTANTS.FIN)
+_RSV = int(CONSTANTS.RSV)
+_OPCODE = int(CONSTANTS.OPCODE)
+_MASKED = int(CONSTANTS.MASKED)
+_PAYLOAD_LEN = int(CONSTANTS.PAYLOAD_LEN)
+_CONTINUATION = int(OPCODE.CONTINUATION)
+
+
+class CaptureRecord(NamedTuple):
+    time: float
+    connection: int
+    direction: int
+    fin: bool
+    rsv: int
+    opcode: int
+    # view of the mapped log
+    payload: memoryview
+
+
+class TrafficRecorder:
+    '''
+    the file is truncated. records are written every flush_interval seconds
+    or when flush_size bytes are buffered.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 flush_size: int = FLUSH_SIZE)->None:
+        self.loop = loop
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.file = open(path, 'wb')
+        self.buffer = bytearray(MAGIC)
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.next_id = 1
+        self.records = 0
+
+    def add(self, ws: 'AsyncWebsocketConnection')->None:
+        ws.capture_id = self.next_id
+        self.next_id += 1
+        self.record(ws.capture_id, DIRECTION_OPEN, 0, str(ws).encode('utf-8'))
+
+    def remove(self, ws: 'AsyncWebsocketConnection')->None:
+        self.record(ws.capture_id, DIRECTION_CLOSE, 0, b'')
+
+    def on_frame_received(self, ws: 'AsyncWebsocketConnection', frame: Frame,
+                          continued: bool)->None:
+        '''
+        continued: the next chunk of a streaming frame
+        '''
+        if continued:
+            header = _CONTINUATION
+        else:
+            header = frame.rsv | frame.opcode
+        if frame.fin and not frame.partial:
+            header |= _FIN
+        self.record(ws.capture_id, DIRECTION_IN, header, frame.payload)
+
+    def on_frame_sent(self, ws: 'AsyncWebsocketConnection', frame: List[bytes])->None:
+        '''
+        an encoded frame. [header + payload] or [header, payload]
+        '''
+        header = frame[0]
+        length = header[1] & _PAYLOAD_LEN
+        offset = 2 if length < 126 else 4 if length == 126 else 10
+        masks = None
+        if header[1] & _MASKED:
+            masks = header[offset:offset + 4]
+            offset += 4
+        payload = frame[1] if len(frame) > 1 else memoryview(header)[offset:]
+        if masks:
+            payload = mask(masks, payload)
+        self.record(ws.capture_id, DIRECTION_OUT, header[0], payload)
+
+    def record(self, connection: int, direction: int, header: int, payload: bytes)->None:
+        if self.file is None:
+            return
+        buffer = self.buffer
+        buffer += RECORD.pack(time.time(), connection, direction, header, len(payload))
+        buffer += payload
+        self.records += 1
+        if len(buffer) >= self.flush_size:
+            self.flush()
+        elif not self.flush_handle:
+            self.flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self)->None:
+        '''
+        one write of the buffered records
+        '''
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.buffer and self.file:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+
+    def close(self)->None:
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class CaptureFile:
+    '''
+    memory mapped log. payloads are views of the mapping, release them before close.
+
+    with CaptureFile('traffic.cap') as capture:
+        for record in capture:
+            ...
+    '''
+
+    def __init__(self, path: str)->None:
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size < len(MAGIC):
+            self.file.close()
+            raise AsyncWebsocketError('not a capture: %s' % path)
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mapped[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise AsyncWebsocketError('not a capture: %s' % path)
+
+    def __enter__(self)->'CaptureFile':
+        return self
+
+    def __exit__(self, *exc)->None:
+        self.close()
+
+    def __iter__(self)->Iterator[CaptureRecord]:
+        '''
+        a record cut off at the end of a live log is skipped
+        '''
+        mapped = self.mapped
+        size = self.size
+        pos = len(MAGIC)
+        with memoryview(mapped) as view:
+            while pos + RECORD.size <= size:
+                timestamp, connection, direction, header, length = RECORD.unpack_from(mapped, pos)
+                pos += RECORD.size
+                if pos + length > size:
+                    break
+                yield CaptureRecord(timestamp, connection, direction, bool(header & _FIN),
+                                    header & _RSV, header & _OPCODE, view[pos:pos + length])
+                pos += length
+
+    def close(self)->None:
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        self.file.close()
@@ -3,46 +3,101 @@ logger = getLogger(__name__)
 
 
 import asyncio
-from .exception import AsyncWebsocketError
+from typing import Any, Dict, Optional
+from .exception import AsyncWebsocketError, AsyncWebsocketHandshakeError
 from .handler import AsyncWebsocketCallbackBase, AsyncWebsocketHandler
 from .connection import AsyncWebsocketConnection
 from .handshake import make_handshake_request
+from .http import HttpResponse
+from .deflate import DeflateOptions, make_offer, negotiate_client
+from .protocol import client_connect_protocol_async, socket_path
 
 
 async def client_connect_async(loop: asyncio.AbstractEventLoop,
                                callbacks: AsyncWebsocketCallbackBase,
-                               host: str, port: int, path: str)->None:
+                               host: str, port: int, path: str,
+                               use_protocol: bool = False,
+                               deflate: Optional[DeflateOptions] = None,
+                               address: Optional[str] = None,
+                               connect_timeout: Optional[float] = None,
+                               handshake_timeout: Optional[float] = None,
+                               unix_path: Optional[str] = None,
+                               **connection_options)->None:
+    '''
+    run a connection until it is closed.
+
+    address: connect to this address instead of resolving host. Host header is host
+    connect_timeout, handshake_timeout: raise asyncio.TimeoutError
+    unix_path: connect to this unix domain socket. '@name' is the linux abstract
+    namespace. host and port are only for the Host header, port 0 is left out
+    '''
+    if use_protocol:
+        await client_connect_protocol_async(
+            loop, callbacks, host, port, path, deflate,
+            address, connect_timeout, handshake_timeout, unix_path, **connection_options)
+        return
+
     #parsed = urlparse(url)
-    logger.debug('connect %s:%s%s', host, port, path)
-    reader, writer = await asyncio.open_connection(
-        host=host, port=port, loop=loop)
+    if unix_path:
+        logger.debug('connect %s%s', unix_path, path)
+        connect = asyncio.open_unix_connection(socket_path(unix_path))
+    else:
+        logger.debug('connect %s:%s%s', host, port, path)
+        connect = asyncio.open_connection(host=address or host, port=port)
+    reader, writer = await asyncio.wait_for(connect, connect_timeout)
+
+    try:
+        response = await asyncio.wait_for(_handshake_async(
+            reader, writer, host, port, path, deflate, connection_options),
+            handshake_timeout)
+    except BaseException:
+        writer.transport.abort()
+        raise
+
+    logger.debug('switch to websocket')
+
+    # WebSocket
+    client = AsyncWebsocketConnection(
+        host, port, writer, True, **connection_options)
+    if deflate:
+        try:
+            client.deflate = negotiate_client(
+                response.get_header(b'sec-websocket-extensions'), deflate)
+        except AsyncWebsocketError:
+            writer.transport.abort()
+            raise
+    ws = AsyncWebsocketHandler(loop, callbacks, reader, client)
+    await ws.handle()
 
-    hostport_bytes = f'{host}:{port}'.encode('utf-8')
+
+async def _handshake_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                           host: str, port: int, path: str,
+                           deflate: Optional[DeflateOptions],
+                           connection_options: Dict[str, Any])->HttpResponse:
+    hostport = f'{host}:{port}' if port else host
+    hostport_bytes = hostport.encode('utf-8')
     path_bytes = (path or '/').encode('utf-8')
 
     # Handshake
-    header_str = make_handshake_request(hostport_bytes, path_bytes)
+    extensions = make_offer(deflate) if deflate else None
+    header_str = make_handshake_request(hostport_bytes, path_bytes, extensions)
     writer.write(header_str)
 
     # http response
     line = await reader.readline()
-    splited = line.decode('utf-8').split(' ', 2)
-    if len(splited) != 3:
-        raise AsyncWebsocketError('not http ?')
-
-    _http_version, status_code, _status = splited
-    if int(status_code) != 101:
-        raise AsyncWebsocketError('fail to switch: %s' % line)
+    response = HttpResponse(line.rstrip(b'\r\n'))
+    if response.status_code != 101:
+        metrics = connection_options.get('metrics')
+        if metrics:
+            metrics.on_handshake_error('status %d' % response.status_code)
+        raise AsyncWebsocketHandshakeError('fail to switch: %s' % line, response.status_code)
 
     while True:
         line = await reader.readline()
         if line == b'\r\n':
             break
+        if not line:
+            raise AsyncWebsocketError('closed in handshake')
         logger.debug('%s', line)
-
-    logger.debug('switch to websocket')
-
-    # WebSocket
-    client = AsyncWebsocketConnection(host, port, writer, True)
-    ws = AsyncWebsocketHandler(loop, callbacks, reader, client)
-    await ws.handle()
+        response.push_line(line[:-2])
+    return response
@@ -0,0 +1,335 @@
+'''
+many client sessions on one loop.
+
+sessions reconnect with jittered exponential backoff. addresses are resolved
+once per host and cached.
+
+manager = ClientManager(loop, handshake_timeout=5.0)
+session = manager.open(callbacks, 'example.com', 80, '/ws')
+await session.send(b'data')
+await manager.close_async()
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+import random
+import socket
+from collections import deque
+from typing import Any, Callable, Collection, Deque, Dict, List, Optional, Set, Tuple, Union
+
+from .constants import OPCODE
+from .exception import AsyncWebsocketHandshakeError
+from .connection import AsyncWebsocketConnection
+from .handler import AsyncWebsocketCallbackBase
+from .stream import MessageStream
+from .client import client_connect_async
+
+DEFAULT_MAX_BUFFERED = 1024
+# handshake responses retried with backoff. others close the session
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+class Backoff:
+    '''
+    full jitter. delay is random in [0, min(maximum, initial * factor ** attempt)]
+    '''
+
+    def __init__(self, initial: float = 0.5, maximum: float = 30.0, factor: float = 2.0)->None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+
+    def delay(self, attempt: int)->float:
+        return random.uniform(0, min(self.maximum, self.initial * self.factor ** attempt))
+
+
+class ClientSession(AsyncWebsocketCallbackBase):
+    '''
+    one reconnecting connection. forwards events to callbacks.
+
+    send buffers up to max_buffered messages while disconnected,
+    then waits for the connection.
+    '''
+
+    def __init__(self, manager: 'ClientManager', callbacks: AsyncWebsocketCallbackBase,
+                 host: str, port: int, path: str,
+                 max_buffered: int = DEFAULT_MAX_BUFFERED,
+                 **connection_options)->None:
+        self.manager = manager
+        self.callbacks = callbacks
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_buffered = max_buffered
+        self.connection_options = connection_options
+        self.ws: Optional[AsyncWebsocketConnection] = None
+        self.outbox: Deque[Tuple[bytes, OPCODE]] = deque()
+        self.connected = asyncio.Event()
+        self.outbox_waiters: List[asyncio.Future] = []
+        self.task: Optional[asyncio.Future] = None
+        self.closing = False
+        self.attempt = 0
+        self.connect_count = 0
+        # why the session closed by itself
+        self.error: Optional[Exception] = None
+
+    def __str__(self)->str:
+        return f'session({self.host}:{self.port}{self.path})'
+
+    #
+    # send
+    #
+    async def send(self, payload: Union[bytes, str], opcode: OPCODE = OPCODE.BINARY)->bool:
+        '''
+        send now or buffer until connected.
+        return False if the session is closed.
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+            if opcode == OPCODE.BINARY:
+                opcode = OPCODE.TEXT
+        while not self.closing:
+            ws = self.ws
+            if ws and not self.outbox:
+                return await ws.send_async(payload, opcode)
+            if len(self.outbox) < self.max_buffered:
+                self.outbox.append((payload, opcode))
+                return True
+            waiter = asyncio.get_running_loop().create_future()
+            self.outbox_waiters.append(waiter)
+            await waiter
+        return False
+
+    async def send_text(self, message: str)->bool:
+        return await self.send(message.encode('utf-8'), OPCODE.TEXT)
+
+    def _flush_outbox(self)->None:
+        ws = self.ws
+        while self.outbox and ws and not ws.transport.is_closing():
+            payload, opcode = self.outbox.popleft()
+            ws.send(payload, opcode)
+        self._wakeup_senders()
+
+    def _wakeup_senders(self)->None:
+        waiters = self.outbox_waiters
+        self.outbox_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    #
+    # connection loop
+    #
+    async def close_async(self)->None:
+        self.closing = True
+        self._wakeup_senders()
+        if self.ws:
+            self.ws.send_close()
+            self.ws.transport.close()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run_async(self)->None:
+        manager = self.manager
+        while not self.closing:
+            try:
+                address = None
+                if not self.connection_options.get('unix_path'):
+                    address = await manager.resolve_async(self.host, self.port)
+                async with manager.connecting:
+                    await manager.throttle_async()
+                    connect = asyncio.ensure_future(client_connect_async(
+                        manager.loop, self, self.host, self.port, self.path,
+                        address=address,
+                        connect_timeout=manager.connect_timeout,
+                        handshake_timeout=manager.handshake_timeout,
+                        **self.connection_options))
+                    # hold the slot until the handshake is done
+                    opened = asyncio.ensure_future(self.connected.wait())
+                    await asyncio.wait([connect, opened],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    opened.cancel()
+                await connect
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.TimeoutError) as ex:
+                logger.warning('%s: %r', self, ex)
+                manager.forget(self.host, self.port)
+            except AsyncWebsocketHandshakeError as ex:
+                logger.warning('%s: %r', self, ex)
+                if ex.status_code not in manager.retry_status_codes:
+                    self.error = ex
+                    self.callbacks.on_connect_failed(ex)
+                    break
+            except Exception as ex:
+                logger.warning('%s: %r', self, ex)
+
+            if self.closing or not manager.reconnect:
+                break
+            delay = manager.backoff.delay(self.attempt)
+            self.attempt += 1
+            logger.debug('%s: reconnect in %.2f s', self, delay)
+            await asyncio.sleep(delay)
+        self.closing = True
+        self._wakeup_senders()
+
+    #
+    # AsyncWebsocketCallbackBase
+    #
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->Any:
+        self.ws = ws
+        self.attempt = 0
+        self.connect_count += 1
+        self.connected.set()
+        result = self.callbacks.on_client_connected(ws)
+        self._flush_outbox()
+        return result
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->Any:
+        self.ws = None
+        self.connected.clear()
+        return self.callbacks.on_client_left(ws)
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->Any:
+        return self.callbacks.on_bytes_message_received(ws, msg)
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->Any:
+        return self.callbacks.on_text_message_received(ws, msg)
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->Any:
+        return self.callbacks.on_ping_received(ws, msg)
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->Any:
+        return self.callbacks.on_pong_received(ws, msg)
+
+    def on_messages_received(self, ws: AsyncWebsocketConnection,
+                             batch: List[Union[bytes, str]])->Any:
+        return self.callbacks.on_messages_received(ws, batch)
+
+    def on_message_chunk_received(self, ws: AsyncWebsocketConnection, opcode: OPCODE,
+                                  chunk: bytes, first: bool, last: bool)->None:
+        self.callbacks.on_message_chunk_received(ws, opcode, chunk, first, last)
+
+    def on_stream_received(self, ws: AsyncWebsocketConnection, stream: MessageStream)->None:
+        self.callbacks.on_stream_received(ws, stream)
+
+
+class ClientManager:
+    '''
+    connect_rate: new connections per second. None is unlimited
+    max_connecting: concurrent connects and handshakes
+    dns_ttl: seconds to keep resolved addresses
+    retry_status_codes: handshake rejections retried with backoff. on others
+    the session closes and callbacks.on_connect_failed is called
+    connection_options: passed to client_connect_async. use_protocol, deflate, heartbeat...
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 connect_timeout: Optional[float] = 10.0,
+                 handshake_timeout: Optional[float] = 10.0,
+                 reconnect: bool = True,
+                 backoff: Optional[Backoff] = None,
+                 connect_rate: Optional[float] = None,
+                 max_connecting: int = 256,
+                 dns_ttl: float = 300.0,
+                 retry_status_codes: Collection[int] = RETRY_STATUS_CODES,
+                 **connection_options)->None:
+        self.loop = loop
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.reconnect = reconnect
+        self.backoff = backoff or Backoff()
+        self.connect_rate = connect_rate
+        self.connecting = asyncio.Semaphore(max_connecting)
+        self.dns_ttl = dns_ttl
+        self.retry_status_codes = retry_status_codes
+        self.connection_options = dict(connection_options)
+        self.connection_options.setdefault('use_protocol', True)
+        self.sessions: Set[ClientSession] = set()
+        # (host, port) => expire, addresses, next index
+        self.dns_cache: Dict[Tuple[str, int], Tuple[float, List[str], int]] = {}
+        self.dns_pending: Dict[Tuple[str, int], asyncio.Future] = {}
+        self.next_connect = 0.0
+
+    def open(self, callbacks: AsyncWebsocketCallbackBase,
+             host: str, port: int, path: str = '/', **options)->ClientSession:
+        '''
+        start a session. options override connection_options
+        '''
+        session = ClientSession(self, callbacks, host, port, path,
+                                **dict(self.connection_options, **options))
+        self.sessions.add(session)
+        session.task = asyncio.ensure_future(self._run_session_async(session))
+        return session
+
+    async def _run_session_async(self, session: ClientSession)->None:
+        try:
+            await session._run_async()
+        finally:
+            self.sessions.discard(session)
+
+    def open_many(self, count: int, callbacks_factory: Callable[[int], AsyncWebsocketCallbackBase],
+                  host: str, port: int, path: str = '/', **options)->List[ClientSession]:
+        '''
+        load generation. connect_rate and max_connecting pace the connects
+        '''
+        return [self.open(callbacks_factory(i), host, port, path, **options)
+                for i in range(count)]
+
+    async def close_async(self)->None:
+        await asyncio.gather(*[session.close_async() for session in list(self.sessions)],
+                             return_exceptions=True)
+
+    async def throttle_async(self)->None:
+        '''
+        wait for a connect slot by connect_rate
+        '''
+        if not self.connect_rate:
+            return
+        now = self.loop.time()
+        start = max(now, self.next_connect)
+        self.next_connect = start + 1.0 / self.connect_rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    #
+    # dns
+    #
+    async def resolve_async(self, host: str, port: int)->str:
+        '''
+        cached address of host. rotates if host has many addresses
+        '''
+        key = (host, port)
+        entry = self.dns_cache.get(key)
+        if not entry or entry[0] < self.loop.time():
+            pending = self.dns_pending.get(key)
+            if not pending:
+                pending = self.dns_pending[key] = asyncio.ensure_future(
+                    self._resolve_async(host, port))
+                pending.add_done_callback(lambda _: self.dns_pending.pop(key, None))
+            addresses = await asyncio.shield(pending)
+            entry = self.dns_cache[key] = (self.loop.time() + self.dns_ttl, addresses, 0)
+        expire, addresses, index = entry
+        self.dns_cache[key] = (expire, addresses, index + 1)
+        return addresses[index % len(addresses)]
+
+    async def _resolve_async(self, host: str, port: int)->List[str]:
+        infos = await self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = []
+        for _family, _type, _proto, _name, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        if not addresses:
+            raise OSError('no address: %s' % host)
+        return addresses
+
+    def forget(self, host: str, port: int)->None:
+        '''
+        resolve again on the next connect
+        '''
+        self.dns_cache.pop((host, port), None)
@@ -1,30 +1,382 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
 import struct
 import asyncio
-from .constants import OPCODE, CONSTANTS, CLOSESTATUS
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Deque, Iterator, List, NamedTuple, Optional, Union
+from .constants import OPCODE, CONSTANTS, CLOSESTATUS, SENDPOLICY
+from .exception import AsyncWebsocketError
+from .deflate import PerMessageDeflate
+from .metrics import MetricsHooks
+from .heartbeat import Heartbeat
+from .ratelimit import RateLimiter
+from .capture import TrafficRecorder
 from .masking import mask
+from .frame import encode_frame_header
+from .stream import STREAM_SOURCE_TYPE, DEFAULT_FRAGMENT_SIZE, iter_chunks_async
+
+WRITER_TYPE = Union[asyncio.streams.StreamWriter, asyncio.WriteTransport]
+
+DEFAULT_HIGH_WATER = 64 * 1024
+# header and payload are joined into one bytes up to this size
+SMALL_FRAME_SIZE = 4096
+# write without waiting for the end of the loop iteration over this
+COALESCE_LIMIT = 64 * 1024
+
+
+class RawMessage(NamedTuple):
+    '''
+    a message to compress when it is written. permessage-deflate shares
+    the compressor state between messages, so a message must not be
+    compressed before it is certain to go out, in order
+    '''
+    payload: bytes
+    opcode: OPCODE
+
+
+QUEUED_TYPE = Union[List[bytes], RawMessage]
+
+
+def queued_size(item: QUEUED_TYPE)->int:
+    if isinstance(item, RawMessage):
+        return len(item.payload)
+    return sum(len(x) for x in item)
 
 
 class AsyncWebsocketConnection:
+    # 100k idle connections per process. no __dict__,
+    # queues and locks are created on first use
+    __slots__ = (
+        'host', 'port', 'writer', 'use_mask', 'transport', 'loop',
+        'out', 'out_bytes', 'flush_handle', 'cork_count',
+        'send_policy', 'high_water', 'low_water',
+        'paused', 'closed', 'drain_waiters',
+        'pending', 'pending_bytes', 'flush_task', 'dropped_messages',
+        '_send_lock', 'stream_sending', 'deferred', 'deferred_bytes',
+        'max_message_size', 'streaming', 'message_stream', 'deflate', 'metrics',
+        'auto_pong', 'max_inflight', 'callback_semaphore', 'heartbeat', 'zero_copy',
+        'batch_size', 'batch_latency', 'rate_limiter', 'rate_state',
+        'max_frames_per_turn', 'max_bytes_per_turn', 'read_yields', 'read_pauses',
+        'recorder', 'capture_id',
+        'last_read', 'ping_sent', 'write_buffered', 'write_stalled_since',
+        'user_data', '__weakref__')
+
     def __init__(self, host: str, port: int,
-                 writer: asyncio.streams.StreamWriter, use_mask: bool)->None:
+                 writer: WRITER_TYPE, use_mask: bool,
+                 high_water: int = DEFAULT_HIGH_WATER,
+                 low_water: Optional[int] = None,
+                 send_policy: SENDPOLICY = SENDPOLICY.BLOCK,
+                 max_message_size: Optional[int] = None,
+                 streaming: bool = False,
+                 metrics: Optional[MetricsHooks] = None,
+                 heartbeat: Optional[Heartbeat] = None,
+                 auto_pong: bool = True,
+                 max_inflight: int = 64,
+                 callback_semaphore: Optional[asyncio.Semaphore] = None,
+                 zero_copy: bool = False,
+                 batch_size: int = 0,
+                 batch_latency: float = 0.0,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 max_frames_per_turn: Optional[int] = None,
+                 max_bytes_per_turn: Optional[int] = None,
+                 recorder: Optional[TrafficRecorder] = None)->None:
+        '''
+        writer is StreamWriter(stream mode) or Transport(protocol mode).
+        created in the running loop
+
+        streaming delivers received messages in chunks.
+        see AsyncWebsocketCallbackBase.on_message_chunk_received
+
+        metrics receives counters and stage timing. see metrics.Metrics
+
+        heartbeat sends ping and closes unresponsive connections. see heartbeat.Heartbeat
+        auto_pong replies to ping before on_ping_received
+
+        async def callbacks: reading is paused while max_inflight callbacks are waiting.
+        callback_semaphore shared by connections limits running coroutine callbacks.
+
+        zero_copy: on_bytes_message_received gets a memoryview of the receive buffer,
+        valid only during the call. copy it with bytes() to keep it.
+        async def on_bytes_message_received gets bytes.
+
+        batch_size: deliver data messages by on_messages_received, up to this many at once.
+        0 disables. batch_latency: seconds to wait for more messages. 0 delivers
+        what was read at once.
+
+        rate_limiter pauses reading over the message and byte rates. see ratelimit.RateLimiter
+        max_frames_per_turn, max_bytes_per_turn: process this much, then let other
+        connections run before the rest of the read.
+
+        recorder appends the received and sent frames to a capture log. see capture.TrafficRecorder
+        '''
         self.host = host
         self.port = port
         self.writer = writer
         self.use_mask = use_mask
 
+        # StreamWriter has transport. Transport is itself
+        self.transport: asyncio.WriteTransport = getattr(
+            writer, 'transport', writer)
+        self.loop = asyncio.get_running_loop()
+
+        # frames written in this loop iteration. flushed by one writelines
+        self.out: Optional[List[bytes]] = None
+        self.out_bytes = 0
+        self.flush_handle: Optional[asyncio.Handle] = None
+        self.cork_count = 0
+        self.send_policy = send_policy
+        self.set_write_buffer_limits(high_water, low_water)
+
+        # protocol mode flow control
+        self.paused = False
+        self.closed = False
+        self.drain_waiters: Optional[List[asyncio.Future]] = None
+
+        # SENDPOLICY.DROP_OLDEST queue
+        self.pending: Optional[Deque[QUEUED_TYPE]] = None
+        self.pending_bytes = 0
+        self.flush_task: Optional[asyncio.Future] = None
+
+        self.dropped_messages = 0
+
+        # send_stream_async
+        self._send_lock: Optional[asyncio.Lock] = None
+        self.stream_sending = False
+        self.deferred: Optional[Deque[QUEUED_TYPE]] = None
+        self.deferred_bytes = 0
+
+        # receive
+        self.max_message_size = max_message_size
+        self.streaming = streaming
+        self.message_stream: Optional['MessageStream'] = None
+
+        # permessage-deflate. set by the handshake
+        self.deflate: Optional[PerMessageDeflate] = None
+
+        self.metrics = metrics
+
+        self.auto_pong = auto_pong
+        self.max_inflight = max_inflight
+        self.callback_semaphore = callback_semaphore
+        self.heartbeat = heartbeat
+        self.zero_copy = zero_copy
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.rate_limiter = rate_limiter
+        # ratelimit.ConnectionRate. set by rate_limiter
+        self.rate_state = None
+        self.max_frames_per_turn = max_frames_per_turn
+        self.max_bytes_per_turn = max_bytes_per_turn
+        # times a read was split by max_frames/bytes_per_turn
+        self.read_yields = 0
+        # reading is paused while any of flow control, callbacks and rate limit pause it
+        self.read_pauses = 0
+        self.recorder = recorder
+        # set by recorder
+        self.capture_id = 0
+        # updated by Heartbeat and AsyncWebsocketHandler
+        self.last_read = 0.0
+        self.ping_sent: Optional[float] = None
+        self.write_buffered = 0
+        self.write_stalled_since: Optional[float] = None
+
+        # free for the application
+        self.user_data: Any = None
+
     def __str__(self)->str:
         return f'({self.host}:{self.port})'
 
+    @property
+    def send_lock(self)->asyncio.Lock:
+        if not self._send_lock:
+            self._send_lock = asyncio.Lock()
+        return self._send_lock
+
+    def set_write_buffer_limits(self, high_water: int, low_water: Optional[int] = None)->None:
+        if low_water is None:
+            low_water = high_water // 4
+        self.high_water = high_water
+        self.low_water = low_water
+        self.transport.set_write_buffer_limits(high_water, low_water)
+
+    @property
+    def buffered_bytes(self)->int:
+        '''
+        bytes written but not sent to the socket yet
+        '''
+        return self.transport.get_write_buffer_size() + self.out_bytes + self.pending_bytes
+
+    def is_writable(self)->bool:
+        return (not self.pending
+                and self.transport.get_write_buffer_size() + self.out_bytes < self.high_water)
+
+    def pause_reading(self)->None:
+        '''
+        every pause_reading needs a resume_reading
+        '''
+        self.read_pauses += 1
+        if self.read_pauses == 1 and not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def resume_reading(self)->None:
+        self.read_pauses -= 1
+        if self.read_pauses == 0 and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    #
+    # flow control. called from AsyncWebsocketProtocolBase
+    #
+    def pause_writing(self)->None:
+        self.paused = True
+
+    def resume_writing(self)->None:
+        self.paused = False
+        self._wakeup_waiters(None)
+
+    def connection_lost(self, exc: Optional[Exception])->None:
+        self.closed = True
+        self.paused = False
+        self.pending = None
+        self.pending_bytes = 0
+        self.out = None
+        self.out_bytes = 0
+        self._wakeup_waiters(exc or ConnectionResetError('Connection lost'))
+
+    def _wakeup_waiters(self, exc: Optional[Exception])->None:
+        waiters = self.drain_waiters
+        if not waiters:
+            return
+        self.drain_waiters = None
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc:
+                waiter.set_exception(exc)
+            else:
+                waiter.set_result(None)
+
+    async def drain(self)->None:
+        '''
+        wait until the write buffer is below low water
+        '''
+        self.flush()
+        if isinstance(self.writer, asyncio.StreamWriter):
+            await self.writer.drain()
+            return
+        if self.closed:
+            raise ConnectionResetError('Connection lost')
+        if not self.paused:
+            return
+        waiter = self.loop.create_future()
+        if self.drain_waiters is None:
+            self.drain_waiters = []
+        self.drain_waiters.append(waiter)
+        await waiter
+
+    #
+    # send
+    #
     def send_pong(self, message: str)->None:
         self.send_text(message, OPCODE.PONG)
 
-    def send_text(self, message: str, opcode: OPCODE = OPCODE.TEXT)->None:
-        self.send(message.encode('utf-8'), opcode)
+    def send_text(self, message: str, opcode: OPCODE = OPCODE.TEXT)->bool:
+        return self.send(message.encode('utf-8'), opcode)
 
     def send_close(self, status: CLOSESTATUS = CLOSESTATUS.NORMAL, reason: bytes = b"")->None:
         self.send(struct.pack('!H', status) + reason, OPCODE.CLOSE_CONN)
+        # the transport may be closed right after this
+        self.flush()
 
-    def send(self, payload: bytes, opcode: OPCODE = OPCODE.BINARY)->None:
+    def send(self, payload: bytes, opcode: OPCODE = OPCODE.BINARY)->bool:
+        '''
+        write a frame without waiting.
+        if the write buffer is over high water, send_policy is applied.
+        return False if the message was dropped.
+        '''
+        if self.transport.is_closing():
+            return False
+        if opcode >= OPCODE.CLOSE_CONN:
+            # control frames are never dropped
+            self.write_frame(self.encode(payload, opcode))
+            return True
+        if self.deflate and self.deflate.should_compress(payload):
+            # compressed when written. a dropped message never reaches the compressor
+            return self.write_frame_with_policy(RawMessage(payload, opcode))
+        return self.write_frame_with_policy(self.encode(payload, opcode))
+
+    async def send_text_async(self, message: str, opcode: OPCODE = OPCODE.TEXT)->bool:
+        return await self.send_async(message.encode('utf-8'), opcode)
+
+    async def send_async(self, payload: bytes, opcode: OPCODE = OPCODE.BINARY)->bool:
+        '''
+        with SENDPOLICY.BLOCK, wait drain while the write buffer is over high water
+        '''
+        if self.send_policy == SENDPOLICY.BLOCK and not self.is_writable():
+            await self.drain()
+        if self.stream_sending and opcode < OPCODE.CLOSE_CONN:
+            async with self.send_lock:
+                return self.send(payload, opcode)
+        return self.send(payload, opcode)
+
+    async def send_stream_async(self, source: STREAM_SOURCE_TYPE,
+                                opcode: OPCODE = OPCODE.BINARY,
+                                fragment_size: int = DEFAULT_FRAGMENT_SIZE)->None:
+        '''
+        send a message as the first frame and CONTINUATION frames.
+
+        source is bytes, a binary file object, a path or an (async) iterable of bytes.
+        waits drain between fragments, so control frames can go out in between.
+        other data messages sent meanwhile are written after this message,
+        and compressed after it with permessage-deflate.
+        '''
+        async with self.send_lock:
+            if self.flush_task:
+                await self.flush_task
+            self.stream_sending = True
+            try:
+                await self._send_fragments_async(
+                    iter_chunks_async(source, fragment_size), opcode)
+            finally:
+                self.stream_sending = False
+                deferred = self.deferred
+                self.deferred = None
+                self.deferred_bytes = 0
+                for frame in deferred or ():
+                    self.write_frame_with_policy(frame)
+
+    async def _send_fragments_async(self, chunks: AsyncIterator[bytes], opcode: OPCODE)->None:
+        deflate = self.deflate
+        rsv = CONSTANTS.RSV1 if deflate else 0
+        current = None
+        async for chunk in chunks:
+            if current is not None:
+                self._write_fragment(current, opcode, False, rsv)
+                opcode = OPCODE.CONTINUATION
+                rsv = 0
+                if self.buffered_bytes >= self.high_water:
+                    await self.drain()
+            current = chunk
+        self._write_fragment(current or b'', opcode, True, rsv)
+
+    def _write_fragment(self, chunk: bytes, opcode: OPCODE, fin: bool, rsv: int)->None:
+        if self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        if self.deflate:
+            chunk = self.deflate.compress_chunk(chunk, fin)
+        self.write_frame(self.encode_frame(chunk, opcode, fin, rsv))
+
+    def try_send(self, payload: bytes, opcode: OPCODE = OPCODE.BINARY)->bool:
+        '''
+        send only if it would not block. return False if not sent.
+        '''
+        if self.transport.is_closing() or self.stream_sending or not self.is_writable():
+            return False
+        self.write_frame(self.encode(payload, opcode))
+        return True
+
+    def encode(self, payload: bytes, opcode: OPCODE)->List[bytes]:
         '''
         +-+-+-+-+-------+-+-------------+-------------------------------+
         0                   1                   2                   3
@@ -40,36 +392,177 @@ class AsyncWebsocketConnection:
         |                     Payload Data continued ...                |
         +---------------------------------------------------------------+
         '''
-        header = bytearray()
-        payload_length = len(payload)
+        rsv = 0
+        if self.deflate and opcode < OPCODE.CLOSE_CONN and self.deflate.should_compress(payload):
+            payload = self.deflate.compress(payload)
+            rsv = CONSTANTS.RSV1
+        return self.encode_frame(payload, opcode, True, rsv)
+
+    def encode_frame(self, payload: bytes, opcode: int, fin: bool, rsv: int)->List[bytes]:
+        header = encode_frame_header(len(payload), opcode, self.use_mask, fin, rsv)
+        if self.use_mask:
+            mask_key = b'0123'
+            header += mask_key
+            payload = mask(mask_key, payload)
+        if len(payload) <= SMALL_FRAME_SIZE:
+            return [header + payload]
+        return [header, payload]
+
+    def write_frame(self, frame: List[bytes])->None:
+        '''
+        frames are written to the transport at the end of the loop iteration,
+        when COALESCE_LIMIT is reached, or by uncork
+        '''
+        size = 0
+        for x in frame:
+            size += len(x)
+        if self.out is None:
+            self.out = frame[:]
+        else:
+            self.out.extend(frame)
+        self.out_bytes += size
+        if not self.cork_count:
+            if self.out_bytes >= min(COALESCE_LIMIT, self.high_water // 2):
+                self.flush()
+            elif not self.flush_handle:
+                self.flush_handle = self.loop.call_soon(self.flush)
+        if self.metrics:
+            self.metrics.on_frame_sent(self, size)
+        if self.recorder:
+            self.recorder.on_frame_sent(self, frame)
+
+    def flush(self)->None:
+        '''
+        write the queued frames by one writelines
+        '''
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.out:
+            return
+        out = self.out
+        self.out = None
+        self.out_bytes = 0
+        if self.transport.is_closing():
+            return
+        if len(out) == 1:
+            self.writer.write(out[0])
+        else:
+            self.writer.writelines(out)
 
-        mask_flag = CONSTANTS.MASKED if self.use_mask else CONSTANTS.NOT_MASKED
+    def cork(self)->None:
+        '''
+        keep frames until uncork. for bulk sends
+        '''
+        self.cork_count += 1
 
-        # Normal payload
-        if payload_length <= 125:
-            header.append(CONSTANTS.FIN | opcode)
-            header.append(mask_flag | payload_length)
+    def uncork(self)->None:
+        if not self.cork_count:
+            raise AsyncWebsocketError('uncork without cork')
+        self.cork_count -= 1
+        if not self.cork_count:
+            self.flush()
 
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(CONSTANTS.FIN | opcode)
-            header.append(mask_flag | CONSTANTS.PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
+    @contextmanager
+    def corked(self)->Iterator['AsyncWebsocketConnection']:
+        '''
+        with ws.corked():
+            for x in messages:
+                ws.send(x)
+        '''
+        self.cork()
+        try:
+            yield self
+        finally:
+            self.uncork()
 
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(CONSTANTS.FIN | opcode)
-            header.append(mask_flag | CONSTANTS.PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
+    def drop_message(self)->None:
+        self.dropped_messages += 1
+        if self.metrics:
+            self.metrics.on_message_dropped(self)
 
-        else:
-            raise Exception(
-                "Message is too big. Consider breaking it into chunks.")
+    def write_queued(self, item: QUEUED_TYPE)->None:
+        if isinstance(item, RawMessage):
+            item = self.encode(item.payload, item.opcode)
+        self.write_frame(item)
 
-        self.writer.write(header)
-        if self.use_mask:
-            mask_key = b'0123'
-            self.writer.write(mask_key)
-            self.writer.write(mask(mask_key, payload))
-        else:
-            self.writer.write(payload)
+    def write_frame_with_policy(self, frame: QUEUED_TYPE)->bool:
+        '''
+        frame is an encoded frame or a RawMessage to encode when written
+        '''
+        if self.stream_sending:
+            return self.defer_frame(frame)
+
+        if self.is_writable():
+            self.write_queued(frame)
+            return True
+
+        if self.send_policy == SENDPOLICY.BLOCK:
+            self.write_queued(frame)
+            return True
+
+        if self.send_policy == SENDPOLICY.DROP_NEWEST:
+            self.drop_message()
+            return False
+
+        if self.send_policy == SENDPOLICY.DISCONNECT:
+            logger.warning('%s: slow consumer. disconnect', self)
+            self.drop_message()
+            self.transport.abort()
+            return False
+
+        # SENDPOLICY.DROP_OLDEST
+        if self.pending is None:
+            self.pending = deque()
+        self.pending.append(frame)
+        self.pending_bytes += queued_size(frame)
+        while self.pending_bytes > self.high_water and len(self.pending) > 1:
+            dropped = self.pending.popleft()
+            self.pending_bytes -= queued_size(dropped)
+            self.drop_message()
+        if not self.flush_task:
+            self.flush_task = asyncio.ensure_future(self._flush_pending_async())
+        return True
+
+    def defer_frame(self, frame: QUEUED_TYPE)->bool:
+        '''
+        keep a frame sent during send_stream_async for after the fragmented message.
+        a RawMessage is compressed after the last fragment, the stream uses the compressor.
+        over high_water of deferred bytes, send_policy is applied
+        '''
+        if self.deferred is None:
+            self.deferred = deque()
+        if self.deferred_bytes >= self.high_water:
+            if self.send_policy == SENDPOLICY.DROP_NEWEST:
+                self.drop_message()
+                return False
+
+            if self.send_policy == SENDPOLICY.DISCONNECT:
+                logger.warning('%s: slow consumer. disconnect', self)
+                self.drop_message()
+                self.transport.abort()
+                return False
+
+        self.deferred.append(frame)
+        self.deferred_bytes += queued_size(frame)
+        if self.send_policy == SENDPOLICY.DROP_OLDEST:
+            while self.deferred_bytes > self.high_water and len(self.deferred) > 1:
+                dropped = self.deferred.popleft()
+                self.deferred_bytes -= queued_size(dropped)
+                self.drop_message()
+        return True
+
+    async def _flush_pending_async(self)->None:
+        try:
+            while self.pending:
+                await self.drain()
+                while self.pending and self.buffered_bytes - self.pending_bytes < self.high_water:
+                    frame = self.pending.popleft()
+                    self.pending_bytes -= queued_size(frame)
+                    self.write_queued(frame)
+        except ConnectionError:
+            pass
+        finally:
+            self.flush_task = None
+            if not self.pending:
+                self.pending = None
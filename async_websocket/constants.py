@@ -18,6 +18,10 @@ class CONSTANTS(IntFlag):
     +---------------------------------------------------------------+
     '''
     FIN = 0x80 # 0
+    RSV = 0x70 # 0
+    RSV1 = 0x40 # 0
+    RSV2 = 0x20 # 0
+    RSV3 = 0x10 # 0
     OPCODE = 0x0f # 0
 
     MASKED = 0x80 # 1
@@ -45,3 +49,20 @@ class CLOSESTATUS(IntEnum):
     https://tools.ietf.org/html/rfc6455#section-11.7
     '''
     NORMAL = 1000
+    GOING_AWAY = 1001
+    PROTOCOL_ERROR = 1002
+    UNSUPPORTED_DATA = 1003
+    INVALID_DATA = 1007
+    POLICY_VIOLATION = 1008
+    MESSAGE_TOO_BIG = 1009
+    INTERNAL_ERROR = 1011
+
+
+class SENDPOLICY(IntEnum):
+    '''
+    what to do when the peer does not read and the write buffer is over high water
+    '''
+    BLOCK = 0  # write anyway. send_async waits drain
+    DROP_OLDEST = 1  # queue and drop the oldest queued message
+    DROP_NEWEST = 2  # drop the message being sent
+    DISCONNECT = 3  # abort the connection
@@ -0,0 +1,244 @@
+'''
+permessage-deflate
+
+https://tools.ietf.org/html/rfc7692
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import zlib
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .exception import AsyncWebsocketError, AsyncWebsocketProtocolError
+from .constants import CLOSESTATUS
+
+EXTENSION_NAME = b'permessage-deflate'
+_TAIL = b'\x00\x00\xff\xff'
+# zlib does not support raw deflate with 8 bits window.
+# the compressing side declines it instead of using a larger window than agreed
+MIN_COMPRESS_WINDOW_BITS = 9
+
+
+class DeflateOptions(NamedTuple):
+    '''
+    what this side asks for / accepts
+    '''
+    server_max_window_bits: int = 15
+    client_max_window_bits: int = 15
+    server_no_context_takeover: bool = False
+    client_no_context_takeover: bool = False
+    level: int = zlib.Z_DEFAULT_COMPRESSION
+    mem_level: int = 8
+    # smaller messages are sent uncompressed
+    min_size: int = 64
+    # decompressed size limit
+    max_message_size: int = 16 * 1024 * 1024
+
+
+class PerMessageDeflate:
+    '''
+    negotiated per connection state
+    '''
+
+    def __init__(self, options: DeflateOptions, is_server: bool,
+                 server_max_window_bits: int, client_max_window_bits: int,
+                 server_no_context_takeover: bool, client_no_context_takeover: bool)->None:
+        self.options = options
+        if is_server:
+            self.compress_bits = server_max_window_bits
+            self.decompress_bits = client_max_window_bits
+            self.compress_reset = server_no_context_takeover
+            self.decompress_reset = client_no_context_takeover
+        else:
+            self.compress_bits = client_max_window_bits
+            self.decompress_bits = server_max_window_bits
+            self.compress_reset = client_no_context_takeover
+            self.decompress_reset = server_no_context_takeover
+        if self.compress_bits < MIN_COMPRESS_WINDOW_BITS:
+            raise AsyncWebsocketError('cannot compress with %d bits window' % self.compress_bits)
+        self.compressor: Optional[zlib._Compress] = None
+        self.decompressor: Optional[zlib._Decompress] = None
+
+    def should_compress(self, payload: bytes)->bool:
+        return len(payload) >= self.options.min_size
+
+    def compress(self, payload: bytes)->bytes:
+        return self.compress_chunk(payload, True)
+
+    def compress_chunk(self, data: bytes, last: bool)->bytes:
+        '''
+        compress a part of a message. each part is flushed to be sent as a fragment.
+        '''
+        if not self.compressor:
+            self.compressor = zlib.compressobj(
+                self.options.level, zlib.DEFLATED, -self.compress_bits,
+                self.options.mem_level)
+        result = self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if last:
+            if result.endswith(_TAIL):
+                result = result[:-4]
+            if self.compress_reset:
+                self.compressor = None
+        return result
+
+    def decompress(self, payload: bytes)->bytes:
+        return self.decompress_chunk(payload, True, self.options.max_message_size)
+
+    def decompress_chunk(self, data: bytes, last: bool, limit: int)->bytes:
+        '''
+        decompress a part of a message. limit is the remaining size for the message.
+        '''
+        if not self.decompressor:
+            self.decompressor = zlib.decompressobj(-self.decompress_bits)
+        if last:
+            # data may be memoryview
+            data = b''.join((data, _TAIL))
+        try:
+            result = self.decompressor.decompress(data, limit + 1)
+        except zlib.error as ex:
+            raise AsyncWebsocketProtocolError(
+                'invalid deflate data: %s' % ex, CLOSESTATUS.INVALID_DATA)
+        if len(result) > limit or self.decompressor.unconsumed_tail:
+            raise AsyncWebsocketProtocolError(
+                'decompressed message exceeds %d bytes' % self.options.max_message_size,
+                CLOSESTATUS.MESSAGE_TOO_BIG)
+        if last and self.decompress_reset:
+            self.decompressor = None
+        return result
+
+
+def parse_extensions(value: Optional[bytes])->List[Tuple[bytes, Dict[bytes, Optional[bytes]]]]:
+    '''
+    Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits, x-other
+    '''
+    result = []
+    if not value:
+        return result
+    for extension in value.split(b','):
+        params = [x.strip() for x in extension.split(b';')]
+        name = params[0].lower()
+        if not name:
+            continue
+        param_map: Dict[bytes, Optional[bytes]] = {}
+        for param in params[1:]:
+            if not param:
+                continue
+            if b'=' in param:
+                k, v = param.split(b'=', 1)
+                param_map[k.strip().lower()] = v.strip().strip(b'"')
+            else:
+                param_map[param.lower()] = None
+        result.append((name, param_map))
+    return result
+
+
+def _window_bits(value: Optional[bytes])->int:
+    try:
+        bits = int(value)
+    except (TypeError, ValueError):
+        raise AsyncWebsocketError('invalid window bits: %s' % value)
+    if bits < 8 or bits > 15:
+        raise AsyncWebsocketError('invalid window bits: %d' % bits)
+    return bits
+
+
+def check_client_options(options: DeflateOptions)->None:
+    '''
+    raise AsyncWebsocketError if the client cannot keep its offer
+    '''
+    if options.client_max_window_bits < MIN_COMPRESS_WINDOW_BITS:
+        raise AsyncWebsocketError('cannot compress with %d bits window' % options.client_max_window_bits)
+
+
+def make_offer(options: DeflateOptions)->bytes:
+    '''
+    client request header value
+    '''
+    check_client_options(options)
+    params = [EXTENSION_NAME]
+    if options.server_no_context_takeover:
+        params.append(b'server_no_context_takeover')
+    if options.client_no_context_takeover:
+        params.append(b'client_no_context_takeover')
+    if options.server_max_window_bits < 15:
+        params.append(b'server_max_window_bits=%d' %
+                      options.server_max_window_bits)
+    if options.client_max_window_bits < 15:
+        params.append(b'client_max_window_bits=%d' %
+                      options.client_max_window_bits)
+    else:
+        params.append(b'client_max_window_bits')
+    return b'; '.join(params)
+
+
+def negotiate_server(value: Optional[bytes], options: DeflateOptions
+                     )->Tuple[Optional[PerMessageDeflate], Optional[bytes]]:
+    '''
+    server. accept the first acceptable offer.
+    return (state, response header value) or (None, None)
+    '''
+    for name, params in parse_extensions(value):
+        if name != EXTENSION_NAME:
+            continue
+        try:
+            server_bits = options.server_max_window_bits
+            if b'server_max_window_bits' in params:
+                server_bits = min(server_bits, _window_bits(
+                    params[b'server_max_window_bits']))
+
+            client_bits = 15
+            if b'client_max_window_bits' in params:
+                client_bits = options.client_max_window_bits
+                if params[b'client_max_window_bits'] is not None:
+                    client_bits = min(client_bits, _window_bits(
+                        params[b'client_max_window_bits']))
+            if server_bits < MIN_COMPRESS_WINDOW_BITS:
+                raise AsyncWebsocketError('cannot compress with %d bits window' % server_bits)
+        except AsyncWebsocketError as ex:
+            logger.debug('decline offer: %s', ex)
+            continue
+
+        server_reset = options.server_no_context_takeover or b'server_no_context_takeover' in params
+        client_reset = options.client_no_context_takeover or b'client_no_context_takeover' in params
+
+        response = [EXTENSION_NAME]
+        if server_reset:
+            response.append(b'server_no_context_takeover')
+        if client_reset:
+            response.append(b'client_no_context_takeover')
+        if server_bits < 15:
+            response.append(b'server_max_window_bits=%d' % server_bits)
+        if client_bits < 15:
+            response.append(b'client_max_window_bits=%d' % client_bits)
+
+        state = PerMessageDeflate(options, True, server_bits, client_bits,
+                                  server_reset, client_reset)
+        return state, b'; '.join(response)
+
+    return None, None
+
+
+def negotiate_client(value: Optional[bytes], options: DeflateOptions)->Optional[PerMessageDeflate]:
+    '''
+    client. apply the server response.
+    raise AsyncWebsocketError if this side cannot compress with the agreed window.
+    '''
+    extensions = parse_extensions(value)
+    if not extensions:
+        return None
+    if len(extensions) != 1 or extensions[0][0] != EXTENSION_NAME:
+        raise AsyncWebsocketError('unexpected extensions: %s' % value)
+    params = extensions[0][1]
+
+    server_bits = 15
+    if b'server_max_window_bits' in params:
+        server_bits = _window_bits(params[b'server_max_window_bits'])
+    client_bits = options.client_max_window_bits
+    if b'client_max_window_bits' in params:
+        client_bits = min(client_bits, _window_bits(
+            params[b'client_max_window_bits']))
+
+    return PerMessageDeflate(options, False, server_bits, client_bits,
+                             b'server_no_context_takeover' in params,
+                             options.client_no_context_takeover or b'client_no_context_takeover' in params)
@@ -1,2 +1,22 @@
 class AsyncWebsocketError(Exception):
     pass
+
+
+class AsyncWebsocketProtocolError(AsyncWebsocketError):
+    '''
+    the connection should be closed with status
+    '''
+
+    def __init__(self, message: str, status: int)->None:
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncWebsocketHandshakeError(AsyncWebsocketError):
+    '''
+    the server answered the handshake with status_code instead of 101
+    '''
+
+    def __init__(self, message: str, status_code: int)->None:
+        super().__init__(message)
+        self.status_code = status_code
@@ -0,0 +1,309 @@
+'''
+sans-IO websocket frame decoder
+'''
+import struct
+from typing import NamedTuple, Iterator, Optional, Tuple
+
+from .constants import CONSTANTS, OPCODE, CLOSESTATUS
+from .exception import AsyncWebsocketError, AsyncWebsocketProtocolError
+from .masking import mask, mask_inplace
+
+
+class Frame(NamedTuple):
+    fin: bool
+    rsv: int
+    opcode: int
+    masked: bool
+    # memoryview from BufferedFrameParser
+    payload: bytes
+    # streaming. more payload of this frame follows
+    partial: bool = False
+
+
+# plain ints. IntFlag operators are slow in the per frame path
+_FIN = int(CONSTANTS.FIN)
+_RSV = int(CONSTANTS.RSV)
+_OPCODE = int(CONSTANTS.OPCODE)
+_MASKED = int(CONSTANTS.MASKED)
+_PAYLOAD_LEN = int(CONSTANTS.PAYLOAD_LEN)
+_CONTROL = int(OPCODE.CLOSE_CONN)
+
+_EXT16 = struct.Struct('>H')
+_EXT64 = struct.Struct('>Q')
+_HEADER16 = struct.Struct('>BBH')
+_HEADER64 = struct.Struct('>BBQ')
+
+# shared by idle parsers. never written
+EMPTY_BUFFER = bytearray()
+
+
+def encode_frame_header(payload_length: int, opcode: int,
+                        masked: bool, fin: bool = True, rsv: int = 0)->bytes:
+    '''
+    header without mask key
+    '''
+    b1 = (_FIN if fin else 0) | rsv | opcode
+    mask_flag = _MASKED if masked else 0
+    if payload_length <= 125:
+        return bytes((b1, mask_flag | payload_length))
+    elif payload_length <= 65535:
+        return _HEADER16.pack(b1, mask_flag | 126, payload_length)
+    elif payload_length < 18446744073709551616:
+        return _HEADER64.pack(b1, mask_flag | 127, payload_length)
+    else:
+        raise AsyncWebsocketError(
+            "Message is too big. Consider breaking it into chunks.")
+
+
+class FrameParser:
+    '''
+    feed arbitrary chunks, get complete frames.
+
+    +-+-+-+-+-------+-+-------------+-------------------------------+
+    0                   1                   2                   3
+    0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+    +-+-+-+-+-------+-+-------------+-------------------------------+
+    |F|R|R|R| opcode|M| Payload len |    Extended payload length    |
+    |I|S|S|S|  (4)  |A|     (7)     |             (16/64)           |
+    |N|V|V|V|       |S|             |   (if payload len==126/127)   |
+    | |1|2|3|       |K|             |                               |
+    +-+-+-+-+-------+-+-------------+ - - - - - - - - - - - - - - - +
+    |     Extended payload length continued, if payload len == 127  |
+    + - - - - - - - - - - - - - - - +-------------------------------+
+    |                     Payload Data continued ...                |
+    +---------------------------------------------------------------+
+    '''
+
+    __slots__ = ('buffer', 'pos', 'end', 'max_frame_size', 'stream', 'current',
+                 'remaining', 'offset', 'mask', 'wanted')
+
+    def __init__(self)->None:
+        # unconsumed input is buffer[pos:end]. released when everything is consumed
+        self.buffer = EMPTY_BUFFER
+        self.pos = 0
+        self.end = 0
+        # larger frame raise MESSAGE_TOO_BIG before buffering
+        self.max_frame_size: Optional[int] = None
+        # yield data frame payload in chunks as it arrives
+        self.stream = False
+        # streaming frame
+        self.current: Optional[Tuple[bool, int, int, bool, bytes]] = None
+        self.remaining = 0
+        self.offset = 0
+        # replaced to measure unmask time
+        self.mask = mask
+        # size of the incomplete frame at pos. 0 if unknown
+        self.wanted = 0
+
+    def __len__(self)->int:
+        '''
+        buffered bytes not consumed yet
+        '''
+        return self.end - self.pos
+
+    def feed(self, data: bytes)->Iterator[Frame]:
+        '''
+        yield all complete frames. incomplete tail is kept for the next feed.
+        '''
+        if self.buffer is EMPTY_BUFFER:
+            self.buffer = bytearray(data)
+        else:
+            self.buffer.extend(data)
+        self.end = len(self.buffer)
+        return self._frames()
+
+    def parse(self)->Iterator[Frame]:
+        '''
+        frames left in the buffer by a consumer that stopped early
+        '''
+        return self._frames()
+
+    def _frames(self)->Iterator[Frame]:
+        try:
+            while True:
+                frame = self._parse_frame()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self._compact()
+
+    def _compact(self)->None:
+        if self.pos >= self.end:
+            self.buffer = EMPTY_BUFFER
+            self.pos = 0
+            self.end = 0
+        elif self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+            self.end = len(self.buffer)
+
+    def _payload(self, start: int, end: int, masks: bytes)->bytes:
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[start:end])
+        if masks:
+            payload = self.mask(masks, payload)
+        return payload
+
+    def _parse_frame(self)->Frame:
+        if self.current:
+            return self._parse_chunk()
+
+        buffer = self.buffer
+        pos = self.pos
+        size = self.end - pos
+        if size < 2:
+            self.wanted = 0
+            return None
+
+        b1 = buffer[pos]
+        b2 = buffer[pos + 1]
+        payload_length = b2 & _PAYLOAD_LEN
+        masked = b2 & _MASKED
+        header_length = 2
+        if payload_length == 126:
+            header_length += 2
+        elif payload_length == 127:
+            header_length += 8
+        if masked:
+            header_length += 4
+        if size < header_length:
+            self.wanted = 0
+            return None
+
+        head = pos + 2
+        if payload_length == 126:
+            payload_length = _EXT16.unpack_from(buffer, head)[0]
+            head += 2
+        elif payload_length == 127:
+            payload_length = _EXT64.unpack_from(buffer, head)[0]
+            head += 8
+
+        if self.max_frame_size is not None and payload_length > self.max_frame_size:
+            raise AsyncWebsocketProtocolError(
+                'frame size %d exceeds %d' % (payload_length, self.max_frame_size),
+                CLOSESTATUS.MESSAGE_TOO_BIG)
+
+        masks = b''
+        if size < header_length + payload_length:
+            if not self.stream or b1 & _OPCODE >= _CONTROL:
+                self.wanted = header_length + payload_length
+                return None
+            if masked:
+                masks = bytes(buffer[head:head + 4])
+            self.pos = pos + header_length
+            self.current = (bool(b1 & _FIN), b1 & _RSV, b1 & _OPCODE,
+                            bool(masked), masks)
+            self.remaining = payload_length
+            self.offset = 0
+            return self._parse_chunk()
+
+        if masked:
+            masks = bytes(buffer[head:head + 4])
+            head += 4
+        end = head + payload_length
+        payload = self._payload(head, end, masks)
+        self.pos = end
+
+        return Frame(bool(b1 & _FIN), b1 & _RSV, b1 & _OPCODE,
+                     bool(masked), payload)
+
+    def _parse_chunk(self)->Frame:
+        '''
+        next part of the streaming frame payload
+        '''
+        size = min(self.end - self.pos, self.remaining)
+        if size == 0 and self.remaining:
+            return None
+
+        fin, rsv, opcode, masked, masks = self.current
+        end = self.pos + size
+        if masked:
+            # rotate the key to the chunk offset
+            o = self.offset % 4
+            masks = masks[o:] + masks[:o]
+        payload = self._payload(self.pos, end, masks)
+        self.pos = end
+        self.remaining -= size
+        self.offset += size
+
+        partial = self.remaining > 0
+        if not partial:
+            self.current = None
+        return Frame(fin, rsv, opcode, masked, payload, partial)
+
+
+class BufferedFrameParser(FrameParser):
+    '''
+    zero copy. the socket is read into the parser buffer by
+    get_buffer/buffer_updated (asyncio.BufferedProtocol), payloads are
+    unmasked in place and returned as memoryview of the buffer.
+
+    release the payload before the next get_buffer or feed.
+    the buffer of read_size is kept for the next read, larger buffers are
+    dropped when consumed.
+    '''
+    __slots__ = ('read_size', 'mask_inplace')
+
+    def __init__(self, read_size: int = 64 * 1024)->None:
+        super().__init__()
+        self.read_size = read_size
+        self.mask_inplace = mask_inplace
+
+    def get_buffer(self, sizehint: int = -1)->memoryview:
+        '''
+        free space after the unconsumed input
+        '''
+        self._reserve(max(self.frame_rest(), sizehint, self.read_size // 2))
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes: int)->Iterator[Frame]:
+        self.end += nbytes
+        return self._frames()
+
+    def feed(self, data: bytes)->Iterator[Frame]:
+        size = len(data)
+        self._reserve(max(size, self.frame_rest()))
+        self.buffer[self.end:self.end + size] = data
+        self.end += size
+        return self._frames()
+
+    def frame_rest(self)->int:
+        '''
+        a frame with known size gets the whole space at once up to max_frame_size.
+        otherwise the buffer grows by doubling
+        '''
+        if self.max_frame_size is None:
+            return 0
+        return self.wanted - (self.end - self.pos)
+
+    def _reserve(self, size: int)->None:
+        buffer = self.buffer
+        if len(buffer) - self.end >= size:
+            return
+        rest = self.end - self.pos
+        if rest + size <= len(buffer):
+            # move the incomplete frame to the head. no resize
+            with memoryview(buffer) as view:
+                view[:rest] = view[self.pos:self.end]
+        else:
+            capacity = max(self.read_size, rest + size, len(buffer) * 2 if rest else 0)
+            new_buffer = bytearray(capacity)
+            new_buffer[:rest] = buffer[self.pos:self.end]
+            self.buffer = new_buffer
+        self.pos = 0
+        self.end = rest
+
+    def _compact(self)->None:
+        # payload views may be alive. never resize the buffer
+        if self.pos >= self.end:
+            self.pos = 0
+            self.end = 0
+            if len(self.buffer) > self.read_size:
+                self.buffer = EMPTY_BUFFER
+
+    def _payload(self, start: int, end: int, masks: bytes)->memoryview:
+        payload = memoryview(self.buffer)[start:end]
+        if masks:
+            self.mask_inplace(masks, payload)
+        return payload
@@ -2,17 +2,27 @@ from logging import getLogger
 logger = getLogger(__name__)
 
 import asyncio
-import struct
+import inspect
 from abc import ABCMeta, abstractmethod
-from typing import List
+from collections import deque
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Deque, Iterator, List, Optional, Tuple, Union
 
-from .exception import AsyncWebsocketError
+from .exception import AsyncWebsocketError, AsyncWebsocketProtocolError
 from .connection import AsyncWebsocketConnection
-from .constants import OPCODE, CONSTANTS
-from .masking import mask
+from .constants import OPCODE, CONSTANTS, CLOSESTATUS
+from .frame import Frame, FrameParser, BufferedFrameParser
+from .masking import mask, mask_inplace
+from .metrics import MetricsHooks, STAGE_PARSE, STAGE_UNMASK, STAGE_DECODE, STAGE_CALLBACK
+from .stream import MessageStream
 
 
 class AsyncWebsocketCallbackBase(metaclass=ABCMeta):
+    '''
+    callbacks may be async def.
+    coroutines of a connection are awaited one by one in the received order.
+    see AsyncWebsocketConnection max_inflight and callback_semaphore
+    '''
     @abstractmethod
     def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
         pass
@@ -37,12 +47,73 @@ class AsyncWebsocketCallbackBase(metaclass=ABCMeta):
     def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
         pass
 
+    def on_message_chunk_received(self, ws: AsyncWebsocketConnection, opcode: OPCODE,
+                                  chunk: bytes, first: bool, last: bool)->None:
+        '''
+        called instead of on_bytes/text_message_received if ws.streaming.
+        text chunks are not decoded, utf-8 sequence may be split.
+
+        default creates MessageStream and calls on_stream_received
+        '''
+        if first:
+            ws.message_stream = MessageStream(ws, opcode)
+            self.on_stream_received(ws, ws.message_stream)
+        ws.message_stream.put(chunk, last)
+        if last:
+            ws.message_stream = None
+
+    def on_messages_received(self, ws: AsyncWebsocketConnection,
+                             batch: List[Union[bytes, str]])->None:
+        '''
+        called instead of on_bytes/text_message_received if ws.batch_size.
+        batch has the data messages in the received order, str for text and bytes for binary.
+        ping and pong are delivered after the messages before them.
+
+        default calls on_bytes/text_message_received for each
+        '''
+        for msg in batch:
+            if isinstance(msg, str):
+                self.on_text_message_received(ws, msg)
+            else:
+                self.on_bytes_message_received(ws, msg)
+
+    def on_connect_failed(self, error: Exception)->None:
+        '''
+        ClientManager gave up the session. error is AsyncWebsocketHandshakeError
+        if the server rejected the handshake
+        '''
+        pass
+
+    def on_stream_received(self, ws: AsyncWebsocketConnection, stream: MessageStream)->None:
+        '''
+        a streaming message started. iterate stream in a task.
+
+        async def consume(stream):
+            async for chunk in stream:
+                ...
+        asyncio.ensure_future(consume(stream))
+        '''
+        pass
+
+
+def abort_message_stream(ws: AsyncWebsocketConnection)->None:
+    if ws.message_stream:
+        ws.message_stream.abort()
+        ws.message_stream = None
+
 
 class AsyncWebsocketHandler:
+    __slots__ = (
+        'loop', 'callbacks', 'reader', 'client', 'keep_alive', 'valid_client',
+        'read_size', 'parser', 'zero_copy', 'continuation', 'continuation_opcode',
+        'continuation_compressed', 'in_frame', 'message_size', 'decompressed_size',
+        'message_streaming', 'message_first',
+        'dispatch_queue', 'dispatch_task', 'dispatch_paused', 'batch', 'batch_handle',
+        'turn_pending', 'turn_messages')
 
     def __init__(self, loop: asyncio.AbstractEventLoop,
                  callbacks: AsyncWebsocketCallbackBase,
-                 reader: asyncio.streams.StreamReader,
+                 reader: Optional[asyncio.streams.StreamReader],
                  client: AsyncWebsocketConnection)->None:
         self.loop = loop
         self.callbacks = callbacks
@@ -52,7 +123,33 @@ class AsyncWebsocketHandler:
         self.keep_alive = True
         self.valid_client = True
 
-        self.continuation: List[bytes] = []
+        self.read_size = 1024 * 1024
+        # a coroutine would get the view after it is released
+        self.zero_copy = client.zero_copy and not inspect.iscoroutinefunction(
+            callbacks.on_bytes_message_received)
+        self.parser = BufferedFrameParser() if self.zero_copy else FrameParser()
+        # fragments of the receiving message. None while idle.
+        # bytearray with zero_copy
+        self.continuation: Optional[List[bytes]] = None
+        self.continuation_opcode: Optional[int] = None
+        self.continuation_compressed = False
+        # receiving message
+        self.in_frame = False
+        self.message_size = 0
+        self.decompressed_size = 0
+        self.message_streaming = False
+        self.message_first = True
+        # callbacks waiting for a coroutine callback
+        self.dispatch_queue: Optional[Deque[Tuple[Callable, Tuple[Any, ...]]]] = None
+        self.dispatch_task: Optional[asyncio.Future] = None
+        self.dispatch_paused = False
+        # data messages for on_messages_received
+        self.batch: Optional[List[Union[bytes, str]]] = None
+        self.batch_handle: Optional[asyncio.TimerHandle] = None
+        # frames left by max_frames/bytes_per_turn
+        self.turn_pending = False
+        # data messages of the read for rate_limiter
+        self.turn_messages = 0
 
     def __str__(self)->str:
         if self.client:
@@ -62,94 +159,477 @@ class AsyncWebsocketHandler:
 
     async def handle(self)->None:
         try:
-            self.callbacks.on_client_connected(self.client)
+            self.on_open()
             while self.keep_alive:
                 await self.read_next_message()
+        except AsyncWebsocketProtocolError as ex:
+            logger.error(str(ex))
+            self.client.send_close(ex.status)
         except AsyncWebsocketError as ex:
             logger.error(str(ex))
         except Exception as ex:
             logger.error(str(ex))
 
         #logger.warning('end')
-        self.callbacks.on_client_left(self.client)
+        self.on_close()
+
+    def on_open(self)->None:
+        if self.client.metrics:
+            self.client.metrics.on_connected(self.client)
+        if self.client.heartbeat:
+            self.client.heartbeat.add(self.client)
+        if self.client.rate_limiter:
+            self.client.rate_limiter.add(self.client)
+        if self.client.recorder:
+            self.client.recorder.add(self.client)
+        self.invoke(self.callbacks.on_client_connected)
+
+    def on_close(self)->None:
+        if self.batch:
+            self.flush_batch()
+        if self.client.metrics:
+            self.client.metrics.on_disconnected(self.client)
+        if self.client.heartbeat:
+            self.client.heartbeat.remove(self.client)
+        if self.client.rate_limiter:
+            self.client.rate_limiter.remove(self.client)
+        # after the chunks that may be queued
+        self.invoke(abort_message_stream)
+        self.invoke(self.callbacks.on_client_left)
+        self.client.flush()
+        if self.client.recorder:
+            self.client.recorder.remove(self.client)
+
+    def invoke(self, callback: Callable, *args: Any)->None:
+        '''
+        call a callback with client and args.
+        while a coroutine callback is running, later callbacks are queued to keep the order.
+        '''
+        if self.dispatch_task:
+            if self.dispatch_queue is None:
+                self.dispatch_queue = deque()
+            self.dispatch_queue.append((callback, args))
+            if len(self.dispatch_queue) >= self.client.max_inflight and not self.dispatch_paused:
+                # callbacks fall behind. stop reading the socket
+                self.dispatch_paused = True
+                self.client.pause_reading()
+            return
+        result = callback(self.client, *args)
+        if result is not None and inspect.isawaitable(result):
+            self.dispatch_task = asyncio.ensure_future(self._dispatch_async(result))
+
+    async def _dispatch_async(self, awaitable: Optional[Awaitable])->None:
+        try:
+            while True:
+                if awaitable is not None:
+                    semaphore = self.client.callback_semaphore
+                    if semaphore:
+                        async with semaphore:
+                            await awaitable
+                    else:
+                        await awaitable
+                if not self.dispatch_queue:
+                    break
+                callback, args = self.dispatch_queue.popleft()
+                if self.dispatch_paused and len(self.dispatch_queue) <= self.client.max_inflight // 2:
+                    self.dispatch_paused = False
+                    self.client.resume_reading()
+                awaitable = callback(self.client, *args)
+                if awaitable is not None and not inspect.isawaitable(awaitable):
+                    awaitable = None
+        except Exception as ex:
+            logger.error('%s: %s', self.client, ex)
+            self.client.transport.close()
+        finally:
+            self.dispatch_task = None
+            self.dispatch_queue = None
 
     async def read_next_message(self)->None:
         '''
-        +-+-+-+-+-------+-+-------------+-------------------------------+
-        0                   1                   2                   3
-        0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
-        +-+-+-+-+-------+-+-------------+-------------------------------+
-        |F|R|R|R| opcode|M| Payload len |    Extended payload length    |
-        |I|S|S|S|  (4)  |A|     (7)     |             (16/64)           |
-        |N|V|V|V|       |S|             |   (if payload len==126/127)   |
-        | |1|2|3|       |K|             |                               |
-        +-+-+-+-+-------+-+-------------+ - - - - - - - - - - - - - - - +
-        |     Extended payload length continued, if payload len == 127  |
-        + - - - - - - - - - - - - - - - +-------------------------------+
-        |                     Payload Data continued ...                |
-        +---------------------------------------------------------------+
-        '''
-        b1, b2 = await self.reader.read(2)
-        fin = b1 & CONSTANTS.FIN
-        opcode = OPCODE(b1 & CONSTANTS.OPCODE)
-        masked = b2 & CONSTANTS.MASKED
-        payload_length = b2 & CONSTANTS.PAYLOAD_LEN
+        read a chunk and dispatch every complete frame in it
+        '''
+        read_size = self.read_size
+        if self.zero_copy:
+            frame_rest = self.parser.frame_rest()
+            if frame_rest > self.parser.read_size:
+                # stop at the end of a large frame. the parser buffer has just the space
+                read_size = min(read_size, frame_rest)
+        data = await self.reader.read(read_size)
+        if not data:
+            logger.debug("connection closed.")
+            self.keep_alive = False
+            return
+
+        self.feed(data)
+        while self.turn_pending and self.keep_alive:
+            # let the other connections run before the rest of the read
+            await asyncio.sleep(self.turn_delay())
+            self.continue_turn()
+
+    def feed(self, data: bytes)->None:
+        '''
+        dispatch every complete frame in data
+        '''
+        self.parser.stream = self.client.streaming
+        self.parser.max_frame_size = self.client.max_message_size
+        self.run_turn(self.parser.feed(data), len(data))
+
+    def get_buffer(self, sizehint: int)->memoryview:
+        '''
+        zero_copy. asyncio.BufferedProtocol reads into the parser buffer
+        '''
+        self.parser.stream = self.client.streaming
+        self.parser.max_frame_size = self.client.max_message_size
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int)->None:
+        self.run_turn(self.parser.buffer_updated(nbytes), nbytes)
+
+    def run_turn(self, frames: Iterator[Frame], nbytes: int)->None:
+        '''
+        process the frames of a read. nbytes is 0 for the rest of a split read
+        '''
+        client = self.client
+        if nbytes and client.heartbeat:
+            client.last_read = client.heartbeat.now
+        if client.max_frames_per_turn or client.max_bytes_per_turn:
+            frames = self.limit_turn(frames)
+        if client.metrics:
+            if nbytes:
+                client.metrics.on_data_received(client, nbytes)
+            self.process_frames_with_metrics(frames, client.metrics)
+        else:
+            self.process_frames(frames)
+        if client.rate_limiter:
+            client.rate_limiter.consume(client, self.turn_messages, nbytes)
+            self.turn_messages = 0
+        if self.turn_pending and self.keep_alive and not self.reader:
+            # the stream reader loop continues by itself
+            client.pause_reading()
+            self.loop.call_later(self.turn_delay(), self.continue_turn)
+
+    def limit_turn(self, frames: Iterator[Frame])->Iterator[Frame]:
+        '''
+        stop after max_frames_per_turn frames or max_bytes_per_turn payload bytes.
+        the rest stays in the parser for continue_turn
+        '''
+        max_frames = self.client.max_frames_per_turn
+        max_bytes = self.client.max_bytes_per_turn
+        count = 0
+        size = 0
+        try:
+            for frame in frames:
+                # a zero_copy payload is released after the frame
+                size += len(frame.payload)
+                count += 1
+                yield frame
+                if (max_frames and count >= max_frames) or (max_bytes and size >= max_bytes):
+                    if len(self.parser):
+                        self.turn_pending = True
+                        self.client.read_yields += 1
+                    return
+        finally:
+            frames.close()
+
+    def turn_delay(self)->float:
+        '''
+        the rest of a read waits while rate_limiter pauses reading
+        '''
+        state = self.client.rate_state
+        if state and state.resume_handle:
+            return max(0.0, state.resume_handle.when() - self.loop.time())
+        return 0.0
+
+    def continue_turn(self)->None:
+        '''
+        process the frames left by limit_turn
+        '''
+        self.turn_pending = False
+        if self.reader:
+            self.run_turn(self.parser.parse(), 0)
+            return
+        # protocol. scheduled by run_turn, reading is paused until here
+        client = self.client
+        client.resume_reading()
+        if client.transport.is_closing():
+            return
+        try:
+            self.run_turn(self.parser.parse(), 0)
+            if not self.keep_alive:
+                client.flush()
+                client.transport.close()
+        except AsyncWebsocketProtocolError as ex:
+            logger.error(ex)
+            client.send_close(ex.status)
+            client.transport.close()
+        except Exception as ex:
+            logger.error(ex)
+            client.transport.close()
+
+    def process_frames(self, frames: Iterator[Frame])->None:
+        try:
+            for frame in frames:
+                self.process_frame(frame)
+                if not self.keep_alive:
+                    break
+        finally:
+            frames.close()
+            if self.batch and not self.client.batch_latency:
+                self.flush_batch()
+
+    def process_frames_with_metrics(self, frames: Iterator[Frame], metrics: MetricsHooks)->None:
+        '''
+        process_frames with counters and stage timing
+        '''
+        client = self.client
+        self.parser.mask = self.unmask_with_metrics
+        if isinstance(self.parser, BufferedFrameParser):
+            # zero_copy unmasks in the receive buffer
+            self.parser.mask_inplace = self.unmask_inplace_with_metrics
+        try:
+            while self.keep_alive:
+                start = perf_counter()
+                frame = next(frames, None)
+                if frame is None:
+                    break
+                metrics.on_stage(client, STAGE_PARSE, perf_counter() - start)
+                metrics.on_frame_received(client, frame.opcode, len(frame.payload))
+                self.process_frame(frame)
+        finally:
+            frames.close()
+            if self.batch and not self.client.batch_latency:
+                self.flush_batch()
+
+    def unmask_with_metrics(self, masks: bytes, payload: bytes)->bytes:
+        start = perf_counter()
+        payload = mask(masks, payload)
+        self.client.metrics.on_stage(self.client, STAGE_UNMASK, perf_counter() - start)
+        return payload
+
+    def unmask_inplace_with_metrics(self, masks: bytes, payload: memoryview)->None:
+        start = perf_counter()
+        mask_inplace(masks, payload)
+        self.client.metrics.on_stage(self.client, STAGE_UNMASK, perf_counter() - start)
+
+    def process_frame(self, frame: Frame)->None:
+        if self.client.recorder:
+            self.client.recorder.on_frame_received(self.client, frame, self.in_frame)
+        if self.in_frame:
+            # next chunk of a streaming frame
+            self.in_frame = frame.partial
+            self.process_data(frame.payload, frame.fin and not frame.partial)
+            return
+
+        opcode = frame.opcode
+        compressed = False
+        if frame.rsv:
+            # only RSV1 of the first data frame with permessage-deflate
+            if (frame.rsv != CONSTANTS.RSV1 or not self.client.deflate
+                    or opcode == OPCODE.CONTINUATION or opcode >= OPCODE.CLOSE_CONN):
+                raise AsyncWebsocketProtocolError(
+                    'unexpected rsv bits: %#x' % frame.rsv, CLOSESTATUS.PROTOCOL_ERROR)
+            compressed = True
 
         if opcode == OPCODE.CLOSE_CONN:
             logger.debug("Client asked to close connection.")
             self.keep_alive = False
             return
 
-        if payload_length == 126:
-            data2 = await self.reader.read(2)
-            payload_length = struct.unpack(">H", data2)[0]
-        elif payload_length == 127:
-            data8 = await self.reader.read(8)
-            payload_length = struct.unpack(">Q", data8)[0]
-
-        if masked:
-            masks = await self.reader.read(4)
-
-        remain_size = payload_length
-        buffer_size = 1024 * 1024
-        buffer_list = []
-        while remain_size > 0:
-            read_size = buffer_size
-            if read_size > remain_size:
-                read_size = remain_size
-            buffer = await self.reader.read(read_size)
-            buffer_list.append(buffer)
-            remain_size -= len(buffer)
-
-        payload = b''.join(buffer_list)
-        if len(payload) != payload_length:
-            logger.error('invalid size %d <=> %d',
-                         len(payload), payload_length)
-
-        if masked:
-            decoded = mask(masks, payload)
+        if opcode >= OPCODE.CLOSE_CONN:
+            # control frame. may be injected between fragments
+            if not frame.fin:
+                raise AsyncWebsocketError('control frame must not be fragmented')
+            # up to 125 bytes. no view
+            payload = bytes(frame.payload)
+            if self.batch:
+                # keep the order
+                self.flush_batch()
+            if opcode == OPCODE.PING and self.client.auto_pong:
+                self.client.send(payload, OPCODE.PONG)
+            self.dispatch(opcode, payload)
+            return
+
+        if opcode == OPCODE.CONTINUATION:
+            if self.continuation_opcode is None:
+                raise AsyncWebsocketError('unexpected OPCODE_CONTINUATION')
+        elif self.continuation_opcode is not None:
+            raise AsyncWebsocketError('opcode should OPCODE_CONTINUATION')
+        else:
+            # new message
+            self.continuation_opcode = opcode
+            self.continuation_compressed = compressed
+            self.message_size = 0
+            self.decompressed_size = 0
+            self.message_streaming = self.client.streaming
+            self.message_first = True
+
+        self.in_frame = frame.partial
+        self.process_data(frame.payload, frame.fin and not frame.partial)
+
+    def process_data(self, data: bytes, last: bool)->None:
+        '''
+        payload of a data frame. last is the end of the message.
+        '''
+        self.message_size += len(data)
+        max_message_size = self.client.max_message_size
+        if max_message_size is not None and self.message_size > max_message_size:
+            raise AsyncWebsocketProtocolError(
+                'message size exceeds %d' % max_message_size,
+                CLOSESTATUS.MESSAGE_TOO_BIG)
+
+        opcode = self.continuation_opcode
+        metrics = self.client.metrics
+        if self.message_streaming:
+            # chunks are kept by MessageStream
+            data = bytes(data)
+            start = perf_counter() if metrics else 0.0
+            if self.continuation_compressed:
+                deflate = self.client.deflate
+                data = deflate.decompress_chunk(
+                    data, last, deflate.options.max_message_size - self.decompressed_size)
+                self.decompressed_size += len(data)
+                if metrics:
+                    metrics.on_stage(self.client, STAGE_DECODE, perf_counter() - start)
+                    start = perf_counter()
+            first = self.message_first
+            self.message_first = False
+            if last:
+                self.continuation_opcode = None
+                self.turn_messages += 1
+            self.invoke(self.callbacks.on_message_chunk_received,
+                        OPCODE(opcode), data, first, last)
+            if metrics:
+                metrics.on_stage(self.client, STAGE_CALLBACK, perf_counter() - start)
+                if last:
+                    metrics.on_message_received(
+                        self.client, opcode, self.decompressed_size or self.message_size)
+            return
+
+        if last and self.continuation is None:
+            # single frame message
+            msg = data
+        elif self.zero_copy:
+            # the receive buffer is reused. collect fragments in one bytearray
+            if self.continuation is None:
+                self.continuation = bytearray()
+            self.continuation += data
+            if not last:
+                return
+            # the view keeps the bytearray. a batch copies it
+            msg = memoryview(self.continuation)
+            self.continuation = None
+        else:
+            if self.continuation is None:
+                self.continuation = []
+            self.continuation.append(data)
+            if not last:
+                return
+            msg = b''.join(self.continuation)
+            self.continuation = None
+        self.continuation_opcode = None
+
+        if self.continuation_compressed:
+            start = perf_counter() if metrics else 0.0
+            msg = self.client.deflate.decompress(msg)
+            if metrics:
+                metrics.on_stage(self.client, STAGE_DECODE, perf_counter() - start)
+        self.turn_messages += 1
+        if self.client.batch_size:
+            self.batch_message(opcode, msg)
+        elif self.zero_copy:
+            self.dispatch_view(opcode, msg)
         else:
-            decoded = payload
+            self.dispatch(opcode, msg)
 
-        self.continuation.append(decoded)
-        if not fin:
-            if opcode != OPCODE.CONTINUATION:
-                raise AsyncWebsocketError('opcode should OPCODE_CONTINUATION')
+    def batch_message(self, opcode: int, msg: bytes)->None:
+        '''
+        add a data message to the batch. flushed by batch_size, batch_latency
+        or at the end of the read
+        '''
+        if opcode == OPCODE.BINARY:
+            if not isinstance(msg, bytes):
+                # zero_copy view. the batch outlives the receive buffer
+                msg = bytes(msg)
+            item: Union[bytes, str] = msg
+        elif opcode == OPCODE.TEXT:
+            item = str(msg, 'utf-8')
+        else:
+            raise AsyncWebsocketError(
+                "Unknown opcode %#x." % opcode)
+        if self.client.metrics:
+            self.client.metrics.on_message_received(self.client, opcode, len(msg))
+        if self.batch is None:
+            self.batch = []
+            if self.client.batch_latency:
+                self.batch_handle = self.loop.call_later(
+                    self.client.batch_latency, self.flush_batch)
+        self.batch.append(item)
+        if len(self.batch) >= self.client.batch_size:
+            self.flush_batch()
+
+    def flush_batch(self)->None:
+        if self.batch_handle:
+            self.batch_handle.cancel()
+            self.batch_handle = None
+        batch = self.batch
+        self.batch = None
+        if not batch:
             return
+        metrics = self.client.metrics
+        start = perf_counter() if metrics else 0.0
+        self.invoke(self.callbacks.on_messages_received, batch)
+        if metrics:
+            metrics.on_stage(self.client, STAGE_CALLBACK, perf_counter() - start)
 
-        msg = self.continuation[0] if len(
-            self.continuation) == 1 else b''.join(self.continuation)
-        self.continuation.clear()
+    def dispatch_view(self, opcode: int, msg: memoryview)->None:
+        '''
+        zero_copy. the view is released after the callback returns
+        '''
+        try:
+            if self.dispatch_task and isinstance(msg, memoryview):
+                # queued after a coroutine callback
+                self.dispatch(opcode, bytes(msg))
+            else:
+                self.dispatch(opcode, msg)
+        finally:
+            if isinstance(msg, memoryview):
+                msg.release()
 
+    def dispatch(self, opcode: int, msg: bytes)->None:
+        if self.client.metrics:
+            self.dispatch_with_metrics(opcode, msg, self.client.metrics)
+            return
         if opcode == OPCODE.BINARY:
-            self.callbacks.on_bytes_message_received(self.client, msg)
+            self.invoke(self.callbacks.on_bytes_message_received, msg)
         elif opcode == OPCODE.TEXT:
-            self.callbacks.on_text_message_received(
-                self.client, msg.decode('utf-8'))
+            self.invoke(self.callbacks.on_text_message_received, str(msg, 'utf-8'))
         elif opcode == OPCODE.PING:
-            self.callbacks.on_ping_received(self.client, msg.decode('utf-8'))
+            self.invoke(self.callbacks.on_ping_received, str(msg, 'utf-8'))
         elif opcode == OPCODE.PONG:
-            self.callbacks.on_pong_received(self.client, msg.decode('utf-8'))
+            self.invoke(self.callbacks.on_pong_received, str(msg, 'utf-8'))
         else:
             raise AsyncWebsocketError(
-                "Unknown opcode %#x." % opcode.value)
+                "Unknown opcode %#x." % opcode)
+
+    def dispatch_with_metrics(self, opcode: int, msg: bytes, metrics: MetricsHooks)->None:
+        client = self.client
+        if opcode not in (OPCODE.BINARY, OPCODE.TEXT, OPCODE.PING, OPCODE.PONG):
+            raise AsyncWebsocketError(
+                "Unknown opcode %#x." % opcode)
+        metrics.on_message_received(client, opcode, len(msg))
+        start = perf_counter()
+        if opcode != OPCODE.BINARY:
+            text = str(msg, 'utf-8')
+            now = perf_counter()
+            metrics.on_stage(client, STAGE_DECODE, now - start)
+            start = now
+
+        if opcode == OPCODE.BINARY:
+            self.invoke(self.callbacks.on_bytes_message_received, msg)
+        elif opcode == OPCODE.TEXT:
+            self.invoke(self.callbacks.on_text_message_received, text)
+        elif opcode == OPCODE.PING:
+            self.invoke(self.callbacks.on_ping_received, text)
+        else:
+            self.invoke(self.callbacks.on_pong_received, text)
+        metrics.on_stage(client, STAGE_CALLBACK, perf_counter() - start)
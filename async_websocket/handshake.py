@@ -5,9 +5,10 @@ import os
 from base64 import b64encode
 from hashlib import sha1
 from binascii import b2a_base64
+from typing import Optional
 
 
-def make_handshake_response(key: bytes)->bytes:
+def make_handshake_response(key: bytes, extensions: Optional[bytes] = None)->bytes:
     '''
     Server
     '''
@@ -15,12 +16,16 @@ def make_handshake_response(key: bytes)->bytes:
     hash_value = sha1(key + GUID.encode())
     response_key = b64encode(hash_value.digest()).strip()
 
-    return \
-        b'HTTP/1.1 101 Switching Protocols\r\n'\
-        b'Upgrade: websocket\r\n'              \
-        b'Connection: Upgrade\r\n'             \
-        b'Sec-WebSocket-Accept: %b\r\n'        \
-        b'\r\n' % response_key
+    headers = [
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Upgrade: websocket\r\n'
+        b'Connection: Upgrade\r\n'
+        b'Sec-WebSocket-Accept: %b\r\n' % response_key,
+    ]
+    if extensions:
+        headers.append(b'Sec-WebSocket-Extensions: %b\r\n' % extensions)
+    headers.append(b'\r\n')
+    return b''.join(headers)
 
 
 def _create_sec_websocket_key()->bytes:
@@ -41,7 +46,8 @@ def _create_sec_websocket_key()->bytes:
     return b"".join(pieces)
 
 
-def make_handshake_request(hostport_bytes: bytes, path_bytes: bytes)->bytes:
+def make_handshake_request(hostport_bytes: bytes, path_bytes: bytes,
+                           extensions: Optional[bytes] = None)->bytes:
     '''
     Client
     '''
@@ -54,7 +60,9 @@ def make_handshake_request(hostport_bytes: bytes, path_bytes: bytes)->bytes:
         b"Connection: Upgrade\r\n"
         b"Host: %s\r\n" % hostport_bytes,
         b"Sec-WebSocket-Key: %b\r\n" % key_bytes,
-        b"Sec-WebSocket-Version: 13\r\n"
-        b"\r\n",
+        b"Sec-WebSocket-Version: 13\r\n",
     ]
+    if extensions:
+        headers.append(b"Sec-WebSocket-Extensions: %b\r\n" % extensions)
+    headers.append(b"\r\n")
     return b"".join(headers)
@@ -0,0 +1,187 @@
+'''
+ping, pong timeout and idle timeouts.
+
+one Heartbeat is shared by many connections. connections are kept in a hashed
+timer wheel that a single task advances every tick, so an idle connection costs
+no call_later handle and is visited only when its deadline comes around.
+
+heartbeat = Heartbeat(loop, ping_interval=20.0, pong_timeout=10.0)
+AsyncWebsocketServer(loop, callbacks, http_service, heartbeat=heartbeat)
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+import math
+from typing import Any, Dict, List, Optional, Set
+
+from .constants import OPCODE, CLOSESTATUS
+
+
+class TimerWheel:
+    '''
+    hashed timer wheel. an entry has one deadline, scheduling again moves it.
+    '''
+
+    def __init__(self, tick: float, size: int = 512)->None:
+        self.tick = tick
+        self.slots: List[Set[Any]] = [set() for _ in range(size)]
+        self.deadlines: Dict[Any, int] = {}
+        # ticks processed
+        self.current = 0
+
+    def __len__(self)->int:
+        return len(self.deadlines)
+
+    def schedule(self, entry: Any, delay: float)->None:
+        deadline = self.current + max(1, math.ceil(delay / self.tick))
+        old = self.deadlines.get(entry)
+        if old is not None:
+            self.slots[old % len(self.slots)].discard(entry)
+        self.deadlines[entry] = deadline
+        self.slots[deadline % len(self.slots)].add(entry)
+
+    def cancel(self, entry: Any)->None:
+        deadline = self.deadlines.pop(entry, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(entry)
+
+    def advance(self, ticks: int)->List[Any]:
+        '''
+        return expired entries
+        '''
+        expired = []
+        for _ in range(min(ticks, len(self.slots))):
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            for entry in [x for x in slot if self.deadlines[x] <= self.current]:
+                slot.discard(entry)
+                del self.deadlines[entry]
+                expired.append(entry)
+        if ticks > len(self.slots):
+            # the loop was blocked for a whole round. everything is due
+            self.current += ticks - len(self.slots)
+            for slot in self.slots:
+                for entry in [x for x in slot if self.deadlines[x] <= self.current]:
+                    slot.discard(entry)
+                    del self.deadlines[entry]
+                    expired.append(entry)
+        return expired
+
+
+class Heartbeat:
+    '''
+    ping_interval: send ping after this idle time. None disables ping
+    pong_timeout: abort if nothing is received after the ping
+    read_timeout: close if nothing is received
+    write_timeout: abort if the write buffer does not shrink
+
+    any received data counts as a pong.
+    times are rounded up to tick.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 ping_interval: Optional[float] = 20.0,
+                 pong_timeout: float = 10.0,
+                 read_timeout: Optional[float] = None,
+                 write_timeout: Optional[float] = None,
+                 tick: float = 1.0, wheel_size: int = 512)->None:
+        self.loop = loop
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.wheel = TimerWheel(tick, wheel_size)
+        self.origin = loop.time()
+        # coarse clock. updated every tick
+        self.now = self.origin
+        self.task: Optional[asyncio.Future] = None
+
+    def add(self, ws: 'AsyncWebsocketConnection')->None:
+        # the clock is not updated while the task is stopped
+        self.now = self.loop.time()
+        if not self.task and not self.wheel:
+            self.wheel.current = int((self.now - self.origin) / self.wheel.tick)
+        ws.last_read = self.now
+        ws.ping_sent = None
+        ws.write_buffered = 0
+        ws.write_stalled_since = None
+        self.wheel.schedule(ws, self.next_delay(ws))
+        if not self.task:
+            self.task = asyncio.ensure_future(self._run_async())
+
+    def remove(self, ws: 'AsyncWebsocketConnection')->None:
+        self.wheel.cancel(ws)
+
+    def stop(self)->None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run_async(self)->None:
+        try:
+            while self.wheel:
+                await asyncio.sleep(self.wheel.tick)
+                self.now = self.loop.time()
+                ticks = int((self.now - self.origin) / self.wheel.tick) - self.wheel.current
+                for ws in self.wheel.advance(ticks):
+                    try:
+                        self.check(ws)
+                    except Exception as ex:
+                        logger.error('%s: %s', ws, ex)
+        finally:
+            self.task = None
+
+    def check(self, ws: 'AsyncWebsocketConnection')->None:
+        if ws.transport.is_closing():
+            return
+        now = self.now
+
+        if ws.ping_sent is not None:
+            if ws.last_read >= ws.ping_sent:
+                ws.ping_sent = None
+            elif now - ws.ping_sent >= self.pong_timeout:
+                logger.warning('%s: pong timeout', ws)
+                ws.transport.abort()
+                return
+
+        if self.read_timeout is not None and now - ws.last_read >= self.read_timeout:
+            logger.info('%s: read timeout', ws)
+            ws.send_close(CLOSESTATUS.GOING_AWAY)
+            ws.transport.close()
+            return
+
+        if self.write_timeout is not None:
+            buffered = ws.buffered_bytes
+            if not buffered or buffered < ws.write_buffered:
+                ws.write_stalled_since = None
+            elif ws.write_stalled_since is None:
+                ws.write_stalled_since = now
+            elif now - ws.write_stalled_since >= self.write_timeout:
+                logger.warning('%s: write timeout', ws)
+                ws.transport.abort()
+                return
+            ws.write_buffered = buffered
+
+        if (self.ping_interval is not None and ws.ping_sent is None
+                and now - ws.last_read >= self.ping_interval):
+            ws.ping_sent = now
+            ws.send(b'', OPCODE.PING)
+
+        self.wheel.schedule(ws, self.next_delay(ws))
+
+    def next_delay(self, ws: 'AsyncWebsocketConnection')->float:
+        idle = self.now - ws.last_read
+        delays = []
+        if ws.ping_sent is not None:
+            delays.append(self.pong_timeout - (self.now - ws.ping_sent))
+        elif self.ping_interval is not None:
+            delays.append(self.ping_interval - idle)
+        if self.read_timeout is not None:
+            delays.append(self.read_timeout - idle)
+        if self.write_timeout is not None and ws.write_buffered:
+            delays.append(self.write_timeout / 2)
+        if not delays:
+            # nothing to do. look again later
+            return self.wheel.tick * len(self.wheel.slots)
+        return min(delays)
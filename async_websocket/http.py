@@ -1,5 +1,20 @@
-from typing import Dict, List, NamedTuple, Generator, Any
+from typing import Awaitable, Dict, List, NamedTuple, Generator, Any, Hashable, Iterable, Optional, Tuple, Union
+import asyncio
+import gzip
+import mimetypes
+import os
 import pathlib
+from collections import OrderedDict
+from concurrent.futures import Executor
+from email.utils import formatdate, parsedate_to_datetime
+from stat import S_ISREG
+from urllib.parse import unquote_to_bytes
+from .exception import AsyncWebsocketError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 class HttpHeader(NamedTuple):
@@ -7,20 +22,159 @@ class HttpHeader(NamedTuple):
     value: bytes
 
 
-class HttpRequest:
-    def __init__(self, line: bytes)->None:
-        self.method, self.path, self.version = line.split()
+MAX_LINE_LENGTH = 8190
+MAX_HEADER_COUNT = 100
+KEEP_ALIVE_HEADER = b'Connection: keep-alive\r\n'
+CLOSE_HEADER = b'Connection: close\r\n'
+
+
+class HttpMessage:
+    def __init__(self)->None:
         self.headers: List[HttpHeader] = []
+        # lower case key => first value
+        self.header_map: Dict[bytes, bytes] = {}
 
     def push_line(self, line: bytes)->None:
+        if len(line) > MAX_LINE_LENGTH:
+            raise AsyncWebsocketError('too long header line')
+        if len(self.headers) >= MAX_HEADER_COUNT:
+            raise AsyncWebsocketError('too many headers')
         kv = line.split(b':', 1)
-        self.headers.append(HttpHeader(kv[0].strip().lower(), kv[1].strip()))
+        if len(kv) != 2:
+            raise AsyncWebsocketError('invalid header line: %s' % line)
+        header = HttpHeader(kv[0].strip().lower(), kv[1].strip())
+        self.headers.append(header)
+        self.header_map.setdefault(header.key, header.value)
 
     def get_header(self, key: bytes)->bytes:
-        for x in self.headers:
-            if x.key == key:
-                return x.value
-        return None
+        return self.header_map.get(key)
+
+
+class HttpRequest(HttpMessage):
+    def __init__(self, line: bytes)->None:
+        super().__init__()
+        if len(line) > MAX_LINE_LENGTH:
+            raise AsyncWebsocketError('too long request line')
+        splited = line.split()
+        if len(splited) != 3:
+            raise AsyncWebsocketError('invalid request line: %s' % line)
+        self.method, self.path, self.version = splited
+
+    def is_keep_alive(self)->bool:
+        '''
+        HTTP/1.1 is persistent unless Connection: close
+        '''
+        connection = [x.strip().lower() for x in (
+            self.get_header(b'connection') or b'').split(b',')]
+        if self.version == b'HTTP/1.1':
+            return b'close' not in connection
+        return b'keep-alive' in connection
+
+    def get_body_length(self)->int:
+        '''
+        Content-Length. chunked and conflicting lengths are rejected,
+        the next request on the connection could not be found
+        '''
+        if self.get_header(b'transfer-encoding') is not None:
+            raise AsyncWebsocketError('transfer-encoding is not supported')
+        values = set(x.value for x in self.headers if x.key == b'content-length')
+        if not values:
+            return 0
+        if len(values) != 1:
+            raise AsyncWebsocketError('conflicting content-length')
+        value = values.pop()
+        if not value.isdigit():
+            raise AsyncWebsocketError('invalid content-length: %s' % value)
+        return int(value)
+
+
+class HttpResponse(HttpMessage):
+    def __init__(self, line: bytes)->None:
+        super().__init__()
+        splited = line.split(b' ', 2)
+        if len(splited) != 3:
+            raise AsyncWebsocketError('not http ? %s' % line)
+        self.version, status_code, self.reason = splited
+        self.status_code = int(status_code)
+
+
+def parse_request(data: bytes)->HttpRequest:
+    '''
+    data is request line and header lines without the last empty line
+    '''
+    lines = data.split(b'\r\n')
+    request = HttpRequest(lines[0])
+    for line in lines[1:]:
+        if line:
+            request.push_line(line)
+    return request
+
+
+def parse_response(data: bytes)->HttpResponse:
+    '''
+    data is status line and header lines without the last empty line
+    '''
+    lines = data.split(b'\r\n')
+    response = HttpResponse(lines[0])
+    for line in lines[1:]:
+        if line:
+            response.push_line(line)
+    return response
+
+
+def find_header(headers: List[HttpHeader], key: bytes)->Optional[bytes]:
+    for x in headers:
+        if x.key == key:
+            return x.value
+    return None
+
+
+class SendFile(NamedTuple):
+    '''
+    http service yields this to send a part of a file with loop.sendfile
+    '''
+    path: pathlib.Path
+    offset: int
+    count: int
+
+
+class DeferredResponse(NamedTuple):
+    '''
+    http service yields this when the rest of the response needs to await.
+    the awaitable returns the rest of the chunks
+    '''
+    rest: Awaitable[Iterable[Union[bytes, SendFile]]]
+
+
+HTTP_CHUNK_TYPE = Union[bytes, SendFile, DeferredResponse]
+
+
+async def write_http_response_async(loop: asyncio.AbstractEventLoop,
+                                    transport: asyncio.WriteTransport,
+                                    response: Iterable[HTTP_CHUNK_TYPE],
+                                    extra_headers: bytes = b'')->None:
+    '''
+    the first chunk of response is the status line. extra_headers follow it.
+    '''
+    first = True
+    for x in response:
+        if isinstance(x, DeferredResponse):
+            rest = await x.rest
+            await write_http_response_async(
+                loop, transport, rest, extra_headers if first else b'')
+            first = False
+            continue
+        if first:
+            first = False
+            if extra_headers:
+                transport.write(x)
+                transport.write(extra_headers)
+                continue
+        if isinstance(x, SendFile):
+            with open(x.path, 'rb') as f:
+                await loop.sendfile(transport, f, x.offset, x.count)
+        else:
+            transport.write(x)
 
 
 def bytes_http_response(data: bytes)->Generator[bytes, None, None]:
@@ -40,6 +194,7 @@ def not_found_response()->Generator[bytes, None, None]:
 
 def internal_error_response()->Generator[bytes, None, None]:
     yield b"HTTP/1.1 500 ERROR\r\n"
+    yield b"Content-Length: 0\r\n"
     yield b"\r\n"
 
 
@@ -58,7 +213,7 @@ class HttpService:
             raise Exception('mount path must startswith "/" and endswith "/": %s' % path)
 
     def __call__(self, method: bytes,
-                 path: bytes, headers: List[HttpHeader])->Generator[bytes, None, None]:
+                 path: bytes, headers: List[HttpHeader])->Generator[HTTP_CHUNK_TYPE, None, None]:
         for k, v in self.mount_map.items():
             if path_match_mount(path, k):
                 relative_path = path[len(k):]
@@ -68,29 +223,343 @@ class HttpService:
         yield from internal_error_response()
 
 
+class FileCache:
+    '''
+    LRU of small file contents with a byte budget.
+    key is path, entry is valid while mtime and size are same.
+    size is of the file, data may be compressed.
+    '''
+
+    def __init__(self, max_bytes: int)->None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: 'OrderedDict[Hashable, Tuple[int, int, bytes]]' = OrderedDict()
+
+    def get(self, path: Hashable, mtime_ns: int, size: int)->Optional[bytes]:
+        entry = self.entries.get(path)
+        if not entry:
+            return None
+        if entry[0] != mtime_ns or entry[1] != size:
+            self.remove(path)
+            return None
+        self.entries.move_to_end(path)
+        return entry[2]
+
+    def put(self, path: Hashable, mtime_ns: int, data: bytes, size: Optional[int] = None)->None:
+        if len(data) > self.max_bytes:
+            return
+        self.remove(path)
+        self.entries[path] = (mtime_ns, len(data) if size is None else size, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def remove(self, path: Hashable)->None:
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.size -= len(entry[2])
+
+
+def parse_range(value: bytes, size: int)->Optional[Tuple[int, int]]:
+    '''
+    Range: bytes=0-99, bytes=100-, bytes=-100
+    return (start, end) inclusive. (0, -1) if not satisfiable. None if ignored.
+    '''
+    if not value.startswith(b'bytes=') or b',' in value:
+        # multiple ranges are not supported. send all
+        return None
+    start, sep, end = value[6:].strip().partition(b'-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0:
+                return (0, -1)
+            return (max(size - suffix, 0), size - 1)
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        return (0, -1)
+    return (first, min(last, size - 1))
+
+
+# content coding => suffix of the prebuilt sibling. server preference order
+ENCODINGS: Dict[bytes, str] = {b'br': '.br', b'gzip': '.gz'}
+GZIP_LEVEL = 9
+# 11 is several times slower
+BROTLI_QUALITY = 9
+COMPRESSIBLE_TYPES = (b'text/', b'application/javascript', b'application/json',
+                      b'application/xml', b'application/wasm', b'image/svg+xml')
+
+
+def parse_accept_encoding(value: Optional[bytes])->Dict[bytes, float]:
+    '''
+    Accept-Encoding: gzip, br;q=0.8, *;q=0
+    return coding => q
+    '''
+    result: Dict[bytes, float] = {}
+    for item in (value or b'').split(b','):
+        coding, _, params = item.partition(b';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        if coding == b'x-gzip':
+            coding = b'gzip'
+        q = 1.0
+        for param in params.split(b';'):
+            key, _, q_value = param.partition(b'=')
+            if key.strip().lower() == b'q':
+                try:
+                    q = float(q_value)
+                except ValueError:
+                    q = 0.0
+        result[coding] = q
+    return result
+
+
+def negotiate_encodings(value: Optional[bytes])->List[bytes]:
+    '''
+    acceptable codings of ENCODINGS. higher q first, then server preference
+    '''
+    accepted = parse_accept_encoding(value)
+    star = accepted.get(b'*', 0.0)
+    ranked = []
+    for i, coding in enumerate(ENCODINGS):
+        q = accepted.get(coding, star)
+        if q > 0:
+            ranked.append((-q, i, coding))
+    return [coding for _, _, coding in sorted(ranked)]
+
+
+def compress(data: bytes, encoding: bytes)->bytes:
+    if encoding == b'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def read_compressed(path: pathlib.Path, encoding: bytes)->Tuple[int, bytes]:
+    '''
+    runs in the executor. return the file size and the compressed data
+    '''
+    data = path.read_bytes()
+    return len(data), compress(data, encoding)
+
+
 class FileSystemMount:
-    def __init__(self, base_path: pathlib.Path)->None:
+    '''
+    small files are served from a LRU cache, larger files with loop.sendfile.
+
+    with compress, Accept-Encoding picks a prebuilt .br or .gz sibling that is
+    not older than the file. otherwise text like files are compressed in the
+    executor on the first request and kept in compressed_cache. br needs the
+    brotli module, prebuilt .br does not. Range requests get the file as is.
+    '''
+
+    def __init__(self, base_path: pathlib.Path,
+                 cache_max_bytes: int = 32 * 1024 * 1024,
+                 cache_max_file_size: int = 256 * 1024,
+                 compress: bool = True,
+                 compress_min_size: int = 1024,
+                 compress_max_file_size: int = 16 * 1024 * 1024,
+                 compress_cache_max_bytes: int = 32 * 1024 * 1024,
+                 executor: Optional[Executor] = None)->None:
         self.base_path = base_path
+        self.cache = FileCache(cache_max_bytes)
+        self.cache_max_file_size = cache_max_file_size
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.compress_max_file_size = compress_max_file_size
+        # (path, encoding) => compressed
+        self.compressed_cache = FileCache(compress_cache_max_bytes)
+        # None is the loop default executor
+        self.executor = executor
+        # (path, encoding, mtime_ns) => running compression. shared by concurrent requests
+        self.compressing: Dict[Tuple[pathlib.Path, bytes, int], asyncio.Future] = {}
 
-    def __call__(self, method: bytes, relative: bytes, headers)->Generator[bytes, None, None]:
-        if method != b'GET':
+    def __call__(self, method: bytes, relative: bytes, headers)->Generator[HTTP_CHUNK_TYPE, None, None]:
+        if method != b'GET' and method != b'HEAD':
             yield from internal_error_response()
             return
 
+        relative = unquote_to_bytes(relative.split(b'?', 1)[0])
         if relative == b'':
             relative = b'index.html'
         elif relative.endswith(b'/'):
             relative = relative + b'index.html'
 
-        path = self.base_path / relative.decode()
-        if not path.is_file():
+        try:
+            parts = pathlib.PurePosixPath(relative.decode()).parts
+        except UnicodeDecodeError:
+            parts = ('..',)
+        if not parts or parts[0] == '/' or '..' in parts:
             yield from not_found_response()
             return
+        path = self.base_path.joinpath(*parts)
 
         try:
-            yield from bytes_http_response(path.read_bytes())
+            stat = path.stat()
+        except OSError:
+            yield from not_found_response()
             return
-
-        except Exception:
+        if not S_ISREG(stat.st_mode):
             yield from not_found_response()
             return
+
+        size = stat.st_size
+        etag = b'"%x-%x"' % (stat.st_mtime_ns, size)
+        last_modified = formatdate(stat.st_mtime, usegmt=True).encode('ascii')
+        content_type = (mimetypes.guess_type(path.name)[0]
+                        or 'application/octet-stream').encode('ascii')
+
+        encoding = None
+        variant = None
+        compressible = (self.compress
+                        and self.compress_min_size <= size <= self.compress_max_file_size
+                        and content_type.startswith(COMPRESSIBLE_TYPES))
+        if self.compress and not find_header(headers, b'range'):
+            for coding in negotiate_encodings(find_header(headers, b'accept-encoding')):
+                variant = self.find_variant(path, stat, coding)
+                if variant or (compressible and (coding != b'br' or brotli)):
+                    encoding = coding
+                    break
+        vary = compressible or encoding is not None
+        if encoding:
+            etag = etag[:-1] + b'-' + encoding + b'"'
+
+        if self.is_not_modified(headers, etag, int(stat.st_mtime)):
+            yield b'HTTP/1.1 304 Not Modified\r\n'
+            yield b'ETag: %b\r\n' % etag
+            yield b'Last-Modified: %b\r\n' % last_modified
+            if vary:
+                yield b'Vary: Accept-Encoding\r\n'
+            yield b'\r\n'
+            return
+
+        if encoding:
+            if variant:
+                variant_path, variant_stat = variant
+                yield from self.encoded_headers(
+                    variant_stat.st_size, content_type, etag, last_modified, encoding)
+                if method != b'HEAD' and variant_stat.st_size:
+                    yield from self.file_body(variant_path, variant_stat, 0, variant_stat.st_size)
+                return
+            data = self.compressed_cache.get((path, encoding), stat.st_mtime_ns, size)
+            if data is None:
+                yield DeferredResponse(self.compress_async(
+                    method, path, stat, encoding, content_type, etag, last_modified))
+                return
+            yield from self.encoded_headers(len(data), content_type, etag, last_modified, encoding)
+            if method != b'HEAD':
+                yield data
+            return
+
+        start, end = 0, size - 1
+        status = b'200 OK'
+        range_value = find_header(headers, b'range')
+        if_range = find_header(headers, b'if-range')
+        if range_value and (not if_range or if_range == etag):
+            byte_range = parse_range(range_value, size)
+            if byte_range == (0, -1):
+                yield b'HTTP/1.1 416 Range Not Satisfiable\r\n'
+                yield b'Content-Range: bytes */%d\r\n' % size
+                yield b'Content-Length: 0\r\n'
+                yield b'\r\n'
+                return
+            if byte_range:
+                start, end = byte_range
+                status = b'206 Partial Content'
+        length = end - start + 1
+
+        yield b'HTTP/1.1 %b\r\n' % status
+        yield b'Content-Type: %b\r\n' % content_type
+        yield b'Content-Length: %d\r\n' % length
+        yield b'ETag: %b\r\n' % etag
+        yield b'Last-Modified: %b\r\n' % last_modified
+        yield b'Accept-Ranges: bytes\r\n'
+        if vary:
+            yield b'Vary: Accept-Encoding\r\n'
+        if status != b'200 OK':
+            yield b'Content-Range: bytes %d-%d/%d\r\n' % (start, end, size)
+        yield b'\r\n'
+        if method == b'HEAD' or length == 0:
+            return
+        yield from self.file_body(path, stat, start, length)
+
+    def file_body(self, path: pathlib.Path, stat: os.stat_result,
+                  start: int, length: int)->Generator[HTTP_CHUNK_TYPE, None, None]:
+        size = stat.st_size
+        if size <= self.cache_max_file_size:
+            data = self.cache.get(path, stat.st_mtime_ns, size)
+            if data is None:
+                data = path.read_bytes()
+                if len(data) == size:
+                    self.cache.put(path, stat.st_mtime_ns, data)
+            yield data[start:start + length] if length != size else data
+        else:
+            yield SendFile(path, start, length)
+
+    def find_variant(self, path: pathlib.Path, stat: os.stat_result,
+                     encoding: bytes)->Optional[Tuple[pathlib.Path, os.stat_result]]:
+        '''
+        prebuilt sibling. app.js.gz for app.js
+        '''
+        variant = path.with_name(path.name + ENCODINGS[encoding])
+        try:
+            variant_stat = variant.stat()
+        except OSError:
+            return None
+        if not S_ISREG(variant_stat.st_mode) or variant_stat.st_mtime_ns < stat.st_mtime_ns:
+            return None
+        return variant, variant_stat
+
+    def encoded_headers(self, length: int, content_type: bytes, etag: bytes,
+                        last_modified: bytes, encoding: bytes)->Generator[bytes, None, None]:
+        yield b'HTTP/1.1 200 OK\r\n'
+        yield b'Content-Type: %b\r\n' % content_type
+        yield b'Content-Length: %d\r\n' % length
+        yield b'Content-Encoding: %b\r\n' % encoding
+        yield b'Vary: Accept-Encoding\r\n'
+        yield b'ETag: %b\r\n' % etag
+        yield b'Last-Modified: %b\r\n' % last_modified
+        yield b'\r\n'
+
+    async def compress_async(self, method: bytes, path: pathlib.Path, stat: os.stat_result,
+                             encoding: bytes, content_type: bytes, etag: bytes,
+                             last_modified: bytes)->List[HTTP_CHUNK_TYPE]:
+        '''
+        compress in the executor, never on the loop
+        '''
+        key = (path, encoding, stat.st_mtime_ns)
+        future = self.compressing.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, read_compressed, path, encoding)
+            self.compressing[key] = future
+            future.add_done_callback(lambda _: self.compressing.pop(key, None))
+        # a closed connection must not cancel the others
+        size, data = await asyncio.shield(future)
+        if size == stat.st_size:
+            self.compressed_cache.put((path, encoding), stat.st_mtime_ns, data, size)
+        response: List[HTTP_CHUNK_TYPE] = list(
+            self.encoded_headers(len(data), content_type, etag, last_modified, encoding))
+        if method != b'HEAD':
+            response.append(data)
+        return response
+
+    def is_not_modified(self, headers: List[HttpHeader], etag: bytes, mtime: int)->bool:
+        if_none_match = find_header(headers, b'if-none-match')
+        if if_none_match:
+            tags = [x.strip() for x in if_none_match.split(b',')]
+            return etag in tags or b'*' in tags or (b'W/' + etag) in tags
+        if_modified_since = find_header(headers, b'if-modified-since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since.decode('ascii'))
+            except (TypeError, ValueError):
+                return False
+            return mtime <= since.timestamp()
+        return False
@@ -1,4 +1,161 @@
+'''
+websocket payload masking
+
+https://tools.ietf.org/html/rfc6455#section-5.3
+
+every backend has the same signature
+
+* mask(masks, payload) -> bytes
+* mask_inplace(masks, buffer) -> None (buffer is bytearray or writable memoryview)
+
+the fastest available backend is exported as mask/mask_inplace.
+'''
 import array
+import sys
+from typing import Callable, Dict, Union
+
+BUFFER_TYPE = Union[bytearray, memoryview]
+MASK_TYPE = Callable[[bytes, bytes], bytes]
+MASK_INPLACE_TYPE = Callable[[bytes, BUFFER_TYPE], None]
+
+
+def _tile(masks: bytes, length: int)->bytes:
+    '''
+    repeat 4 byte key to length
+    '''
+    q, r = divmod(length, 4)
+    return masks * q + masks[:r]
+
+
+#
+# per byte. reference implementation
+#
+def mask_bytewise(masks: bytes, payload: bytes)->bytes:
+    _m = array.array("B", masks)
+    _d = array.array("B", memoryview(payload).cast('B'))
+    length = len(_d)
+    for i in range(length):
+        _d[i] ^= _m[i % 4]
+    return _d.tobytes()
+
+
+def mask_bytewise_inplace(masks: bytes, buffer: BUFFER_TYPE)->None:
+    view = memoryview(buffer).cast('B')
+    for i in range(len(view)):
+        view[i] ^= masks[i % 4]
+
+
+#
+# whole payload as one python int
+#
+def mask_bigint(masks: bytes, payload: bytes)->bytes:
+    length = len(payload)
+    if length == 0:
+        return b''
+    value = int.from_bytes(payload, sys.byteorder) ^ int.from_bytes(
+        _tile(masks, length), sys.byteorder)
+    return value.to_bytes(length, sys.byteorder)
+
+
+# in place masking works in blocks. temporaries stay small for large payloads
+INPLACE_BLOCK = 64 * 1024
+
+
+def mask_bigint_inplace(masks: bytes, buffer: BUFFER_TYPE)->None:
+    view = memoryview(buffer).cast('B')
+    length = len(view)
+    if length == 0:
+        return
+    block = min(length, INPLACE_BLOCK)
+    key = int.from_bytes(_tile(masks, block), sys.byteorder)
+    for start in range(0, length, block):
+        chunk = view[start:start + block]
+        size = len(chunk)
+        if size != block:
+            # last block
+            key = int.from_bytes(_tile(masks, size), sys.byteorder)
+        value = int.from_bytes(chunk, sys.byteorder) ^ key
+        chunk[:] = value.to_bytes(size, sys.byteorder)
+
+
+#
+# 64bit words
+#
+def mask_word64(masks: bytes, payload: bytes)->bytes:
+    view = memoryview(payload).cast('B')
+    length = len(view)
+    aligned = length - length % 8
+    words = array.array('Q')
+    # raw bytes. array('Q', view) would take each byte as a word
+    words.frombytes(view[:aligned])
+    key = int.from_bytes(masks * 2, sys.byteorder)
+    words = array.array('Q', [x ^ key for x in words])
+    tail = view[aligned:]
+    if tail:
+        return words.tobytes() + bytes(x ^ y for x, y in zip(tail, masks * 2))
+    return words.tobytes()
+
+
+def mask_word64_inplace(masks: bytes, buffer: BUFFER_TYPE)->None:
+    view = memoryview(buffer).cast('B')
+    length = len(view)
+    aligned = length - length % 8
+    if aligned:
+        words = view[:aligned].cast('Q')
+        key = int.from_bytes(masks * 2, sys.byteorder)
+        for i in range(len(words)):
+            words[i] ^= key
+    for i in range(aligned, length):
+        view[i] ^= masks[i % 4]
+
+
+MASK_BACKENDS: Dict[str, MASK_TYPE] = {
+    'bytewise': mask_bytewise,
+    'bigint': mask_bigint,
+    'word64': mask_word64,
+}
+MASK_INPLACE_BACKENDS: Dict[str, MASK_INPLACE_TYPE] = {
+    'bytewise': mask_bytewise_inplace,
+    'bigint': mask_bigint_inplace,
+    'word64': mask_word64_inplace,
+}
+
+mask = mask_bigint
+mask_inplace = mask_bigint_inplace
+MASK_BACKEND = 'bigint'
+
+
+try:
+    import numpy
+
+    # below this size numpy call overhead is larger than bigint
+    NUMPY_THRESHOLD = 1024
+
+    def mask_numpy(masks: bytes, payload: bytes)->bytes:
+        length = len(payload)
+        if length < NUMPY_THRESHOLD:
+            return mask_bigint(masks, payload)
+        data = numpy.frombuffer(payload, dtype=numpy.uint8)
+        key = numpy.frombuffer(_tile(masks, length), dtype=numpy.uint8)
+        return numpy.bitwise_xor(data, key).tobytes()
+
+    def mask_numpy_inplace(masks: bytes, buffer: BUFFER_TYPE)->None:
+        length = len(buffer)
+        if length < NUMPY_THRESHOLD:
+            mask_bigint_inplace(masks, buffer)
+            return
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        data ^= numpy.frombuffer(_tile(masks, length), dtype=numpy.uint8)
+
+    MASK_BACKENDS['numpy'] = mask_numpy
+    MASK_INPLACE_BACKENDS['numpy'] = mask_numpy_inplace
+    mask = mask_numpy
+    mask_inplace = mask_numpy_inplace
+    MASK_BACKEND = 'numpy'
+
+except ImportError:
+    pass
+
 
 try:
     #
@@ -7,15 +164,18 @@ try:
     # If wsaccel is available we use compiled routines to mask data.
     from wsaccel.xormask import XorMaskerSimple
 
-    def mask(masks: bytes, payload: bytes)->bytes:
+    def mask_wsaccel(masks: bytes, payload: bytes)->bytes:
         return XorMaskerSimple(masks).process(payload)
 
+    def mask_wsaccel_inplace(masks: bytes, buffer: BUFFER_TYPE)->None:
+        view = memoryview(buffer).cast('B')
+        view[:] = XorMaskerSimple(masks).process(bytes(view))
+
+    MASK_BACKENDS['wsaccel'] = mask_wsaccel
+    MASK_INPLACE_BACKENDS['wsaccel'] = mask_wsaccel_inplace
+    mask = mask_wsaccel
+    mask_inplace = mask_wsaccel_inplace
+    MASK_BACKEND = 'wsaccel'
+
 except ImportError:
-    # wsaccel is not available, we rely on python implementations.
-    def mask(masks: bytes, payload: bytes)->bytes:
-        _m = array.array("B", masks)
-        _d = array.array("B", payload)
-        length = len(_d)
-        for i in range(length):
-            _d[i] ^= _m[i % 4]
-        return _d.tobytes()
+    pass
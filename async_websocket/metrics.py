@@ -0,0 +1,316 @@
+'''
+counters, histograms and stage timing.
+
+pass metrics=Metrics() in connection_options of AsyncWebsocketServer or
+client_connect_async. nothing is measured when metrics is None.
+
+stages
+    parse: FrameParser, includes unmask
+    unmask: masking of received payload
+    decode: inflate and utf-8 decode
+    callback: AsyncWebsocketCallbackBase callbacks
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+from bisect import bisect_left
+from typing import Dict, Generator, List, Optional, Sequence
+
+
+STAGE_PARSE = 'parse'
+STAGE_UNMASK = 'unmask'
+STAGE_DECODE = 'decode'
+STAGE_CALLBACK = 'callback'
+STAGES = [STAGE_PARSE, STAGE_UNMASK, STAGE_DECODE, STAGE_CALLBACK]
+
+TIME_BUCKETS = [0.00001, 0.00005, 0.0001, 0.0005, 0.001,
+                0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536,
+                262144, 1048576, 4194304, 16777216]
+
+PREFIX = 'async_websocket'
+
+
+class MetricsHooks:
+    '''
+    no-op hooks. override to trace
+    '''
+
+    def on_connected(self, ws: 'AsyncWebsocketConnection')->None:
+        pass
+
+    def on_disconnected(self, ws: 'AsyncWebsocketConnection')->None:
+        pass
+
+    def on_handshake_error(self, reason: str)->None:
+        pass
+
+    def on_data_received(self, ws: 'AsyncWebsocketConnection', size: int)->None:
+        '''
+        bytes read from the socket
+        '''
+        pass
+
+    def on_frame_received(self, ws: 'AsyncWebsocketConnection', opcode: int, size: int)->None:
+        pass
+
+    def on_message_received(self, ws: 'AsyncWebsocketConnection', opcode: int, size: int)->None:
+        pass
+
+    def on_frame_sent(self, ws: 'AsyncWebsocketConnection', size: int)->None:
+        pass
+
+    def on_message_dropped(self, ws: 'AsyncWebsocketConnection')->None:
+        '''
+        by send_policy
+        '''
+        pass
+
+    def on_stage(self, ws: 'AsyncWebsocketConnection', stage: str, seconds: float)->None:
+        pass
+
+    def on_throttled(self, ws: 'AsyncWebsocketConnection', seconds: float)->None:
+        '''
+        reading paused by RateLimiter
+        '''
+        pass
+
+    def on_link_message_dropped(self, link: str)->None:
+        '''
+        a TopicRouter link to another node fell behind
+        '''
+        pass
+
+
+class Histogram:
+    def __init__(self, bounds: Sequence[float])->None:
+        self.bounds = bounds
+        # last is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float)->None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class ConnectionStats:
+    def __init__(self)->None:
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.messages_dropped = 0
+        self.callback_seconds = 0.0
+        self.throttled_seconds = 0.0
+
+
+class Metrics(MetricsHooks):
+    '''
+    global and per connection counters. exported by PrometheusMount
+    '''
+
+    def __init__(self)->None:
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.handshake_errors = 0
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.messages_dropped = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.link_messages_dropped = 0
+        self.message_size = Histogram(SIZE_BUCKETS)
+        self.stage_seconds: Dict[str, Histogram] = {
+            stage: Histogram(TIME_BUCKETS) for stage in STAGES}
+        self.connections: Dict['AsyncWebsocketConnection', ConnectionStats] = {}
+
+    def on_connected(self, ws: 'AsyncWebsocketConnection')->None:
+        '''
+        the only hook that adds a connection. the others may come after
+        on_disconnected, frames are still written and callbacks still run
+        '''
+        self.connections_opened += 1
+        self.connections[ws] = ConnectionStats()
+
+    def on_disconnected(self, ws: 'AsyncWebsocketConnection')->None:
+        self.connections_closed += 1
+        self.connections.pop(ws, None)
+
+    def on_handshake_error(self, reason: str)->None:
+        self.handshake_errors += 1
+
+    def on_data_received(self, ws: 'AsyncWebsocketConnection', size: int)->None:
+        self.bytes_received += size
+        stats = self.connections.get(ws)
+        if stats:
+            stats.bytes_received += size
+
+    def on_frame_received(self, ws: 'AsyncWebsocketConnection', opcode: int, size: int)->None:
+        self.frames_received += 1
+        stats = self.connections.get(ws)
+        if stats:
+            stats.frames_received += 1
+
+    def on_message_received(self, ws: 'AsyncWebsocketConnection', opcode: int, size: int)->None:
+        self.messages_received += 1
+        self.message_size.observe(size)
+        stats = self.connections.get(ws)
+        if stats:
+            stats.messages_received += 1
+
+    def on_frame_sent(self, ws: 'AsyncWebsocketConnection', size: int)->None:
+        self.frames_sent += 1
+        self.bytes_sent += size
+        stats = self.connections.get(ws)
+        if stats:
+            stats.frames_sent += 1
+            stats.bytes_sent += size
+
+    def on_message_dropped(self, ws: 'AsyncWebsocketConnection')->None:
+        self.messages_dropped += 1
+        stats = self.connections.get(ws)
+        if stats:
+            stats.messages_dropped += 1
+
+    def on_stage(self, ws: 'AsyncWebsocketConnection', stage: str, seconds: float)->None:
+        self.stage_seconds[stage].observe(seconds)
+        if stage == STAGE_CALLBACK:
+            stats = self.connections.get(ws)
+            if stats:
+                stats.callback_seconds += seconds
+
+    def on_throttled(self, ws: 'AsyncWebsocketConnection', seconds: float)->None:
+        self.throttled += 1
+        self.throttled_seconds += seconds
+        stats = self.connections.get(ws)
+        if stats:
+            stats.throttled_seconds += seconds
+
+    def on_link_message_dropped(self, link: str)->None:
+        self.link_messages_dropped += 1
+
+
+def _format_value(value: float)->str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class PrometheusMount:
+    '''
+    metrics in prometheus text format.
+
+    http_service.mount(b'/metrics/', PrometheusMount(metrics))
+    mount before b'/' and scrape /metrics/
+
+    per connection series are exported for the top connections only.
+    '''
+
+    def __init__(self, metrics: Metrics, top: int = 10)->None:
+        self.metrics = metrics
+        self.top = top
+
+    def __call__(self, method: bytes, relative: bytes, headers)->Generator[bytes, None, None]:
+        if method != b'GET' and method != b'HEAD':
+            yield b'HTTP/1.1 405 Method Not Allowed\r\n'
+            yield b'Content-Length: 0\r\n'
+            yield b'\r\n'
+            return
+        body = self.render().encode('utf-8')
+        yield b'HTTP/1.1 200 OK\r\n'
+        yield b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+        yield b'Content-Length: %d\r\n' % len(body)
+        yield b'\r\n'
+        if method == b'GET':
+            yield body
+
+    def render(self)->str:
+        m = self.metrics
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help: str)->str:
+            name = f'{PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            return name
+
+        def sample(name: str, value: float, labels: Optional[Dict[str, str]] = None)->None:
+            if labels:
+                label = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels.items())
+                lines.append(f'{name}{{{label}}} {_format_value(value)}')
+            else:
+                lines.append(f'{name} {_format_value(value)}')
+
+        def histogram(name: str, h: Histogram, labels: Dict[str, str])->None:
+            total = 0
+            for bound, count in zip(list(h.bounds) + [float('inf')], h.counts):
+                total += count
+                sample(name + '_bucket', total, dict(labels, le=_format_value(float(bound))))
+            sample(name + '_sum', h.sum, labels)
+            sample(name + '_count', h.count, labels)
+
+        for name, value, help in [
+                ('connections_opened_total', m.connections_opened, 'websocket connections opened'),
+                ('connections_closed_total', m.connections_closed, 'websocket connections closed'),
+                ('handshake_errors_total', m.handshake_errors, 'failed websocket handshakes'),
+                ('received_bytes_total', m.bytes_received, 'bytes read from sockets'),
+                ('received_frames_total', m.frames_received, 'frames received'),
+                ('received_messages_total', m.messages_received, 'messages received'),
+                ('sent_bytes_total', m.bytes_sent, 'bytes written to transports'),
+                ('sent_frames_total', m.frames_sent, 'frames sent'),
+                ('dropped_messages_total', m.messages_dropped, 'messages dropped by send_policy'),
+                ('throttled_total', m.throttled, 'reads paused by rate limit'),
+                ('throttled_seconds_total', m.throttled_seconds, 'time reads were paused by rate limit'),
+                ('link_dropped_messages_total', m.link_messages_dropped,
+                 'messages not forwarded to a slow router link')]:
+            sample(metric(name, 'counter', help), value)
+
+        sample(metric('connections', 'gauge', 'open websocket connections'),
+               len(m.connections))
+
+        buffered = [ws.buffered_bytes for ws in m.connections]
+        sample(metric('write_buffer_bytes', 'gauge', 'bytes waiting to be sent'),
+               sum(buffered))
+        sample(metric('write_buffer_max_bytes', 'gauge', 'largest write buffer of a connection'),
+               max(buffered, default=0))
+
+        name = metric('message_size_bytes', 'histogram', 'received message size')
+        histogram(name, m.message_size, {})
+
+        name = metric('stage_seconds', 'histogram', 'time spent in each stage')
+        for stage, h in m.stage_seconds.items():
+            histogram(name, h, {'stage': stage})
+
+        # hot connections
+        def top(key)->List['AsyncWebsocketConnection']:
+            return sorted(m.connections, key=lambda ws: key(m.connections[ws]),
+                          reverse=True)[:self.top]
+
+        for name, kind, help, key in [
+                ('connection_received_bytes_total', 'counter', 'bytes received by the top connections',
+                 lambda s: s.bytes_received),
+                ('connection_sent_bytes_total', 'counter', 'bytes sent by the top connections',
+                 lambda s: s.bytes_sent),
+                ('connection_callback_seconds_total', 'counter', 'callback time of the top connections',
+                 lambda s: s.callback_seconds),
+                ('connection_throttled_seconds_total', 'counter', 'rate limited time of the top connections',
+                 lambda s: s.throttled_seconds)]:
+            name = metric(name, kind, help)
+            for ws in top(key):
+                sample(name, key(m.connections[ws]), {'peer': f'{ws.host}:{ws.port}'})
+
+        name = metric('connection_write_buffer_bytes', 'gauge',
+                      'write buffer of the top connections')
+        for ws in sorted(m.connections, key=lambda ws: ws.buffered_bytes, reverse=True)[:self.top]:
+            sample(name, ws.buffered_bytes, {'peer': f'{ws.host}:{ws.port}'})
+
+        lines.append('')
+        return '\n'.join(lines)
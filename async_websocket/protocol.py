@@ -0,0 +1,374 @@
+'''
+asyncio.Protocol based transport.
+
+frames are parsed in data_received and written directly to the transport.
+no StreamReader, no coroutine per connection.
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict, Optional, Tuple
+
+from .exception import AsyncWebsocketError, AsyncWebsocketHandshakeError, AsyncWebsocketProtocolError
+from .connection import AsyncWebsocketConnection
+from .handler import AsyncWebsocketCallbackBase, AsyncWebsocketHandler
+from .http import (HttpRequest, KEEP_ALIVE_HEADER, CLOSE_HEADER, parse_request, parse_response,
+                   write_http_response_async)
+from .deflate import DeflateOptions, check_client_options, make_offer, negotiate_server, negotiate_client
+from .handshake import make_handshake_request, make_handshake_response
+
+HEADER_LIMIT = 64 * 1024
+
+
+def socket_path(path: str)->str:
+    '''
+    unix domain socket path. '@name' is the linux abstract namespace
+    '''
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
+
+
+def peer_address(transport: asyncio.BaseTransport)->Tuple[str, int]:
+    '''
+    host and port of the peer. a unix socket peer is the listening path and port 0
+    '''
+    peer = transport.get_extra_info('peername')
+    if isinstance(peer, tuple):
+        # ipv6 has flowinfo and scope id
+        return peer[0], peer[1]
+    name = peer or transport.get_extra_info('sockname') or ''
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    if name.startswith('\0'):
+        name = '@' + name[1:]
+    return name, 0
+
+
+class AsyncWebsocketProtocolBase(asyncio.Protocol, metaclass=ABCMeta):
+    __slots__ = ('loop', 'callbacks', 'connection_options', 'deflate_options',
+                 'transport', 'header_buffer', 'busy', 'handler')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 callbacks: AsyncWebsocketCallbackBase,
+                 connection_options: Dict[str, Any],
+                 deflate_options: Optional[DeflateOptions])->None:
+        self.loop = loop
+        self.callbacks = callbacks
+        self.connection_options = connection_options
+        self.deflate_options = deflate_options
+        self.transport: Optional[asyncio.Transport] = None
+        # None after the websocket handshake
+        self.header_buffer: Optional[bytearray] = bytearray()
+        # serving a http request. following requests wait in header_buffer
+        self.busy = False
+        self.handler: Optional[AsyncWebsocketHandler] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport)->None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Optional[Exception])->None:
+        if self.handler:
+            self.handler.client.connection_lost(exc)
+            self.handler.on_close()
+            self.handler = None
+
+    def pause_writing(self)->None:
+        if self.handler:
+            self.handler.client.pause_writing()
+
+    def resume_writing(self)->None:
+        if self.handler:
+            self.handler.client.resume_writing()
+
+    def data_received(self, data: bytes)->None:
+        try:
+            if self.handler:
+                self.feed(data)
+                return
+
+            self.header_buffer.extend(data)
+            self.process_header_buffer()
+
+        except AsyncWebsocketProtocolError as ex:
+            logger.error(ex)
+            if self.handler:
+                self.handler.client.send_close(ex.status)
+            self.transport.close()
+        except Exception as ex:
+            logger.error(ex)
+            self.transport.close()
+
+    def process_header_buffer(self)->None:
+        while not self.busy and not self.handler:
+            end = self.header_buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.header_buffer) > HEADER_LIMIT:
+                    raise AsyncWebsocketError('http header too large')
+                return
+            head = bytes(self.header_buffer[:end])
+            del self.header_buffer[:end + 4]
+            self.on_header(head)
+
+        if self.handler:
+            rest = self.header_buffer
+            self.header_buffer = None
+            if rest:
+                self.feed(bytes(rest))
+
+    @abstractmethod
+    def on_header(self, head: bytes)->None:
+        '''
+        a http request or response head before the websocket handshake
+        '''
+        pass
+
+    def start_websocket(self, client: AsyncWebsocketConnection)->None:
+        self.handler = AsyncWebsocketHandler(
+            self.loop, self.callbacks, None, client)
+        if self.handler.zero_copy:
+            # read into the frame parser buffer from now on
+            self.transport.set_protocol(AsyncWebsocketBufferedProtocol(self))
+        self.handler.on_open()
+
+    def feed(self, data: bytes)->None:
+        self.handler.feed(data)
+        if not self.handler.keep_alive:
+            self.handler.client.flush()
+            self.transport.close()
+
+
+class AsyncWebsocketBufferedProtocol(asyncio.BufferedProtocol):
+    '''
+    zero_copy websocket. the transport reads into the frame parser buffer.
+    other events go to the protocol that did the handshake
+    '''
+    __slots__ = ('protocol', 'handler')
+
+    def __init__(self, protocol: AsyncWebsocketProtocolBase)->None:
+        self.protocol = protocol
+        self.handler = protocol.handler
+
+    def connection_lost(self, exc: Optional[Exception])->None:
+        self.protocol.connection_lost(exc)
+
+    def pause_writing(self)->None:
+        self.protocol.pause_writing()
+
+    def resume_writing(self)->None:
+        self.protocol.resume_writing()
+
+    def eof_received(self)->Optional[bool]:
+        return self.protocol.eof_received()
+
+    def get_buffer(self, sizehint: int)->memoryview:
+        return self.handler.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int)->None:
+        try:
+            self.handler.buffer_updated(nbytes)
+            if not self.handler.keep_alive:
+                self.handler.client.flush()
+                self.protocol.transport.close()
+        except AsyncWebsocketProtocolError as ex:
+            logger.error(ex)
+            self.handler.client.send_close(ex.status)
+            self.protocol.transport.close()
+        except Exception as ex:
+            logger.error(ex)
+            self.protocol.transport.close()
+
+
+class AsyncWebsocketServerProtocol(AsyncWebsocketProtocolBase):
+    __slots__ = ('server', 'request_count', 'idle_timer', 'body_rest')
+
+    def __init__(self, server: 'AsyncWebsocketServer')->None:
+        super().__init__(server.loop, server.callbacks,
+                         server.connection_options, server.deflate_options)
+        self.server = server
+        self.request_count = 0
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        # bytes of the request body not received yet. discarded
+        self.body_rest = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport)->None:
+        super().connection_made(transport)
+        self.start_idle_timer()
+
+    def start_idle_timer(self)->None:
+        self.idle_timer = self.loop.call_later(
+            self.server.keep_alive_timeout, self.transport.close)
+
+    def cancel_idle_timer(self)->None:
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def start_websocket(self, client: AsyncWebsocketConnection)->None:
+        self.server.connections.add(client)
+        super().start_websocket(client)
+
+    def connection_lost(self, exc: Optional[Exception])->None:
+        self.cancel_idle_timer()
+        if self.handler:
+            self.server.connections.discard(self.handler.client)
+        super().connection_lost(exc)
+
+    def process_header_buffer(self)->None:
+        if self.body_rest and not self.busy:
+            # http_service gets no body. the next request follows it
+            size = min(self.body_rest, len(self.header_buffer))
+            del self.header_buffer[:size]
+            self.body_rest -= size
+            if self.body_rest:
+                return
+        super().process_header_buffer()
+
+    def on_header(self, head: bytes)->None:
+        self.cancel_idle_timer()
+        request = parse_request(head)
+        self.request_count += 1
+        if request.get_header(b'upgrade'):
+            #
+            # websocket handshake
+            #
+            key = request.get_header(b'sec-websocket-key')
+            if not key:
+                raise self.server.handshake_error('no sec-websocket-key')
+            deflate, extensions = None, None
+            if self.deflate_options:
+                deflate, extensions = negotiate_server(
+                    request.get_header(b'sec-websocket-extensions'), self.deflate_options)
+            self.transport.write(make_handshake_response(key, extensions))
+            client = AsyncWebsocketConnection(
+                *peer_address(self.transport),
+                self.transport, False, **self.connection_options)
+            client.deflate = deflate
+            self.start_websocket(client)
+        else:
+            #
+            # http service
+            #
+            self.body_rest = request.get_body_length()
+            self.busy = True
+            self.transport.pause_reading()
+            asyncio.ensure_future(self.serve_http_async(request))
+
+    async def serve_http_async(self, request: HttpRequest)->None:
+        keep_alive = self.server.is_keep_alive(request, self.request_count)
+        try:
+            await write_http_response_async(
+                self.loop, self.transport,
+                self.server.http_service(request.method, request.path, request.headers),
+                KEEP_ALIVE_HEADER if keep_alive else CLOSE_HEADER)
+        except Exception as ex:
+            logger.error(ex)
+            self.transport.close()
+            return
+
+        if not keep_alive or self.transport.is_closing():
+            self.transport.close()
+            return
+
+        # next request. may be pipelined already
+        self.busy = False
+        self.start_idle_timer()
+        self.transport.resume_reading()
+        try:
+            self.process_header_buffer()
+        except Exception as ex:
+            logger.error(ex)
+            self.transport.close()
+
+
+class AsyncWebsocketClientProtocol(AsyncWebsocketProtocolBase):
+    __slots__ = ('host', 'port', 'path', 'opened', 'closed')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 callbacks: AsyncWebsocketCallbackBase,
+                 host: str, port: int, path: str,
+                 connection_options: Dict[str, Any],
+                 deflate_options: Optional[DeflateOptions])->None:
+        super().__init__(loop, callbacks, connection_options, deflate_options)
+        self.host = host
+        self.port = port
+        self.path = path
+        # handshake done or failed
+        self.opened: asyncio.Future = loop.create_future()
+        self.closed: asyncio.Future = loop.create_future()
+
+    def connection_made(self, transport: asyncio.BaseTransport)->None:
+        super().connection_made(transport)
+        hostport = f'{self.host}:{self.port}' if self.port else self.host
+        hostport_bytes = hostport.encode('utf-8')
+        path_bytes = (self.path or '/').encode('utf-8')
+        extensions = make_offer(
+            self.deflate_options) if self.deflate_options else None
+        transport.write(make_handshake_request(
+            hostport_bytes, path_bytes, extensions))
+
+    def connection_lost(self, exc: Optional[Exception])->None:
+        super().connection_lost(exc)
+        if not self.opened.done():
+            self.opened.set_exception(
+                exc or ConnectionResetError('closed before handshake'))
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def on_header(self, head: bytes)->None:
+        response = parse_response(head)
+        if response.status_code != 101:
+            metrics = self.connection_options.get('metrics')
+            if metrics:
+                metrics.on_handshake_error('status %d' % response.status_code)
+            error = AsyncWebsocketHandshakeError('fail to switch: %s' % head, response.status_code)
+            if not self.opened.done():
+                self.opened.set_exception(error)
+            raise error
+
+        logger.debug('switch to websocket')
+        client = AsyncWebsocketConnection(
+            self.host, self.port, self.transport, True, **self.connection_options)
+        if self.deflate_options:
+            try:
+                client.deflate = negotiate_client(
+                    response.get_header(b'sec-websocket-extensions'), self.deflate_options)
+            except AsyncWebsocketError as ex:
+                self.opened.set_exception(ex)
+                raise
+        self.opened.set_result(None)
+        self.start_websocket(client)
+
+
+async def client_connect_protocol_async(loop: asyncio.AbstractEventLoop,
+                                        callbacks: AsyncWebsocketCallbackBase,
+                                        host: str, port: int, path: str,
+                                        deflate: Optional[DeflateOptions] = None,
+                                        address: Optional[str] = None,
+                                        connect_timeout: Optional[float] = None,
+                                        handshake_timeout: Optional[float] = None,
+                                        unix_path: Optional[str] = None,
+                                        **connection_options)->None:
+    def protocol_factory()->AsyncWebsocketClientProtocol:
+        return AsyncWebsocketClientProtocol(
+            loop, callbacks, host, port, path, connection_options, deflate)
+
+    if deflate:
+        # the offer is written in connection_made
+        check_client_options(deflate)
+    if unix_path:
+        logger.debug('connect %s%s', unix_path, path)
+        connect = loop.create_unix_connection(protocol_factory, socket_path(unix_path))
+    else:
+        logger.debug('connect %s:%s%s', host, port, path)
+        connect = loop.create_connection(protocol_factory, address or host, port)
+    transport, protocol = await asyncio.wait_for(connect, connect_timeout)
+    try:
+        await asyncio.wait_for(asyncio.shield(protocol.opened), handshake_timeout)
+    except BaseException:
+        protocol.opened.cancel()
+        transport.abort()
+        raise
+    await protocol.closed
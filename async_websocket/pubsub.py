@@ -0,0 +1,305 @@
+'''
+topic router.
+
+connections subscribe to topics. publish encodes the frame once and writes it
+to the subscribers of the topic only. routers on other nodes are linked over
+tcp or unix socket, publishes are forwarded to them in batches.
+
+router = TopicRouter(loop, metrics=metrics)
+await router.listen_async('0.0.0.0', 9000)       # node A
+await router.connect_async('node-a', 9000)       # node B
+
+in callbacks
+    router.subscribe(ws, 'news')
+    router.publish('news', b'hello')
+    router.unsubscribe_all(ws)  # on_client_left
+
+links do not forward what they received to other links, so connect the nodes
+as a full mesh. or use relay=True on the hub of a star.
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+import struct
+from typing import Dict, List, Optional, Set, Union
+
+from .constants import OPCODE
+from .connection import AsyncWebsocketConnection
+from .frame import encode_frame_header
+from .metrics import MetricsHooks
+from .client_manager import Backoff
+
+# opcode, topic length, payload length
+LINK_HEADER = struct.Struct('>BHI')
+# drop forwarded messages while a link has this much unsent
+LINK_MAX_BUFFERED = 16 * 1024 * 1024
+
+
+class TopicLink:
+    '''
+    a connection to another router. writes of a loop iteration are batched.
+    over the transport high water, messages wait for drain in out.
+    '''
+
+    def __init__(self, router: 'TopicRouter', reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, name: str)->None:
+        self.router = router
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.out: List[bytes] = []
+        self.out_bytes = 0
+        self.flush_handle: Optional[asyncio.Handle] = None
+        self.drain_task: Optional[asyncio.Future] = None
+        self.dropped_messages = 0
+
+    def __str__(self)->str:
+        return f'link({self.name})'
+
+    @property
+    def buffered_bytes(self)->int:
+        '''
+        bytes not sent to the socket yet
+        '''
+        return self.writer.transport.get_write_buffer_size() + self.out_bytes
+
+    def send(self, topic: bytes, payload: bytes, opcode: OPCODE)->bool:
+        '''
+        return False if the message was dropped
+        '''
+        if self.writer.transport.is_closing():
+            return False
+        if self.buffered_bytes > LINK_MAX_BUFFERED:
+            self.dropped_messages += 1
+            self.router.on_link_message_dropped(self)
+            return False
+        header = LINK_HEADER.pack(opcode, len(topic), len(payload)) + topic
+        self.out.append(header)
+        self.out.append(payload)
+        self.out_bytes += len(header) + len(payload)
+        if not self.flush_handle and not self.drain_task:
+            self.flush_handle = self.router.loop.call_soon(self.flush)
+        return True
+
+    def flush(self)->None:
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        out = self.out
+        self.out = []
+        self.out_bytes = 0
+        transport = self.writer.transport
+        if not out or transport.is_closing():
+            return
+        self.writer.writelines(out)
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            # the rest waits in out
+            self.drain_task = asyncio.ensure_future(self._drain_async())
+
+    async def _drain_async(self)->None:
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.drain_task = None
+        self.flush()
+
+    def close(self)->None:
+        if self.drain_task:
+            self.drain_task.cancel()
+            self.drain_task = None
+        self.writer.close()
+
+    async def run_async(self)->None:
+        '''
+        deliver received messages until the link is closed
+        '''
+        try:
+            while True:
+                header = await self.reader.readexactly(LINK_HEADER.size)
+                opcode, topic_length, length = LINK_HEADER.unpack(header)
+                topic = await self.reader.readexactly(topic_length)
+                payload = await self.reader.readexactly(length)
+                self.router.on_link_message(self, topic.decode('utf-8'), payload, OPCODE(opcode))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info('%s: closed', self)
+        finally:
+            self.writer.close()
+
+
+class TopicRouter:
+    '''
+    subscriptions are indexed by topic, publish is O(subscribers).
+    messages for a link with LINK_MAX_BUFFERED unsent are dropped,
+    counted in dropped_messages and metrics.on_link_message_dropped.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, relay: bool = False,
+                 backoff: Optional[Backoff] = None,
+                 metrics: Optional[MetricsHooks] = None)->None:
+        self.loop = loop
+        self.relay = relay
+        self.backoff = backoff or Backoff()
+        self.metrics = metrics
+        self.dropped_messages = 0
+        self.subscribers: Dict[str, Set[AsyncWebsocketConnection]] = {}
+        self.topics: Dict[AsyncWebsocketConnection, Set[str]] = {}
+        self.links: Set[TopicLink] = set()
+        self.servers: List[asyncio.AbstractServer] = []
+        self.tasks: Set[asyncio.Future] = set()
+        self.closing = False
+
+    #
+    # subscription
+    #
+    def subscribe(self, ws: AsyncWebsocketConnection, topic: str)->None:
+        self.subscribers.setdefault(topic, set()).add(ws)
+        self.topics.setdefault(ws, set()).add(topic)
+
+    def unsubscribe(self, ws: AsyncWebsocketConnection, topic: str)->None:
+        subscribers = self.subscribers.get(topic)
+        if subscribers:
+            subscribers.discard(ws)
+            if not subscribers:
+                del self.subscribers[topic]
+        topics = self.topics.get(ws)
+        if topics:
+            topics.discard(topic)
+            if not topics:
+                del self.topics[ws]
+
+    def unsubscribe_all(self, ws: AsyncWebsocketConnection)->None:
+        for topic in list(self.topics.get(ws, ())):
+            self.unsubscribe(ws, topic)
+
+    #
+    # publish
+    #
+    def publish(self, topic: str, payload: Union[bytes, str], opcode: OPCODE = OPCODE.BINARY)->int:
+        '''
+        send to the local subscribers and the linked routers.
+        return the number of local subscribers the frame was written to.
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+            if opcode == OPCODE.BINARY:
+                opcode = OPCODE.TEXT
+        if self.links:
+            topic_bytes = topic.encode('utf-8')
+            for link in self.links:
+                link.send(topic_bytes, payload, opcode)
+        return self.deliver(topic, payload, opcode)
+
+    def deliver(self, topic: str, payload: bytes, opcode: OPCODE)->int:
+        '''
+        local subscribers only. each connection's send_policy handles slow peers.
+        '''
+        subscribers = self.subscribers.get(topic)
+        if not subscribers:
+            return 0
+        frame = [encode_frame_header(len(payload), opcode, False) + payload]
+        count = 0
+        for ws in subscribers:
+            if ws.use_mask or ws.transport.is_closing():
+                continue
+            if ws.write_frame_with_policy(frame):
+                count += 1
+        return count
+
+    def on_link_message_dropped(self, link: TopicLink)->None:
+        self.dropped_messages += 1
+        if link.dropped_messages == 1:
+            logger.warning('%s: falls behind. drop messages', link)
+        if self.metrics:
+            self.metrics.on_link_message_dropped(link.name)
+
+    def on_link_message(self, source: TopicLink, topic: str, payload: bytes, opcode: OPCODE)->None:
+        if self.relay:
+            topic_bytes = topic.encode('utf-8')
+            for link in self.links:
+                if link is not source:
+                    link.send(topic_bytes, payload, opcode)
+        self.deliver(topic, payload, opcode)
+
+    #
+    # links
+    #
+    def _start_link(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    name: str)->asyncio.Future:
+        link = TopicLink(self, reader, writer, name)
+        self.links.add(link)
+        logger.info('%s: open', link)
+
+        async def run_async()->None:
+            try:
+                await link.run_async()
+            finally:
+                self.links.discard(link)
+        return asyncio.ensure_future(run_async())
+
+    def _on_accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter)->None:
+        peer = writer.get_extra_info('peername')
+        task = self._start_link(reader, writer, str(peer))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def listen_async(self, host: Optional[str], port: int)->asyncio.AbstractServer:
+        server = await asyncio.start_server(self._on_accept, host, port)
+        self.servers.append(server)
+        return server
+
+    async def listen_unix_async(self, path: str)->asyncio.AbstractServer:
+        server = await asyncio.start_unix_server(self._on_accept, path)
+        self.servers.append(server)
+        return server
+
+    async def connect_async(self, host: str, port: int)->None:
+        '''
+        link to a router. reconnects until close_async
+        '''
+        await self._connect_async(f'{host}:{port}',
+                                  lambda: asyncio.open_connection(host, port))
+
+    async def connect_unix_async(self, path: str)->None:
+        await self._connect_async(path, lambda: asyncio.open_unix_connection(path))
+
+    async def _connect_async(self, name: str, open_connection)->None:
+        # the first connect raises
+        reader, writer = await open_connection()
+        link_task = self._start_link(reader, writer, name)
+
+        async def reconnect_async()->None:
+            nonlocal link_task
+            attempt = 0
+            while True:
+                await link_task
+                while not self.closing:
+                    await asyncio.sleep(self.backoff.delay(attempt))
+                    attempt += 1
+                    try:
+                        reader, writer = await open_connection()
+                    except OSError as ex:
+                        logger.warning('link(%s): %r', name, ex)
+                        continue
+                    attempt = 0
+                    link_task = self._start_link(reader, writer, name)
+                    break
+                if self.closing:
+                    return
+
+        task = asyncio.ensure_future(reconnect_async())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close_async(self)->None:
+        self.closing = True
+        for server in self.servers:
+            server.close()
+        for link in list(self.links):
+            link.flush()
+            link.close()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,126 @@
+'''
+token bucket rate limits for received messages and bytes.
+
+one RateLimiter is shared by connections. over the limit, reading of the
+connection is paused until the bucket refills. nothing is buffered.
+
+limiter = RateLimiter(loop, messages_per_second=100, bytes_per_second=1024 * 1024,
+                      total_bytes_per_second=100 * 1024 * 1024)
+AsyncWebsocketServer(loop, callbacks, http_service, rate_limiter=limiter)
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+from typing import Optional
+
+
+class TokenBucket:
+    '''
+    rate tokens per second, up to burst. consume may go below zero,
+    the debt is the time to wait.
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate: float, burst: float, now: float)->None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def consume(self, amount: float, now: float)->float:
+        '''
+        return seconds until the bucket is not negative
+        '''
+        tokens = self.tokens + (now - self.last) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        tokens -= amount
+        self.tokens = tokens
+        self.last = now
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+
+class ConnectionRate:
+    '''
+    per connection buckets and counters. ws.rate_state
+    '''
+    __slots__ = ('messages', 'bytes', 'messages_received', 'bytes_received',
+                 'throttled', 'throttled_seconds', 'resume_handle')
+
+    def __init__(self, limiter: 'RateLimiter', now: float)->None:
+        self.messages = limiter.bucket(limiter.messages_per_second, now)
+        self.bytes = limiter.bucket(limiter.bytes_per_second, now)
+        self.messages_received = 0
+        self.bytes_received = 0
+        # times reading was paused
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.resume_handle: Optional[asyncio.TimerHandle] = None
+
+
+class RateLimiter:
+    '''
+    messages_per_second, bytes_per_second: per connection
+    total_messages_per_second, total_bytes_per_second: all connections together
+    None is unlimited. burst is in seconds of the rate
+
+    messages are data messages. bytes are read from the socket.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 messages_per_second: Optional[float] = None,
+                 bytes_per_second: Optional[float] = None,
+                 total_messages_per_second: Optional[float] = None,
+                 total_bytes_per_second: Optional[float] = None,
+                 burst: float = 1.0)->None:
+        self.loop = loop
+        self.messages_per_second = messages_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        now = loop.time()
+        self.total_messages = self.bucket(total_messages_per_second, now)
+        self.total_bytes = self.bucket(total_bytes_per_second, now)
+        self.throttled = 0
+
+    def bucket(self, rate: Optional[float], now: float)->Optional[TokenBucket]:
+        if rate is None:
+            return None
+        return TokenBucket(rate, max(rate * self.burst, 1.0), now)
+
+    def add(self, ws: 'AsyncWebsocketConnection')->None:
+        ws.rate_state = ConnectionRate(self, self.loop.time())
+
+    def remove(self, ws: 'AsyncWebsocketConnection')->None:
+        state = ws.rate_state
+        if state and state.resume_handle:
+            state.resume_handle.cancel()
+            state.resume_handle = None
+
+    def consume(self, ws: 'AsyncWebsocketConnection', messages: int, size: int)->None:
+        '''
+        count what was processed. pause reading if a bucket is empty
+        '''
+        state = ws.rate_state
+        state.messages_received += messages
+        state.bytes_received += size
+        now = self.loop.time()
+        delay = 0.0
+        for bucket, amount in ((state.messages, messages), (state.bytes, size),
+                               (self.total_messages, messages), (self.total_bytes, size)):
+            if bucket and amount:
+                delay = max(delay, bucket.consume(amount, now))
+        if delay > 0 and not state.resume_handle and not ws.transport.is_closing():
+            state.throttled += 1
+            state.throttled_seconds += delay
+            self.throttled += 1
+            if ws.metrics:
+                ws.metrics.on_throttled(ws, delay)
+            ws.pause_reading()
+            state.resume_handle = self.loop.call_later(delay, self._resume, ws)
+
+    def _resume(self, ws: 'AsyncWebsocketConnection')->None:
+        ws.rate_state.resume_handle = None
+        ws.resume_reading()
@@ -3,12 +3,17 @@ logger = getLogger(__name__)
 
 
 import asyncio
-from typing import Generator, Callable, List
+from typing import Generator, Callable, List, Optional, Set, Union
 from .connection import AsyncWebsocketConnection
+from .constants import OPCODE
+from .frame import encode_frame_header
+from .deflate import DeflateOptions, negotiate_server
 from .handler import AsyncWebsocketCallbackBase, AsyncWebsocketHandler
-from .http import HttpRequest, HttpHeader
+from .http import (HttpRequest, HttpHeader, HTTP_CHUNK_TYPE, KEEP_ALIVE_HEADER, CLOSE_HEADER,
+                   write_http_response_async)
 from .exception import AsyncWebsocketError
 from .handshake import make_handshake_response
+from .protocol import AsyncWebsocketServerProtocol, peer_address, socket_path
 
 
 class NoLineError(AsyncWebsocketError):
@@ -16,61 +21,160 @@ class NoLineError(AsyncWebsocketError):
 
 
 HTTP_SERVICE_TYPE = Callable[[
-    bytes, bytes, List[HttpHeader]], Generator[bytes, None, None]]
+    bytes, bytes, List[HttpHeader]], Generator[HTTP_CHUNK_TYPE, None, None]]
+# request bodies are read and discarded in this size
+BODY_READ_SIZE = 64 * 1024
 
 class AsyncWebsocketServer:
 
     def __init__(self, loop: asyncio.AbstractEventLoop,
                  callbacks: AsyncWebsocketCallbackBase,
-                 http_service: HTTP_SERVICE_TYPE)->None:
+                 http_service: HTTP_SERVICE_TYPE,
+                 use_protocol: bool = False,
+                 deflate: Optional[DeflateOptions] = None,
+                 keep_alive_timeout: float = 15.0,
+                 max_keep_alive_requests: int = 100,
+                 **connection_options)->None:
+        '''
+        deflate enables permessage-deflate.
+        plain http connections are closed after keep_alive_timeout seconds idle
+        or max_keep_alive_requests requests. a request and its body have to
+        arrive within keep_alive_timeout. http_service gets no body.
+        connection_options are passed to AsyncWebsocketConnection.
+        high_water, low_water, send_policy, metrics, heartbeat,
+        max_inflight, callback_semaphore, zero_copy, batch_size, batch_latency,
+        rate_limiter, max_frames_per_turn, max_bytes_per_turn, recorder
+        '''
         self.loop = loop
         self.http_service = http_service
         self.callbacks = callbacks
+        self.use_protocol = use_protocol
+        self.deflate_options = deflate
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self.connection_options = connection_options
+        self.metrics = connection_options.get('metrics')
+        # live websocket connections
+        self.connections: Set[AsyncWebsocketConnection] = set()
+
+    def handshake_error(self, reason: str)->AsyncWebsocketError:
+        '''
+        count and return the error to raise
+        '''
+        if self.metrics:
+            self.metrics.on_handshake_error(reason)
+        return AsyncWebsocketError('handshake error: %s' % reason)
+
+    def protocol_factory(self)->AsyncWebsocketServerProtocol:
+        return AsyncWebsocketServerProtocol(self)
+
+    def broadcast(self, payload: Union[bytes, str], opcode: OPCODE = OPCODE.BINARY,
+                  filter: Optional[Callable[[AsyncWebsocketConnection], bool]] = None)->int:
+        '''
+        encode the frame once and write it to every connection.
+        each connection's send_policy handles slow peers.
+        return the number of connections the frame was written to.
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        frame = [encode_frame_header(len(payload), opcode, False) + payload]
+        count = 0
+        for connection in self.connections:
+            if connection.use_mask or connection.transport.is_closing():
+                continue
+            if filter and not filter(connection):
+                continue
+            if connection.write_frame_with_policy(frame):
+                count += 1
+        return count
+
+    async def start_async(self, host: Optional[str] = None, port: Optional[int] = None,
+                          **kwargs)->asyncio.AbstractServer:
+        '''
+        listen with asyncio.Protocol or asyncio.streams.
+        kwargs are passed to create_server. sock, reuse_port, backlog...
+        '''
+        if self.use_protocol:
+            return await self.loop.create_server(self.protocol_factory, host, port, **kwargs)
+        else:
+            return await asyncio.start_server(self.handle, host, port, **kwargs)
+
+    async def start_unix_async(self, path: str, **kwargs)->asyncio.AbstractServer:
+        '''
+        listen on a unix domain socket. '@name' is the linux abstract namespace.
+        may be used with start_async, tcp and unix connections share this server.
+        kwargs are passed to create_unix_server. sock, backlog...
+        '''
+        path = socket_path(path)
+        if self.use_protocol:
+            return await self.loop.create_unix_server(self.protocol_factory, path, **kwargs)
+        else:
+            return await asyncio.start_unix_server(self.handle, path, **kwargs)
+
+    def is_keep_alive(self, request: HttpRequest, count: int)->bool:
+        '''
+        keep the connection after the response to the count-th request
+        '''
+        return request.is_keep_alive() and count < self.max_keep_alive_requests
+
+    async def read_request_async(self, reader: asyncio.StreamReader)->HttpRequest:
+        '''
+        request line, headers and the discarded body within keep_alive_timeout
+        '''
+        try:
+            return await asyncio.wait_for(
+                self._read_request_async(reader), self.keep_alive_timeout)
+        except asyncio.TimeoutError:
+            raise NoLineError('keep-alive timeout')
+
+    async def _read_request_async(self, reader: asyncio.StreamReader)->HttpRequest:
+        request_line = await reader.readline()
+        if not request_line:
+            raise NoLineError('no line')
+
+        #logger.debug(line)
+        request = HttpRequest(request_line)
+        while True:
+            line = await reader.readline()
+            if line[-2:] == b'\r\n':
+                if len(line) == 2:
+                    break
+                request.push_line(line[:-2])
+            else:
+                raise AsyncWebsocketError(b"invalid line: " + line)
+
+        size = request.get_body_length()
+        while size > 0:
+            data = await reader.read(min(size, BODY_READ_SIZE))
+            if not data:
+                raise NoLineError('closed in body')
+            size -= len(data)
+        return request
 
     async def handle(self, reader, writer):
 
         try:
-            # read http request
-            request_line = await reader.readline()
-            if not request_line:
-                raise NoLineError('no line')
-                #return
-
-            #logger.debug(line)
-            request = HttpRequest(request_line)
+            count = 0
             while True:
-                line = await reader.readline()
-                if line[-2] == 0x0d and line[-1] == 0x0a:
-                    if len(line) == 2:
-                        break
-                    request.push_line(line[:-2])
-                else:
-                    raise AsyncWebsocketError(b"invalid line: " + line)
-
-            if request.get_header(b'upgrade'):
-                #
-                # websocket handshake
-                #
-                key = request.get_header(b'sec-websocket-key')
-                response = make_handshake_response(key)
-                writer.write(response)
-                await writer.drain()
+                # read http request
+                request = await self.read_request_async(reader)
+                count += 1
+                if request.get_header(b'upgrade'):
+                    await self.handle_websocket_async(reader, writer, request)
+                    break
 
-                #
-                # start websocket
-                #
-                client = AsyncWebsocketConnection(
-                    *writer.transport.get_extra_info('peername'), writer, False)
-                handler = AsyncWebsocketHandler(
-                    self.loop, self.callbacks, reader, client)
-                await handler.handle()
-            else:
                 #
                 # http service
                 #
-                for x in self.http_service(request.method, request.path, request.headers):
-                    writer.write(x)
-                writer.write_eof()
+                keep_alive = self.is_keep_alive(request, count)
+                await write_http_response_async(
+                    self.loop, writer.transport,
+                    self.http_service(request.method, request.path, request.headers),
+                    KEEP_ALIVE_HEADER if keep_alive else CLOSE_HEADER)
+                if not keep_alive:
+                    writer.write_eof()
+                    await writer.drain()
+                    break
                 await writer.drain()
 
         except NoLineError as ex:
@@ -79,3 +183,33 @@ class AsyncWebsocketServer:
             logger.error(ex)
 
         writer.close()
+
+    async def handle_websocket_async(self, reader, writer, request: HttpRequest)->None:
+        #
+        # websocket handshake
+        #
+        key = request.get_header(b'sec-websocket-key')
+        if not key:
+            raise self.handshake_error('no sec-websocket-key')
+        deflate, extensions = None, None
+        if self.deflate_options:
+            deflate, extensions = negotiate_server(
+                request.get_header(b'sec-websocket-extensions'), self.deflate_options)
+        response = make_handshake_response(key, extensions)
+        writer.write(response)
+        await writer.drain()
+
+        #
+        # start websocket
+        #
+        client = AsyncWebsocketConnection(
+            *peer_address(writer.transport), writer, False,
+            **self.connection_options)
+        client.deflate = deflate
+        handler = AsyncWebsocketHandler(
+            self.loop, self.callbacks, reader, client)
+        self.connections.add(client)
+        try:
+            await handler.handle()
+        finally:
+            self.connections.discard(client)
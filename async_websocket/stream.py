@@ -0,0 +1,127 @@
+'''
+streaming receive and send
+'''
+import asyncio
+import pathlib
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Deque, Iterable, Optional, Union
+
+from .constants import OPCODE
+
+DEFAULT_MAX_BUFFERED = 4 * 1024 * 1024
+DEFAULT_FRAGMENT_SIZE = 64 * 1024
+
+STREAM_SOURCE_TYPE = Union[bytes, bytearray, memoryview, str, pathlib.Path,
+                           BinaryIO, Iterable[bytes], AsyncIterable[bytes]]
+
+
+async def iter_chunks_async(source: STREAM_SOURCE_TYPE, size: int)->AsyncIterator[bytes]:
+    '''
+    split source to chunks not larger than size.
+    files are read in the default executor.
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for i in range(0, len(view), size):
+            yield view[i:i + size]
+        return
+
+    if isinstance(source, (str, pathlib.Path)):
+        with open(source, 'rb') as f:
+            async for chunk in iter_chunks_async(f, size):
+                yield chunk
+        return
+
+    if hasattr(source, 'read'):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, source.read, size)
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    if hasattr(source, '__aiter__'):
+        async for chunk in source:
+            for i in range(0, len(chunk), size):
+                yield chunk[i:i + size]
+        return
+
+    for chunk in source:
+        for i in range(0, len(chunk), size):
+            yield chunk[i:i + size]
+
+
+class MessageStream:
+    '''
+    async iterator over the chunks of one message.
+
+    reading from the socket is paused while more than max_buffered bytes
+    are waiting for the consumer.
+    if the connection is lost before the last chunk, the iteration raises
+    ConnectionResetError after the received chunks.
+    '''
+
+    def __init__(self, ws: 'AsyncWebsocketConnection', opcode: OPCODE,
+                 max_buffered: int = DEFAULT_MAX_BUFFERED)->None:
+        self.ws = ws
+        self.opcode = opcode
+        self.max_buffered = max_buffered
+        self.chunks: Deque[bytes] = deque()
+        self.buffered = 0
+        self.done = False
+        # set by abort
+        self.error: Optional[Exception] = None
+        self.paused = False
+        self.waiter: Optional[asyncio.Future] = None
+
+    def put(self, chunk: bytes, last: bool)->None:
+        if chunk:
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+        if last:
+            self.done = True
+        if self.buffered > self.max_buffered and not self.paused:
+            self.paused = True
+            self.ws.pause_reading()
+        self._wakeup()
+
+    def abort(self, error: Optional[Exception] = None)->None:
+        '''
+        the connection was lost before the last chunk
+        '''
+        if self.done:
+            return
+        self.error = error or ConnectionResetError('connection lost before the end of the message')
+        self.done = True
+        self._wakeup()
+
+    def _wakeup(self)->None:
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def __aiter__(self)->'MessageStream':
+        return self
+
+    async def __anext__(self)->bytes:
+        while not self.chunks:
+            if self.done:
+                if self.error:
+                    raise self.error
+                raise StopAsyncIteration
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+            self.waiter = None
+
+        chunk = self.chunks.popleft()
+        self.buffered -= len(chunk)
+        if self.paused and self.buffered <= self.max_buffered // 2:
+            self.paused = False
+            self.ws.resume_reading()
+        return chunk
+
+    async def read(self)->bytes:
+        '''
+        all remaining chunks. for small messages
+        '''
+        return b''.join([chunk async for chunk in self])
@@ -0,0 +1,335 @@
+'''
+multi process server. POSIX only.
+
+the master process forks workers, restarts dead workers and relays the
+inter-worker bus. each worker runs its own event loop and AsyncWebsocketServer
+on the same port (SO_REUSEPORT or a socket bound by the master).
+'''
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+import os
+import selectors
+import signal
+import socket
+import struct
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+from .constants import OPCODE
+from .exception import AsyncWebsocketError
+
+# opcode, payload length
+BUS_HEADER = struct.Struct('>BI')
+RESTART_INTERVAL = 1.0
+# bus bytes queued for one worker or by a worker. messages over this are dropped
+# for that worker instead of blocking the others
+MAX_BUS_BUFFERED = 16 * 1024 * 1024
+
+
+class WorkerBus:
+    '''
+    worker side of the bus. publish reaches every connection of every worker.
+    while the master does not read MAX_BUS_BUFFERED bytes, published messages
+    reach only the local connections and are counted in dropped.
+    '''
+
+    def __init__(self, path: str, index: int)->None:
+        self.path = path
+        self.index = index
+        self.dropped = 0
+        self.server: Optional['AsyncWebsocketServer'] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.read_task: Optional[asyncio.Future] = None
+
+    def attach(self, server: 'AsyncWebsocketServer')->None:
+        self.server = server
+
+    async def connect_async(self)->None:
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.read_task = asyncio.ensure_future(self._read_async(reader))
+
+    def publish(self, payload: bytes, opcode: OPCODE = OPCODE.BINARY)->int:
+        '''
+        broadcast to local connections and send to the other workers.
+        return the number of local connections
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        if self.writer and not self.writer.is_closing():
+            if self.writer.transport.get_write_buffer_size() < MAX_BUS_BUFFERED:
+                self.writer.write(BUS_HEADER.pack(opcode, len(payload)))
+                self.writer.write(payload)
+            else:
+                self.dropped += 1
+        return self.on_bus_message(payload, opcode)
+
+    def on_bus_message(self, payload: bytes, opcode: OPCODE)->int:
+        if not self.server:
+            return 0
+        return self.server.broadcast(payload, opcode)
+
+    async def _read_async(self, reader: asyncio.StreamReader)->None:
+        try:
+            while True:
+                header = await reader.readexactly(BUS_HEADER.size)
+                opcode, length = BUS_HEADER.unpack(header)
+                payload = await reader.readexactly(length)
+                self.on_bus_message(payload, OPCODE(opcode))
+        except asyncio.IncompleteReadError:
+            logger.warning('worker %d: bus closed', self.index)
+        except Exception as ex:
+            logger.error(ex)
+
+
+class _BusPeer:
+    __slots__ = ('sock', 'received', 'outgoing', 'dropped')
+
+    def __init__(self, sock: socket.socket)->None:
+        self.sock = sock
+        # up to a partial message
+        self.received = bytearray()
+        # whole messages not sent yet
+        self.outgoing = bytearray()
+        # messages dropped since outgoing was last empty
+        self.dropped = 0
+
+
+class _BusRelay:
+    '''
+    master side of the bus. relays each message to the other workers.
+    sockets are non-blocking, a worker that does not read loses messages
+    over MAX_BUS_BUFFERED instead of stalling the others.
+    '''
+
+    def __init__(self, path: str)->None:
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.peers: Dict[socket.socket, _BusPeer] = {}
+
+    def close(self)->None:
+        for sock in list(self.peers):
+            self._drop(sock)
+        self.selector.close()
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _drop(self, sock: socket.socket)->None:
+        self.peers.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    def poll(self, timeout: float)->None:
+        for key, events in self.selector.select(timeout):
+            sock = key.fileobj
+            if sock is self.listener:
+                try:
+                    sock, _ = self.listener.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue
+                sock.setblocking(False)
+                self.peers[sock] = _BusPeer(sock)
+                self.selector.register(sock, selectors.EVENT_READ)
+                continue
+
+            peer = self.peers.get(sock)
+            if peer and events & selectors.EVENT_WRITE:
+                self._send(peer)
+            peer = self.peers.get(sock)
+            if peer and events & selectors.EVENT_READ:
+                self._receive(peer)
+
+    def _receive(self, peer: _BusPeer)->None:
+        try:
+            data = peer.sock.recv(256 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(peer.sock)
+            return
+        buffer = peer.received
+        buffer.extend(data)
+        # relay complete messages only, in one write per peer
+        end = 0
+        count = 0
+        while len(buffer) - end >= BUS_HEADER.size:
+            _, length = BUS_HEADER.unpack_from(buffer, end)
+            if len(buffer) - end - BUS_HEADER.size < length:
+                break
+            end += BUS_HEADER.size + length
+            count += 1
+        if end:
+            messages = bytes(buffer[:end])
+            del buffer[:end]
+            self._relay(peer, messages, count)
+
+    def _relay(self, sender: _BusPeer, messages: bytes, count: int)->None:
+        for peer in list(self.peers.values()):
+            if peer is sender:
+                continue
+            if len(peer.outgoing) + len(messages) > MAX_BUS_BUFFERED:
+                if not peer.dropped:
+                    logger.warning('bus: worker falls behind. drop messages')
+                peer.dropped += count
+                continue
+            pending = bool(peer.outgoing)
+            peer.outgoing += messages
+            if not pending:
+                self._send(peer)
+
+    def _send(self, peer: _BusPeer)->None:
+        '''
+        send what the socket takes. wait for EVENT_WRITE for the rest
+        '''
+        try:
+            sent = peer.sock.send(peer.outgoing)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as ex:
+            logger.error('bus: drop worker. %s', ex)
+            self._drop(peer.sock)
+            return
+        del peer.outgoing[:sent]
+        if peer.outgoing:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        else:
+            if peer.dropped:
+                logger.warning('bus: worker dropped %d messages', peer.dropped)
+                peer.dropped = 0
+            events = selectors.EVENT_READ
+        if self.selector.get_key(peer.sock).events != events:
+            self.selector.modify(peer.sock, events)
+
+
+WORKER_SETUP_TYPE = Callable[[asyncio.AbstractEventLoop, WorkerBus], 'AsyncWebsocketServer']
+
+
+def _worker_main(index: int, setup: WORKER_SETUP_TYPE, host: str, port: int,
+                 sock: Optional[socket.socket], bus_path: str)->None:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    bus = WorkerBus(bus_path, index)
+    server = setup(loop, bus)
+    bus.attach(server)
+    if sock:
+        loop.run_until_complete(server.start_async(sock=sock))
+    else:
+        loop.run_until_complete(server.start_async(host, port, reuse_port=True))
+    loop.run_until_complete(bus.connect_async())
+
+    logger.info('worker %d(pid %d): listen tcp: %s:%d...',
+                index, os.getpid(), host, port)
+    loop.run_forever()
+
+
+def _spawn(index: int, setup: WORKER_SETUP_TYPE, host: str, port: int,
+           sock: Optional[socket.socket], bus_path: str)->int:
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # worker
+    status = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        _worker_main(index, setup, host, port, sock, bus_path)
+    except BaseException as ex:
+        logger.error('worker %d: %s', index, ex)
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def run_workers(setup: WORKER_SETUP_TYPE, host: str, port: int,
+                workers: Optional[int] = None, reuse_port: bool = True)->None:
+    '''
+    fork workers and supervise them until SIGINT or SIGTERM.
+
+    setup(loop, bus) is called in each worker and returns the AsyncWebsocketServer.
+    with reuse_port each worker binds the port with SO_REUSEPORT,
+    otherwise the master binds it and workers share the socket.
+    '''
+    if not hasattr(os, 'fork'):
+        raise AsyncWebsocketError('multi process server requires os.fork')
+    workers = workers or os.cpu_count() or 1
+
+    sock = None
+    if not reuse_port:
+        sock = socket.create_server((host, port), reuse_port=False)
+        sock.setblocking(False)
+
+    bus_dir = tempfile.mkdtemp(prefix='async_websocket-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    relay = _BusRelay(bus_path)
+
+    stopping = []
+
+    def on_signal(signum, frame)->None:
+        stopping.append(signum)
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    pids: Dict[int, int] = {}
+    started: List[float] = [0.0] * workers
+    try:
+        while not stopping:
+            # (re)start
+            now = time.monotonic()
+            running = set(pids.values())
+            for index in range(workers):
+                if index in running:
+                    continue
+                if now - started[index] < RESTART_INTERVAL:
+                    continue
+                started[index] = now
+                pid = _spawn(index, setup, host, port, sock, bus_path)
+                pids[pid] = index
+                logger.info('start worker %d: pid %d', index, pid)
+
+            relay.poll(0.2)
+
+            # reap
+            while pids:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                index = pids.pop(pid, None)
+                if index is not None:
+                    logger.warning('worker %d(pid %d) exit: %d', index, pid, status)
+
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        relay.close()
+        os.rmdir(bus_dir)
+        if sock:
+            sock.close()
@@ -0,0 +1,119 @@
+'''
+small message receive, per message callback vs on_messages_received
+
+a child process sends prebuilt masked 16 byte sensor records (timestamp, value)
+over a raw socket. the server decodes them into an array per message or per batch.
+
+python benchmarks/batch_bench.py --count 500000
+'''
+import argparse
+import array
+import asyncio
+import multiprocessing
+import pathlib
+import socket
+import struct
+import sys
+import time
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+RECORD = struct.Struct('<dd')
+# records per sendall
+SEND_BATCH = 4096
+
+
+def send(port: int, count: int)->None:
+    key = b'\x01\x02\x03\x04'
+    frames = b''.join(encode_frame_header(RECORD.size, 2, True) + key
+                      + mask(key, RECORD.pack(i, i * 0.5)) for i in range(SEND_BATCH))
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(HANDSHAKE)
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(4096)
+    for _ in range(count // SEND_BATCH):
+        sock.sendall(frames)
+    # wait for the server to close
+    sock.recv(1)
+    sock.close()
+
+
+class Receiver(AsyncWebsocketCallbackBase):
+    def __init__(self, count: int)->None:
+        self.count = count
+        self.values = array.array('d')
+        self.start = 0.0
+        self.batches = 0
+        self.done = asyncio.get_event_loop().create_future()
+
+    def check_done(self, ws: AsyncWebsocketConnection)->None:
+        if len(self.values) >= self.count * 2 and not self.done.done():
+            self.done.set_result(time.perf_counter() - self.start)
+            ws.transport.close()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        self.start = time.perf_counter()
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        self.values.extend(RECORD.unpack(msg))
+        self.check_done(ws)
+
+    def on_messages_received(self, ws: AsyncWebsocketConnection, batch)->None:
+        self.batches += 1
+        self.values.frombytes(b''.join(batch))
+        self.check_done(ws)
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+async def run_async(name: str, count: int, **options)->None:
+    loop = asyncio.get_event_loop()
+    receiver = Receiver(count)
+    server = AsyncWebsocketServer(loop, receiver, HttpService(), True, **options)
+    listener = await server.start_async('127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    sender = multiprocessing.Process(target=send, args=(port, count))
+    cpu = time.process_time()
+    sender.start()
+    seconds = await receiver.done
+    cpu = time.process_time() - cpu
+    await loop.run_in_executor(None, sender.join)
+    listener.close()
+    print('%-24s %8d msgs: %9.0f msg/s, %5.2f us cpu/msg, %7d callbacks' % (
+        name, count, count / seconds, cpu / count * 1e6, receiver.batches or count))
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=500000)
+    args = parser.parse_args()
+    count = args.count - args.count % SEND_BATCH
+    asyncio.run(run_async('per message', count))
+    asyncio.run(run_async('batch 1024', count, batch_size=1024))
+    asyncio.run(run_async('batch 1024, 5 ms', count, batch_size=1024, batch_latency=0.005))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+'''
+small message send throughput with and without write coalescing
+
+the server sends 64 byte messages in bursts. "per frame" writes each frame
+to the transport as before coalescing.
+
+python benchmarks/coalesce_bench.py --messages 200000 --burst 100
+'''
+import argparse
+import asyncio
+import pathlib
+import sys
+import time
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import (
+    AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+    HttpService, client_connect_async)
+from async_websocket.constants import OPCODE
+
+
+class CountingTransport:
+    '''
+    count write calls of the wrapped transport
+    '''
+
+    def __init__(self, transport: asyncio.WriteTransport)->None:
+        self.transport = transport
+        self.writes = 0
+
+    def write(self, data: bytes)->None:
+        self.writes += 1
+        self.transport.write(data)
+
+    def writelines(self, data)->None:
+        self.writes += 1
+        self.transport.writelines(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self.transport, name)
+
+
+class Callbacks(AsyncWebsocketCallbackBase):
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+class Sender(Callbacks):
+    def __init__(self, mode: str, messages: int, burst: int)->None:
+        self.mode = mode
+        self.messages = messages
+        self.burst = burst
+        self.writes = 0
+
+    async def send_async(self, ws: AsyncWebsocketConnection)->None:
+        payload = b'x' * 64
+        counter = CountingTransport(ws.writer)
+        ws.writer = counter
+        for i in range(0, self.messages, self.burst):
+            if self.mode == 'per frame':
+                for _ in range(self.burst):
+                    for x in ws.encode(payload, OPCODE.BINARY):
+                        counter.write(x)
+            elif self.mode == 'corked':
+                with ws.corked():
+                    for _ in range(self.burst):
+                        ws.send(payload)
+            else:
+                for _ in range(self.burst):
+                    ws.send(payload)
+            await ws.drain()
+            await asyncio.sleep(0)
+        ws.flush()
+        self.writes = counter.writes
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        asyncio.ensure_future(self.send_async(ws))
+
+
+class Receiver(Callbacks):
+    def __init__(self, messages: int)->None:
+        self.messages = messages
+        self.received = 0
+        self.done = asyncio.get_event_loop().create_future()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        self.ws = ws
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        self.received += 1
+        if self.received == self.messages:
+            self.done.set_result(None)
+
+
+async def run_async(mode: str, messages: int, burst: int)->None:
+    loop = asyncio.get_event_loop()
+    sender = Sender(mode, messages, burst)
+    server = AsyncWebsocketServer(loop, sender, HttpService(), True)
+    listener = await server.start_async('127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    receiver = Receiver(messages)
+    start = time.perf_counter()
+    task = asyncio.ensure_future(client_connect_async(
+        loop, receiver, '127.0.0.1', port, '/', use_protocol=True))
+    await receiver.done
+    seconds = time.perf_counter() - start
+    receiver.ws.transport.close()
+    await task
+    listener.close()
+    print('%-10s %8d msgs in %.3f s: %9.0f msg/s, %.3f writes/msg' % (
+        mode, messages, seconds, messages / seconds, sender.writes / messages))
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--burst', type=int, default=100)
+    args = parser.parse_args()
+    for mode in ('per frame', 'coalesced', 'corked'):
+        asyncio.run(run_async(mode, args.messages, args.burst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+echo latency of light clients next to a flooding connection
+
+a child process floods the server with small binary frames. another child runs
+light clients that send a text message and wait for the echo. the server
+reports echo latency percentiles with the defaults, max_frames_per_turn and
+a per connection rate limit.
+
+python benchmarks/fairness_bench.py --clients 20 --seconds 3
+'''
+import argparse
+import asyncio
+import multiprocessing
+import pathlib
+import socket
+import sys
+import time
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import (AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+                             HttpService, RateLimiter)
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+FLOOD_FRAME = encode_frame_header(64, 2, True) + KEY + mask(KEY, bytes(64))
+# frames per sendall
+FLOOD_BATCH = 16384
+
+
+def handshake(sock: socket.socket)->None:
+    sock.sendall(HANDSHAKE)
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(4096)
+
+
+def flood(port: int, seconds: float)->None:
+    frames = FLOOD_FRAME * FLOOD_BATCH
+    sock = socket.create_connection(('127.0.0.1', port))
+    handshake(sock)
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            sock.sendall(frames)
+    except OSError:
+        pass
+    sock.close()
+
+
+def light(conn, port: int, clients: int, seconds: float)->None:
+    async def client_async(latencies: list)->None:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(HANDSHAKE)
+        await reader.readuntil(b'\r\n\r\n')
+        frame = encode_frame_header(4, 1, True) + KEY + mask(KEY, b'ping')
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            start = time.perf_counter()
+            writer.write(frame)
+            # unmasked echo, 2 byte header
+            await reader.readexactly(2 + 4)
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.01)
+        writer.close()
+
+    async def run_async()->list:
+        latencies = []
+        await asyncio.gather(*[client_async(latencies) for _ in range(clients)])
+        return latencies
+
+    conn.send(asyncio.run(run_async()))
+
+
+class Echo(AsyncWebsocketCallbackBase):
+    def __init__(self)->None:
+        self.flooded = 0
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        self.flooded += 1
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        ws.send_text(msg)
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+def percentile(values: list, p: float)->float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def run_async(name: str, clients: int, seconds: float, use_protocol: bool,
+                    **options)->None:
+    loop = asyncio.get_event_loop()
+    if 'rate_limit' in options:
+        options['rate_limiter'] = RateLimiter(loop, messages_per_second=options.pop('rate_limit'))
+    echo = Echo()
+    server = AsyncWebsocketServer(loop, echo, HttpService(), use_protocol, **options)
+    listener = await server.start_async('127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    conn, child_conn = multiprocessing.Pipe()
+    flooder = multiprocessing.Process(target=flood, args=(port, seconds))
+    clients_process = multiprocessing.Process(target=light, args=(child_conn, port, clients, seconds))
+    flooder.start()
+    clients_process.start()
+    latencies = await loop.run_in_executor(None, conn.recv)
+    await loop.run_in_executor(None, flooder.join)
+    await loop.run_in_executor(None, clients_process.join)
+    listener.close()
+    for ws in list(server.connections):
+        ws.transport.abort()
+
+    print('%-28s %6d echoes: p50 %7.2f ms, p99 %7.2f ms, max %7.2f ms, flood %7.0f msg/s' % (
+        name, len(latencies), percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3,
+        max(latencies, default=0.0) * 1e3, echo.flooded / seconds))
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--stream', action='store_true', help='asyncio.streams server')
+    args = parser.parse_args()
+    use_protocol = not args.stream
+    asyncio.run(run_async('default', args.clients, args.seconds, use_protocol))
+    asyncio.run(run_async('max_frames_per_turn=256', args.clients, args.seconds, use_protocol,
+                          max_frames_per_turn=256))
+    asyncio.run(run_async('rate 50k msg/s, 256/turn', args.clients, args.seconds, use_protocol,
+                          max_frames_per_turn=256, rate_limit=50000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+'''
+cpu cost of keepalive for many idle connections
+
+compares Heartbeat (one timer wheel task) with one call_later per connection.
+connections use a fake transport that answers ping immediately.
+
+python benchmarks/heartbeat_bench.py --connections 100000
+'''
+import argparse
+import asyncio
+import pathlib
+import sys
+import time
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import AsyncWebsocketConnection, Heartbeat
+from async_websocket.constants import OPCODE
+
+
+class FakeTransport:
+    '''
+    a peer that replies pong to every ping
+    '''
+
+    def __init__(self)->None:
+        self.ws = None
+        self.heartbeat = None
+        self.pings = 0
+
+    def set_write_buffer_limits(self, high: int, low: int)->None:
+        pass
+
+    def get_write_buffer_size(self)->int:
+        return 0
+
+    def is_closing(self)->bool:
+        return False
+
+    def write(self, data: bytes)->None:
+        if data[:1] == b'\x89':
+            self.pings += 1
+            # as AsyncWebsocketHandler.feed does for the pong
+            self.ws.last_read = self.heartbeat.now if self.heartbeat else 0.0
+
+    def close(self)->None:
+        pass
+
+    def abort(self)->None:
+        pass
+
+
+def create_connections(count: int, heartbeat=None):
+    connections = []
+    for i in range(count):
+        transport = FakeTransport()
+        transport.heartbeat = heartbeat
+        ws = AsyncWebsocketConnection('127.0.0.1', i, transport, False,
+                                      heartbeat=heartbeat)
+        transport.ws = ws
+        connections.append(ws)
+    return connections
+
+
+async def wheel_async(count: int, ping_interval: float, duration: float, tick: float):
+    loop = asyncio.get_event_loop()
+    heartbeat = Heartbeat(loop, ping_interval=ping_interval, pong_timeout=ping_interval,
+                          tick=tick)
+    connections = create_connections(count, heartbeat)
+    for ws in connections:
+        heartbeat.add(ws)
+    start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - start
+    heartbeat.stop()
+    return cpu, sum(ws.transport.pings for ws in connections)
+
+
+async def call_later_async(count: int, ping_interval: float, duration: float, tick: float):
+    loop = asyncio.get_event_loop()
+    connections = create_connections(count)
+    handles = {}
+
+    def ping(ws: AsyncWebsocketConnection)->None:
+        ws.send(b'', OPCODE.PING)
+        handles[ws] = loop.call_later(ping_interval, ping, ws)
+
+    for ws in connections:
+        handles[ws] = loop.call_later(ping_interval, ping, ws)
+    start = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - start
+    for handle in handles.values():
+        handle.cancel()
+    return cpu, sum(ws.transport.pings for ws in connections)
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--ping-interval', type=float, default=2.0)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--tick', type=float, default=0.1)
+    args = parser.parse_args()
+
+    for name, func in (('timer wheel', wheel_async), ('call_later', call_later_async)):
+        cpu, pings = asyncio.run(func(
+            args.connections, args.ping_interval, args.duration, args.tick))
+        print('%-12s %7d connections: cpu %6.3f s / %.1f s (%5.1f%%), %8d pings, %6.2f us/ping' % (
+            name, args.connections, cpu, args.duration, cpu / args.duration * 100,
+            pings, cpu / max(pings, 1) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+'''
+memory per idle websocket connection
+
+the server runs in a child process. the parent opens N connections, finishes
+the handshake and leaves them idle. the server reports RSS and tracemalloc
+growth divided by N.
+
+python benchmarks/idle_bench.py --connections 10000
+python benchmarks/idle_bench.py --connections 100000 --stream
+
+100k connections need `ulimit -n` over 100k in both processes. the client
+spreads connections over 127.0.0.x source addresses to get enough ports.
+'''
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import pathlib
+import resource
+import sys
+import time
+import tracemalloc
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+
+CONNECT_BATCH = 512
+# connections per 127.0.0.x source address
+PER_SOURCE_ADDRESS = 20000
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+
+
+def raise_nofile()->int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def rss_bytes()->int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # peak only
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Idle(AsyncWebsocketCallbackBase):
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+def serve(conn, use_protocol: bool, trace: bool)->None:
+    raise_nofile()
+    if trace:
+        tracemalloc.start()
+
+    async def run_async()->None:
+        loop = asyncio.get_event_loop()
+        server = AsyncWebsocketServer(loop, Idle(), HttpService(), use_protocol)
+        listener = await server.start_async('0.0.0.0', 0, backlog=4096)
+        conn.send(listener.sockets[0].getsockname()[1])
+
+        def measure():
+            gc.collect()
+            traced = tracemalloc.get_traced_memory()[0] if trace else 0
+            return len(server.connections), rss_bytes(), traced
+
+        while True:
+            command = await loop.run_in_executor(None, conn.recv)
+            if command == 'quit':
+                break
+            conn.send(measure())
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+class IdleClient(asyncio.Protocol):
+    def __init__(self, opened: asyncio.Future)->None:
+        self.opened = opened
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.BaseTransport)->None:
+        self.transport = transport
+        transport.write(HANDSHAKE)
+
+    def data_received(self, data: bytes)->None:
+        if not self.opened.done():
+            self.opened.set_result(data.startswith(b'HTTP/1.1 101'))
+
+    def connection_lost(self, exc)->None:
+        if not self.opened.done():
+            self.opened.set_result(False)
+
+
+async def connect_async(port: int, count: int)->list:
+    loop = asyncio.get_event_loop()
+    clients = []
+
+    async def connect_one(i: int)->None:
+        opened = loop.create_future()
+        source = '127.0.0.%d' % (1 + i // PER_SOURCE_ADDRESS)
+        _, protocol = await loop.create_connection(
+            lambda: IdleClient(opened), '127.0.0.1', port, local_addr=(source, 0))
+        if not await opened:
+            raise Exception('handshake failed')
+        clients.append(protocol)
+
+    for start in range(0, count, CONNECT_BATCH):
+        await asyncio.gather(*[connect_one(i)
+                               for i in range(start, min(count, start + CONNECT_BATCH))])
+    return clients
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--stream', action='store_true', help='asyncio.streams server')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also count python allocations. slower')
+    args = parser.parse_args()
+
+    limit = raise_nofile()
+    if args.connections + 64 > limit:
+        sys.exit('ulimit -n is %d. need more than %d' % (limit, args.connections + 64))
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=serve, args=(child_conn, not args.stream, args.tracemalloc))
+    server.start()
+    port = conn.recv()
+
+    conn.send('measure')
+    _, rss0, traced0 = conn.recv()
+
+    start = time.perf_counter()
+    clients = asyncio.new_event_loop().run_until_complete(
+        connect_async(port, args.connections))
+    seconds = time.perf_counter() - start
+    # let the server finish on_client_connected
+    time.sleep(1.0)
+
+    conn.send('measure')
+    count, rss1, traced1 = conn.recv()
+    conn.send('quit')
+    server.join()
+    for client in clients:
+        client.transport.abort()
+
+    print('%s mode: %d connections in %.1f s' % (
+        'stream' if args.stream else 'protocol', count, seconds))
+    print('rss        %8.1f MB, %7.0f bytes/connection' % (
+        (rss1 - rss0) / 1e6, (rss1 - rss0) / max(count, 1)))
+    if args.tracemalloc:
+        print('tracemalloc %7.1f MB, %7.0f bytes/connection' % (
+            (traced1 - traced0) / 1e6, (traced1 - traced0) / max(count, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,435 @@
+'''
+loopback load generation
+
+starts an AsyncWebsocketServer in a child process and drives it with
+client_connect_async clients. results are written to json.
+
+python benchmarks/load_bench.py ws --quick -o result.json
+python benchmarks/load_bench.py ws --sizes 10 65536 --connections 1 100
+python benchmarks/load_bench.py http --sizes 1024 1048576
+python benchmarks/load_bench.py ws -o new.json --compare old.json
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import (
+    AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+    HttpService, FileSystemMount, client_connect_async)
+from async_websocket.constants import OPCODE
+
+SIZES = [10, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+CONNECTIONS = [1, 10, 100, 1000, 10000]
+QUICK_SIZES = [10, 1024, 64 * 1024]
+QUICK_CONNECTIONS = [1, 100]
+# skip size * connections combinations over this
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+# concurrent handshakes
+CONNECT_BATCH = 256
+# --compare fails when a value gets worse by this ratio
+REGRESSION_RATIO = 0.1
+
+
+#
+# server process
+#
+class EchoServerCallbacks(AsyncWebsocketCallbackBase):
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        ws.send(msg, OPCODE.BINARY)
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        ws.send_text(msg)
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+def run_server(conn: Any, use_protocol: bool, document_root: Optional[str])->None:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    http_service = HttpService()
+    if document_root:
+        http_service.mount(b'/', FileSystemMount(pathlib.Path(document_root)))
+    server = AsyncWebsocketServer(
+        loop, EchoServerCallbacks(), http_service, use_protocol,
+        max_keep_alive_requests=1 << 30)
+    listener = loop.run_until_complete(
+        server.start_async('127.0.0.1', 0, backlog=4096))
+    conn.send(listener.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+class ServerProcess:
+    def __init__(self, use_protocol: bool, document_root: Optional[str] = None)->None:
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_server, args=(child, use_protocol, document_root), daemon=True)
+        self.process.start()
+        self.port: int = parent.recv()
+
+    def stop(self)->None:
+        self.process.terminate()
+        self.process.join()
+
+
+#
+# measurement
+#
+def percentile(values: List[float], q: float)->float:
+    '''
+    values must be sorted
+    '''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(messages: int, total_bytes: int, seconds: float,
+              latencies: List[float])->Dict[str, float]:
+    latencies.sort()
+    return {
+        'messages': messages,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'msgs_per_sec': messages / seconds,
+        'mb_per_sec': total_bytes / seconds / 1024 / 1024,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'p999_ms': percentile(latencies, 0.999) * 1000,
+    }
+
+
+def raise_fd_limit(count: int)->None:
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count * 2 + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+#
+# websocket
+#
+class EchoClientCallbacks(AsyncWebsocketCallbackBase):
+    '''
+    each connection sends the next message when the echo of the previous one arrives
+    '''
+
+    def __init__(self, payload: bytes, opcode: OPCODE, fragment_size: int)->None:
+        self.payload = payload
+        self.text = payload.decode('ascii') if opcode == OPCODE.TEXT else None
+        self.opcode = opcode
+        self.fragment_size = fragment_size
+        self.running = False
+        self.connections: List[AsyncWebsocketConnection] = []
+        self.sent: Dict[AsyncWebsocketConnection, Deque[float]] = {}
+        self.messages = 0
+        self.latencies: List[float] = []
+
+    def send_next(self, ws: AsyncWebsocketConnection)->None:
+        self.sent[ws].append(time.perf_counter())
+        if self.fragment_size:
+            asyncio.ensure_future(ws.send_stream_async(
+                self.payload, self.opcode, self.fragment_size))
+        elif self.text is not None:
+            ws.send_text(self.text)
+        else:
+            ws.send(self.payload, self.opcode)
+
+    def start(self)->None:
+        self.running = True
+        for ws in self.connections:
+            self.send_next(ws)
+
+    def on_received(self, ws: AsyncWebsocketConnection, size: int)->None:
+        sent = self.sent[ws].popleft()
+        if not self.running:
+            return
+        self.latencies.append(time.perf_counter() - sent)
+        self.messages += 1
+        self.send_next(ws)
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        self.connections.append(ws)
+        self.sent[ws] = deque()
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        self.on_received(ws, len(msg))
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        self.on_received(ws, len(msg))
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+async def ws_scenario_async(port: int, size: int, connections: int, opcode: OPCODE,
+                            fragmented: bool, duration: float,
+                            use_protocol: bool)->Dict[str, Any]:
+    loop = asyncio.get_event_loop()
+    payload = b'x' * size if opcode == OPCODE.TEXT else os.urandom(size)
+    fragment_size = max(1, size // 4) if fragmented else 0
+    callbacks = EchoClientCallbacks(payload, opcode, fragment_size)
+
+    # connect in batches to avoid overflowing the listen backlog
+    tasks = []
+    for i in range(0, connections, CONNECT_BATCH):
+        for _ in range(min(CONNECT_BATCH, connections - i)):
+            tasks.append(asyncio.ensure_future(client_connect_async(
+                loop, callbacks, '127.0.0.1', port, '/', use_protocol=use_protocol)))
+        while len(callbacks.connections) < len(tasks):
+            failed = [x for x in tasks if x.done() and x.exception()]
+            if failed:
+                raise failed[0].exception()
+            await asyncio.sleep(0.001)
+
+    callbacks.start()
+    start = time.perf_counter()
+    await asyncio.sleep(duration)
+    callbacks.running = False
+    seconds = time.perf_counter() - start
+
+    for ws in callbacks.connections:
+        ws.transport.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    result = {
+        'scenario': 'ws',
+        'size': size,
+        'connections': connections,
+        'opcode': opcode.name,
+        'fragmented': fragmented,
+    }
+    # a round trip moves the payload twice
+    result.update(summarize(callbacks.messages, callbacks.messages * size * 2,
+                            seconds, callbacks.latencies))
+    return result
+
+
+def run_ws(args: argparse.Namespace)->List[Dict[str, Any]]:
+    results = []
+    server = ServerProcess(not args.stream_server)
+    try:
+        for connections in args.connections:
+            raise_fd_limit(connections)
+            for size in args.sizes:
+                if size * connections > args.max_inflight_bytes:
+                    continue
+                for opcode in args.opcodes:
+                    for fragmented in args.fragmented:
+                        result = asyncio.run(ws_scenario_async(
+                            server.port, size, connections, opcode, fragmented,
+                            args.duration, not args.stream_client))
+                        print_result(result)
+                        results.append(result)
+    finally:
+        server.stop()
+    return results
+
+
+#
+# http
+#
+async def http_scenario_async(port: int, size: int, connections: int,
+                              duration: float)->Dict[str, Any]:
+    path = f'/{size}.bin'.encode('ascii')
+    request = b'GET ' + path + b' HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'
+    latencies: List[float] = []
+    counts = [0, 0]
+    running = True
+
+    async def client_async()->None:
+        reader = writer = None
+        try:
+            while running:
+                if not writer:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                sent = time.perf_counter()
+                writer.write(request)
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                close = False
+                for line in head.split(b'\r\n'):
+                    name, _, value = line.partition(b':')
+                    name = name.strip().lower()
+                    if name == b'content-length':
+                        length = int(value)
+                    elif name == b'connection' and value.strip().lower() == b'close':
+                        close = True
+                await reader.readexactly(length)
+                if running:
+                    latencies.append(time.perf_counter() - sent)
+                    counts[0] += 1
+                    counts[1] += length
+                if close:
+                    writer.close()
+                    reader = writer = None
+        finally:
+            if writer:
+                writer.close()
+
+    tasks = [asyncio.ensure_future(client_async()) for _ in range(connections)]
+    start = time.perf_counter()
+    await asyncio.sleep(duration)
+    running = False
+    seconds = time.perf_counter() - start
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    result = {
+        'scenario': 'http',
+        'size': size,
+        'connections': connections,
+    }
+    result.update(summarize(counts[0], counts[1], seconds, latencies))
+    return result
+
+
+def run_http(args: argparse.Namespace)->List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as document_root:
+        for size in args.sizes:
+            (pathlib.Path(document_root) / f'{size}.bin').write_bytes(os.urandom(size))
+        server = ServerProcess(not args.stream_server, document_root)
+        try:
+            for connections in args.connections:
+                raise_fd_limit(connections)
+                for size in args.sizes:
+                    if size * connections > args.max_inflight_bytes:
+                        continue
+                    result = asyncio.run(http_scenario_async(
+                        server.port, size, connections, args.duration))
+                    print_result(result)
+                    results.append(result)
+        finally:
+            server.stop()
+    return results
+
+
+#
+# report
+#
+def result_key(result: Dict[str, Any])->str:
+    return '%s size=%d connections=%d %s%s' % (
+        result['scenario'], result['size'], result['connections'],
+        result.get('opcode', ''), ' fragmented' if result.get('fragmented') else '')
+
+
+def print_result(result: Dict[str, Any])->None:
+    print('%-50s %10.0f msg/s %9.1f MB/s p50 %8.3f p99 %8.3f p999 %8.3f ms' % (
+        result_key(result), result['msgs_per_sec'], result['mb_per_sec'],
+        result['p50_ms'], result['p99_ms'], result['p999_ms']), flush=True)
+
+
+def get_meta(args: argparse.Namespace)->Dict[str, Any]:
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=pathlib.Path(__file__).parent).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('func', 'opcodes')},
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str)->bool:
+    '''
+    return False if any scenario regressed more than REGRESSION_RATIO
+    '''
+    with open(baseline_path) as f:
+        baseline = {result_key(x): x for x in json.load(f)['results']}
+    ok = True
+    for result in results:
+        base = baseline.get(result_key(result))
+        if not base:
+            continue
+        throughput = result['msgs_per_sec'] / max(base['msgs_per_sec'], 1e-9)
+        latency = result['p99_ms'] / max(base['p99_ms'], 1e-9)
+        regressed = throughput < 1 - REGRESSION_RATIO or latency > 1 + REGRESSION_RATIO
+        if regressed:
+            ok = False
+        print('%-50s throughput x%.2f p99 x%.2f%s' % (
+            result_key(result), throughput, latency, ' REGRESSION' if regressed else ''))
+    return ok
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, func in (('ws', run_ws), ('http', run_http)):
+        p = sub.add_parser(name)
+        p.set_defaults(func=func)
+        p.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+        p.add_argument('--connections', type=int, nargs='+', default=CONNECTIONS)
+        p.add_argument('--duration', type=float, default=2.0,
+                       help='seconds per scenario')
+        p.add_argument('--max-inflight-bytes', type=int, default=MAX_INFLIGHT_BYTES)
+        p.add_argument('--quick', action='store_true',
+                       help='small sizes and connection counts')
+        p.add_argument('--stream-server', action='store_true',
+                       help='asyncio.streams server instead of asyncio.Protocol')
+        p.add_argument('-o', '--output', help='write results as json')
+        p.add_argument('--compare', help='json from a previous run')
+        if name == 'ws':
+            p.add_argument('--text', choices=['text', 'binary', 'both'], default='both')
+            p.add_argument('--fragmented', choices=['whole', 'fragmented', 'both'],
+                           default='both')
+            p.add_argument('--stream-client', action='store_true',
+                           help='asyncio.streams client instead of asyncio.Protocol')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.sizes = QUICK_SIZES
+        args.connections = QUICK_CONNECTIONS
+    if args.command == 'ws':
+        args.opcodes = {
+            'text': [OPCODE.TEXT], 'binary': [OPCODE.BINARY],
+            'both': [OPCODE.TEXT, OPCODE.BINARY]}[args.text]
+        args.fragmented = {
+            'whole': [False], 'fragmented': [True], 'both': [False, True]}[args.fragmented]
+
+    results = args.func(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': get_meta(args), 'results': results}, f, indent=2)
+    if args.compare and not compare(results, args.compare):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+compare masking backends
+
+python benchmarks/mask_bench.py
+'''
+import os
+import sys
+import time
+import pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import masking
+
+
+SIZES = [16, 256, 4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+# skip slow backends for large payloads
+LIMITS = {
+    'bytewise': 1024 * 1024,
+    'word64': 16 * 1024 * 1024,
+}
+MIN_SECONDS = 0.2
+
+
+def measure(func, masks: bytes, payload: bytes)->float:
+    '''
+    return bytes per second
+    '''
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func(masks, payload)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_SECONDS:
+            return len(payload) * count / elapsed
+
+
+def main()->None:
+    masks = os.urandom(4)
+    print('selected backend: %s' % masking.MASK_BACKEND)
+    for size in SIZES:
+        payload = os.urandom(size)
+        expected = masking.mask_bigint(masks, payload)
+        for name, func in masking.MASK_BACKENDS.items():
+            if size > LIMITS.get(name, size):
+                continue
+            assert func(masks, payload) == expected, name
+            mbps = measure(func, masks, payload) / 1024 / 1024
+            print('%10d B %-10s %10.1f MB/s' % (size, name, mbps))
+        for name, func in masking.MASK_INPLACE_BACKENDS.items():
+            if size > LIMITS.get(name, size):
+                continue
+            buffer = bytearray(payload)
+            func(masks, buffer)
+            assert buffer == expected, name
+            mbps = measure(func, masks, buffer) / 1024 / 1024
+            print('%10d B %-10s %10.1f MB/s (inplace)' % (size, name, mbps))
+
+
+if __name__ == '__main__':
+    main()
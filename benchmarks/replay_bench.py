@@ -0,0 +1,372 @@
+'''
+replay a capture log against a server over loopback
+
+record with AsyncWebsocketServer(..., recorder=TrafficRecorder(loop, 'traffic.cap')).
+every recorded connection is replayed by a client that sends the frames the
+server received, at the recorded times / speed or as fast as possible
+(--speed 0). compressed frames are skipped, the replay offers no extensions.
+
+reply latency pairs the n-th data message from the server with the frame
+that came before the n-th recorded reply, so it holds for request/response
+traffic with the same reply order.
+
+python benchmarks/replay_bench.py traffic.cap                  # echo server in a child process
+python benchmarks/replay_bench.py traffic.cap --speed 10
+python benchmarks/replay_bench.py traffic.cap --speed 0 --port 8080
+python benchmarks/replay_bench.py traffic.cap --unix /run/ws.sock
+python benchmarks/replay_bench.py --make-sample traffic.cap     # record a sample log
+'''
+import argparse
+import asyncio
+import multiprocessing
+import pathlib
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import (AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+                             CaptureFile, HttpService, TrafficRecorder, client_connect_async)
+from async_websocket.capture import DIRECTION_IN, DIRECTION_OUT, DIRECTION_CLOSE
+from async_websocket.constants import OPCODE
+from async_websocket.frame import FrameParser, encode_frame_header
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: localhost\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+# concurrent handshakes
+CONNECT_BATCH = 256
+# wait for the rest of the replies after the last frame
+REPLY_TIMEOUT = 5.0
+
+
+class Echo(AsyncWebsocketCallbackBase):
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        ws.send(msg)
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        ws.send_text(msg)
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+def serve(conn, use_protocol: bool, record: Optional[str])->None:
+    async def run_async()->None:
+        loop = asyncio.get_event_loop()
+        recorder = TrafficRecorder(loop, record) if record else None
+        server = AsyncWebsocketServer(loop, Echo(), HttpService(), use_protocol, recorder=recorder)
+        listener = await server.start_async('127.0.0.1', 0)
+        conn.send(listener.sockets[0].getsockname()[1])
+        await loop.run_in_executor(None, conn.recv)
+        listener.close()
+        for ws in list(server.connections):
+            ws.transport.close()
+        await asyncio.sleep(0.1)
+        if recorder:
+            recorder.close()
+
+    asyncio.run(run_async())
+
+
+class Session:
+    '''
+    a recorded connection
+    '''
+
+    def __init__(self, connection: int)->None:
+        self.connection = connection
+        self.open_time: Optional[float] = None
+        self.close_time: Optional[float] = None
+        # (time, fin, rsv, opcode, payload) received by the recorded server
+        self.frames: List[Tuple[float, bool, int, int, memoryview]] = []
+        # index of the frame before each recorded reply. -1 for a push
+        self.triggers: List[int] = []
+
+
+def load_sessions(capture: CaptureFile)->Tuple[List[Session], int, float]:
+    '''
+    sessions in open order, skipped compressed frames, first time
+    '''
+    sessions: Dict[int, Session] = {}
+    skipped = 0
+    start = None
+    for record in capture:
+        if start is None:
+            start = record.time
+        session = sessions.get(record.connection)
+        if session is None:
+            session = sessions[record.connection] = Session(record.connection)
+        if session.open_time is None:
+            session.open_time = record.time
+        if record.direction == DIRECTION_IN:
+            if record.rsv:
+                skipped += 1
+                continue
+            session.frames.append((record.time, record.fin, record.rsv, record.opcode, record.payload))
+        elif record.direction == DIRECTION_OUT:
+            if record.fin and record.opcode < OPCODE.CLOSE_CONN:
+                session.triggers.append(len(session.frames) - 1)
+        elif record.direction == DIRECTION_CLOSE:
+            session.close_time = record.time
+    ordered = sorted(sessions.values(), key=lambda s: s.open_time)
+    return ordered, skipped, start or 0.0
+
+
+class ReplayClient(asyncio.Protocol):
+    def __init__(self, loop: asyncio.AbstractEventLoop, session: Session, stats: 'Stats')->None:
+        self.session = session
+        self.stats = stats
+        self.transport: Optional[asyncio.Transport] = None
+        self.opened = loop.create_future()
+        self.closed = loop.create_future()
+        self.head = b''
+        self.parser = FrameParser()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        # actual send time of each frame
+        self.sent: List[float] = []
+        self.replies = 0
+        self.replied = asyncio.Event()
+
+    def connection_made(self, transport: asyncio.BaseTransport)->None:
+        self.transport = transport
+        transport.write(HANDSHAKE)
+
+    def connection_lost(self, exc: Optional[Exception])->None:
+        if not self.opened.done():
+            self.opened.set_exception(exc or ConnectionResetError('closed in handshake'))
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self.writable.set()
+        self.replied.set()
+
+    def pause_writing(self)->None:
+        self.writable.clear()
+
+    def resume_writing(self)->None:
+        self.writable.set()
+
+    def data_received(self, data: bytes)->None:
+        if not self.opened.done():
+            self.head += data
+            end = self.head.find(b'\r\n\r\n')
+            if end < 0:
+                return
+            if not self.head.startswith(b'HTTP/1.1 101'):
+                self.opened.set_exception(ConnectionError(self.head[:end].decode('latin-1')))
+                self.transport.close()
+                return
+            self.opened.set_result(None)
+            data = self.head[end + 4:]
+            self.head = b''
+        now = time.perf_counter()
+        for frame in self.parser.feed(data):
+            if not frame.fin or frame.opcode >= OPCODE.CLOSE_CONN:
+                continue
+            self.stats.replies += 1
+            triggers = self.session.triggers
+            if self.replies < len(triggers):
+                index = triggers[self.replies]
+                if 0 <= index < len(self.sent):
+                    self.stats.latencies.append(now - self.sent[index])
+            self.replies += 1
+            if self.replies >= len(triggers):
+                self.replied.set()
+
+    def send(self, fin: bool, rsv: int, opcode: int, payload: memoryview)->None:
+        frame = encode_frame_header(len(payload), opcode, True, fin, rsv) + KEY + mask(KEY, payload)
+        self.transport.write(frame)
+        self.sent.append(time.perf_counter())
+        self.stats.frames += 1
+        self.stats.bytes += len(payload)
+
+
+class Stats:
+    def __init__(self)->None:
+        self.frames = 0
+        self.bytes = 0
+        self.replies = 0
+        self.errors = 0
+        self.latencies: List[float] = []
+        # actual - scheduled send time
+        self.lags: List[float] = []
+
+
+async def replay_session_async(loop: asyncio.AbstractEventLoop, session: Session, stats: Stats,
+                               connect, connecting: asyncio.Semaphore,
+                               start: float, capture_start: float, speed: float)->None:
+    def scheduled(recorded: float)->float:
+        return start + (recorded - capture_start) / speed
+
+    if speed:
+        delay = scheduled(session.open_time) - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    client = None
+    try:
+        async with connecting:
+            _, client = await connect(lambda: ReplayClient(loop, session, stats))
+            await client.opened
+        for recorded, fin, rsv, opcode, payload in session.frames:
+            if client.transport.is_closing():
+                break
+            if speed:
+                target = scheduled(recorded)
+                delay = target - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                stats.lags.append(time.perf_counter() - target)
+            elif not client.writable.is_set():
+                await client.writable.wait()
+            client.send(fin, rsv, opcode, payload)
+        if session.triggers and client.replies < len(session.triggers):
+            try:
+                await asyncio.wait_for(client.replied.wait(), REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        if speed and session.close_time:
+            delay = scheduled(session.close_time) - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    except (OSError, ConnectionError) as ex:
+        stats.errors += 1
+        print('connection %d: %r' % (session.connection, ex), file=sys.stderr)
+    finally:
+        if client and client.transport:
+            client.transport.close()
+
+
+def percentile(values: List[float], q: float)->float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def replay_async(path: str, speed: float, host: str, port: Optional[int],
+                       unix: Optional[str])->None:
+    loop = asyncio.get_event_loop()
+    if unix:
+        def connect(factory):
+            return loop.create_unix_connection(factory, unix)
+    else:
+        def connect(factory):
+            return loop.create_connection(factory, host, port)
+
+    with CaptureFile(path) as capture:
+        sessions, skipped, capture_start = load_sessions(capture)
+        recorded_seconds = max((s.close_time or (s.frames[-1][0] if s.frames else s.open_time))
+                               for s in sessions) - capture_start if sessions else 0.0
+        stats = Stats()
+        connecting = asyncio.Semaphore(CONNECT_BATCH)
+        start = time.perf_counter()
+        await asyncio.gather(*[replay_session_async(loop, session, stats, connect, connecting,
+                                                    start, capture_start, speed)
+                               for session in sessions])
+        seconds = time.perf_counter() - start
+        count = len(sessions)
+        # payload views must be gone before the mapping is closed
+        del sessions
+
+    print('%s: %d connections, %.1f s recorded, speed %s, %d compressed frames skipped' % (
+        path, count, recorded_seconds, '%gx' % speed if speed else 'max', skipped))
+    print('sent    %8d frames %10d bytes in %.2f s: %9.0f frames/s %8.1f MB/s, %d errors' % (
+        stats.frames, stats.bytes, seconds, stats.frames / seconds, stats.bytes / seconds / 1e6,
+        stats.errors))
+    print('replies %8d, latency p50 %.2f ms p99 %.2f ms max %.2f ms' % (
+        stats.replies, percentile(stats.latencies, 0.5) * 1e3,
+        percentile(stats.latencies, 0.99) * 1e3, max(stats.latencies, default=0.0) * 1e3))
+    if speed:
+        print('send lag p50 %.2f ms p99 %.2f ms' % (
+            percentile(stats.lags, 0.5) * 1e3, percentile(stats.lags, 0.99) * 1e3))
+
+
+async def make_sample_async(port: int, connections: int, messages: int)->None:
+    '''
+    clients that send text and binary messages with pauses, to record a sample log
+    '''
+    loop = asyncio.get_event_loop()
+
+    class Client(AsyncWebsocketCallbackBase):
+        def on_client_connected(self, ws: AsyncWebsocketConnection)->Any:
+            async def run_async()->None:
+                for i in range(messages):
+                    if i % 2:
+                        ws.send(bytes(64 * (i % 16)))
+                    else:
+                        ws.send_text('message %d' % i)
+                    await asyncio.sleep(0.001 * (i % 10))
+                await asyncio.sleep(0.1)
+                ws.send_close()
+            asyncio.ensure_future(run_async())
+
+        def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+            pass
+
+        def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+            pass
+
+        def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+            pass
+
+        def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+            pass
+
+        def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+            pass
+
+    await asyncio.gather(*[client_connect_async(loop, Client(), '127.0.0.1', port, '/', True)
+                           for _ in range(connections)])
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1.0, help='0 is as fast as possible')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='a running server. default starts an echo server')
+    parser.add_argument('--unix', help='a running server on a unix socket')
+    parser.add_argument('--stream', action='store_true', help='asyncio.streams echo server')
+    parser.add_argument('--make-sample', action='store_true',
+                        help='record clients against the echo server to the capture path')
+    parser.add_argument('--connections', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+
+    server = None
+    port = args.port
+    if args.make_sample or not (args.port or args.unix):
+        conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve, args=(
+            child_conn, not args.stream, args.capture if args.make_sample else None))
+        server.start()
+        port = conn.recv()
+    try:
+        if args.make_sample:
+            asyncio.run(make_sample_async(port, args.connections, args.messages))
+        else:
+            asyncio.run(replay_async(args.capture, args.speed, args.host, port, args.unix))
+    finally:
+        if server:
+            conn.send('quit')
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''
+tcp loopback vs unix domain socket
+
+the server runs in a child process and listens on tcp and a unix socket at
+once. the parent measures echo round trip latency and one way throughput of
+binary messages over each.
+
+python benchmarks/uds_bench.py --round-trips 20000 --count 200000 --size 1024
+'''
+import argparse
+import asyncio
+import multiprocessing
+import os
+import pathlib
+import socket
+import sys
+import tempfile
+import time
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+# frames per sendall
+SEND_BATCH = 256
+
+
+class Echo(AsyncWebsocketCallbackBase):
+    '''
+    echo text, count binary
+    '''
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        ws.send_text(msg)
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+def serve(conn, path: str, use_protocol: bool)->None:
+    async def run_async()->None:
+        loop = asyncio.get_event_loop()
+        server = AsyncWebsocketServer(loop, Echo(), HttpService(), use_protocol)
+        tcp = await server.start_async('127.0.0.1', 0)
+        unix = await server.start_unix_async(path)
+        conn.send(tcp.sockets[0].getsockname()[1])
+        await loop.run_in_executor(None, conn.recv)
+        tcp.close()
+        unix.close()
+
+    asyncio.run(run_async())
+
+
+def recv_exactly(sock: socket.socket, size: int)->bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('closed')
+        data += chunk
+    return data
+
+
+def open_socket(family: int, address)->socket.socket:
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(HANDSHAKE)
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(4096)
+    return sock
+
+
+def measure(name: str, family: int, address, round_trips: int, count: int, size: int)->None:
+    sock = open_socket(family, address)
+    ping = encode_frame_header(4, 1, True) + KEY + mask(KEY, b'ping')
+    latencies = []
+    for _ in range(round_trips):
+        start = time.perf_counter()
+        sock.sendall(ping)
+        recv_exactly(sock, 2 + 4)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    frames = (encode_frame_header(size, 2, True) + KEY + mask(KEY, os.urandom(size))) * SEND_BATCH
+    start = time.perf_counter()
+    for _ in range(count // SEND_BATCH):
+        sock.sendall(frames)
+    # the echo comes after every binary message is processed
+    sock.sendall(ping)
+    recv_exactly(sock, 2 + 4)
+    seconds = time.perf_counter() - start
+    sock.close()
+
+    sent = count - count % SEND_BATCH
+    print('%-4s rtt p50 %6.1f us, p99 %6.1f us | %6d x %5d bytes: %8.1f MB/s %9.0f msg/s' % (
+        name, latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6,
+        sent, size, sent * size / seconds / 1e6, sent / seconds))
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--round-trips', type=int, default=20000)
+    parser.add_argument('--count', type=int, default=200000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--stream', action='store_true', help='asyncio.streams server')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child_conn, path, not args.stream))
+    server.start()
+    port = conn.recv()
+    try:
+        print('%s mode' % ('stream' if args.stream else 'protocol'))
+        measure('tcp', socket.AF_INET, ('127.0.0.1', port), args.round_trips, args.count, args.size)
+        measure('uds', socket.AF_UNIX, path, args.round_trips, args.count, args.size)
+    finally:
+        conn.send('quit')
+        server.join()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    main()
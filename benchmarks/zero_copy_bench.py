@@ -0,0 +1,133 @@
+'''
+binary message receive with and without zero_copy
+
+a child process sends prebuilt masked frames over a raw socket. the server
+reports throughput and the tracemalloc peak of the receive path in multiples
+of the message size (about the number of copies alive at once).
+
+python benchmarks/zero_copy_bench.py --size 104857600 --count 3
+python benchmarks/zero_copy_bench.py --size 1024 --count 200000
+'''
+import argparse
+import asyncio
+import multiprocessing
+import os
+import pathlib
+import socket
+import sys
+import time
+import tracemalloc
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+# frames per sendall
+SEND_BATCH = 1024 * 1024
+
+
+def send(port: int, size: int, count: int)->None:
+    key = b'\x01\x02\x03\x04'
+    frame = (encode_frame_header(size, 2, True) + key
+             + mask(key, os.urandom(min(size, 1024)) * (size // 1024) + os.urandom(size % 1024)))
+    frames = frame * max(1, SEND_BATCH // len(frame))
+    per_send = len(frames) // len(frame)
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(HANDSHAKE)
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(4096)
+    sent = 0
+    while sent < count:
+        n = min(per_send, count - sent)
+        sock.sendall(frames if n == per_send else frame * n)
+        sent += n
+    # wait for the server to close
+    sock.recv(1)
+    sock.close()
+
+
+class Receiver(AsyncWebsocketCallbackBase):
+    def __init__(self, count: int)->None:
+        self.count = count
+        self.received = 0
+        self.bytes = 0
+        self.start = 0.0
+        self.done = asyncio.get_event_loop().create_future()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        self.start = time.perf_counter()
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        # touch the payload as an application would
+        self.bytes += len(msg) + msg[-1] * 0
+        self.received += 1
+        if self.received == self.count:
+            self.done.set_result(time.perf_counter() - self.start)
+            ws.transport.close()
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+async def run_async(size: int, count: int, zero_copy: bool, use_protocol: bool,
+                    trace: bool)->None:
+    loop = asyncio.get_event_loop()
+    receiver = Receiver(count)
+    server = AsyncWebsocketServer(loop, receiver, HttpService(), use_protocol,
+                                  max_message_size=size, zero_copy=zero_copy)
+    listener = await server.start_async('127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    if trace:
+        tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0] if trace else 0
+    sender = multiprocessing.Process(target=send, args=(port, size, count))
+    sender.start()
+    seconds = await receiver.done
+    peak = tracemalloc.get_traced_memory()[1] - base if trace else 0
+    if trace:
+        tracemalloc.stop()
+    await loop.run_in_executor(None, sender.join)
+    listener.close()
+
+    line = '%-8s zero_copy=%-5s %9d x %7d: %8.1f MB/s %9.0f msg/s' % (
+        'protocol' if use_protocol else 'stream', zero_copy, size, count,
+        size * count / seconds / 1e6, count / seconds)
+    if trace:
+        line += ', peak %6.1f MB (%.1f x size)' % (peak / 1e6, peak / size)
+    print(line)
+
+
+def main()->None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100 * 1024 * 1024)
+    parser.add_argument('--count', type=int, default=3)
+    parser.add_argument('--stream', action='store_true', help='asyncio.streams server')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='peak python allocations. slower')
+    args = parser.parse_args()
+    for zero_copy in (False, True):
+        asyncio.run(run_async(args.size, args.count, zero_copy, not args.stream,
+                              args.tracemalloc))
+
+
+if __name__ == '__main__':
+    main()
@@ -33,7 +33,18 @@ class EchoCallbacks(AsyncWebsocketCallbackBase):
 
 
 
-def main(host: str, port: int)->None:
+def create_server(loop: asyncio.AbstractEventLoop, use_protocol: bool)->AsyncWebsocketServer:
+    document_root = pathlib.Path(__file__).absolute().parent
+
+    http_service = HttpService()
+    http_service.mount(b'/', FileSystemMount(document_root))
+
+    # http server
+    return AsyncWebsocketServer(
+        loop, EchoCallbacks(), http_service, use_protocol)
+
+
+def main(host: str, port: int, use_protocol: bool, workers: int)->None:
     from logging import basicConfig, DEBUG
     basicConfig(
         level=DEBUG,
@@ -41,16 +52,15 @@ def main(host: str, port: int)->None:
         format='%(asctime)s[%(levelname)s][%(name)s.%(funcName)s] %(message)s'
     )
 
-    loop = asyncio.get_event_loop()
-    document_root = pathlib.Path(__file__).absolute().parent
+    if workers:
+        from async_websocket.workers import run_workers
+        run_workers(lambda loop, bus: create_server(loop, use_protocol),
+                    host, port, workers)
+        return
 
-    http_service = HttpService()
-    http_service.mount(b'/', FileSystemMount(document_root))
-
-    # http server
-    server = AsyncWebsocketServer(loop, EchoCallbacks(), http_service)
-    loop.run_until_complete(asyncio.start_server(
-        server.handle, host, port, loop=loop))
+    loop = asyncio.get_event_loop()
+    server = create_server(loop, use_protocol)
+    loop.run_until_complete(server.start_async(host, port))
 
     logger.info("listen tcp: %s:%d...", host, port)
     loop.run_forever()
@@ -58,4 +68,10 @@ def main(host: str, port: int)->None:
 
 
 if __name__ == '__main__':
-    main('0.0.0.0', 8080)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--protocol', action='store_true')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='fork workers with SO_REUSEPORT')
+    args = parser.parse_args()
+    main('0.0.0.0', 8080, args.protocol, args.workers)
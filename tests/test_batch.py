@@ -0,0 +1,83 @@
+'''
+on_messages_received with fragmented messages
+'''
+import asyncio
+from typing import List, Union
+
+import pytest
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.constants import OPCODE
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+
+
+def encode(payload: bytes, opcode: int, fin: bool = True)->bytes:
+    return encode_frame_header(len(payload), opcode, True, fin) + KEY + mask(KEY, payload)
+
+
+class Batches(AsyncWebsocketCallbackBase):
+    def __init__(self)->None:
+        self.batches: List[List[Union[bytes, str]]] = []
+        self.closed = asyncio.Event()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        self.closed.set()
+
+    def on_messages_received(self, ws: AsyncWebsocketConnection,
+                             batch: List[Union[bytes, str]])->None:
+        self.batches.append(batch)
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+@pytest.mark.parametrize('zero_copy', [True, False])
+def test_fragmented_messages(use_protocol: bool, zero_copy: bool)->None:
+    async def run_async()->List[Union[bytes, str]]:
+        loop = asyncio.get_running_loop()
+        callbacks = Batches()
+        server = AsyncWebsocketServer(loop, callbacks, HttpService(), use_protocol,
+                                      zero_copy=zero_copy, batch_size=16)
+        listener = await server.start_async('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+        writer.write(HANDSHAKE)
+        await reader.readuntil(b'\r\n\r\n')
+        # one read per message
+        for frames in [
+                [encode(b'AB', OPCODE.BINARY, False), encode(b'CD', OPCODE.CONTINUATION)],
+                [encode(b'EF', OPCODE.BINARY, False), encode(b'GH', OPCODE.CONTINUATION)],
+                [encode(b'XY', OPCODE.BINARY)],
+                [encode(b'te', OPCODE.TEXT, False), encode(b'xt', OPCODE.CONTINUATION)],
+                [encode(b'', OPCODE.CLOSE_CONN)]]:
+            writer.write(b''.join(frames))
+            await writer.drain()
+            await asyncio.sleep(0.02)
+        await asyncio.wait_for(callbacks.closed.wait(), 5)
+        writer.close()
+        listener.close()
+        return [msg for batch in callbacks.batches for msg in batch]
+
+    assert asyncio.run(run_async()) == [b'ABCD', b'EFGH', b'XY', 'text']
@@ -0,0 +1,84 @@
+'''
+TrafficRecorder and CaptureFile
+'''
+import asyncio
+import os
+import pathlib
+
+import pytest
+
+from async_websocket import CaptureFile, TrafficRecorder
+from async_websocket.capture import DIRECTION_CLOSE, DIRECTION_IN, DIRECTION_OPEN, DIRECTION_OUT, MAGIC, RECORD
+from async_websocket.constants import CONSTANTS, OPCODE
+from async_websocket.exception import AsyncWebsocketError
+from async_websocket.frame import Frame, encode_frame_header
+from async_websocket.masking import mask
+
+
+class Connection:
+    '''
+    what TrafficRecorder uses of AsyncWebsocketConnection
+    '''
+
+    def __init__(self, peer: str)->None:
+        self.peer = peer
+        self.capture_id = 0
+
+    def __str__(self)->str:
+        return self.peer
+
+
+def test_write_and_read(tmp_path: pathlib.Path)->None:
+    async def run_async()->None:
+        recorder = TrafficRecorder(asyncio.get_running_loop(), str(tmp_path / 'traffic.cap'))
+        ws = [Connection('(127.0.0.1:1000)'), Connection('(127.0.0.1:1001)')]
+        for x in ws:
+            recorder.add(x)
+        key = b'\x01\x02\x03\x04'
+        large = os.urandom(100000)
+        recorder.on_frame_received(ws[0], Frame(True, 0, OPCODE.TEXT, True, b'hello'), False)
+        # streaming chunks of one frame
+        recorder.on_frame_received(ws[1], Frame(False, 0, OPCODE.BINARY, True, b'ab', True), False)
+        recorder.on_frame_received(ws[1], Frame(False, 0, OPCODE.BINARY, True, memoryview(b'cd')), True)
+        # sent frames as encoded. unmasked for the log
+        recorder.on_frame_sent(ws[0], [encode_frame_header(3, OPCODE.BINARY, True, rsv=int(CONSTANTS.RSV1))
+                                       + key + mask(key, b'xyz')])
+        recorder.on_frame_sent(ws[1], [encode_frame_header(len(large), OPCODE.BINARY, False), large])
+        recorder.remove(ws[0])
+        assert recorder.records == 8
+        recorder.close()
+
+    asyncio.run(run_async())
+
+    with CaptureFile(str(tmp_path / 'traffic.cap')) as capture:
+        records = [(x.connection, x.direction, x.fin, x.rsv, x.opcode, bytes(x.payload)) for x in capture]
+    large = records[6][5]
+    assert len(large) == 100000
+    assert records == [
+        (1, DIRECTION_OPEN, False, 0, 0, b'(127.0.0.1:1000)'),
+        (2, DIRECTION_OPEN, False, 0, 0, b'(127.0.0.1:1001)'),
+        (1, DIRECTION_IN, True, 0, OPCODE.TEXT, b'hello'),
+        (2, DIRECTION_IN, False, 0, OPCODE.BINARY, b'ab'),
+        (2, DIRECTION_IN, False, 0, OPCODE.CONTINUATION, b'cd'),
+        (1, DIRECTION_OUT, True, int(CONSTANTS.RSV1), OPCODE.BINARY, b'xyz'),
+        (2, DIRECTION_OUT, True, 0, OPCODE.BINARY, large),
+        (1, DIRECTION_CLOSE, False, 0, 0, b'')]
+
+
+def test_read_cut_off_log(tmp_path: pathlib.Path)->None:
+    path = tmp_path / 'traffic.cap'
+    data = (MAGIC + RECORD.pack(1.0, 1, DIRECTION_IN, int(OPCODE.BINARY), 3) + b'abc'
+            + RECORD.pack(2.0, 1, DIRECTION_IN, int(OPCODE.BINARY), 5) + b'ab')
+    path.write_bytes(data)
+    with CaptureFile(str(path)) as capture:
+        assert [bytes(x.payload) for x in capture] == [b'abc']
+
+    path.write_bytes(b'AWSCAP1\n' + RECORD.pack(1.0, 1, DIRECTION_IN, int(OPCODE.BINARY), 0))
+    with pytest.raises(AsyncWebsocketError):
+        CaptureFile(str(path))
+
+
+def test_large_payload_length()->None:
+    # a payload over 4GiB keeps its length
+    record = RECORD.pack(0.0, 1, DIRECTION_IN, int(OPCODE.BINARY), 5 << 30)
+    assert RECORD.unpack(record)[4] == 5 << 30
@@ -0,0 +1,256 @@
+'''
+permessage-deflate negotiation, compression and send policies
+'''
+import asyncio
+import os
+import struct
+from typing import List, Tuple
+
+import pytest
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.constants import CLOSESTATUS, CONSTANTS, OPCODE, SENDPOLICY
+from async_websocket.deflate import (DeflateOptions, PerMessageDeflate, check_client_options, make_offer,
+                                     negotiate_client, negotiate_server)
+from async_websocket.exception import AsyncWebsocketError, AsyncWebsocketProtocolError
+from async_websocket.frame import FrameParser, encode_frame_header
+from async_websocket.masking import mask
+
+KEY = b'\x01\x02\x03\x04'
+
+
+def pair(offer: bytes, server_options: DeflateOptions = DeflateOptions(),
+         client_options: DeflateOptions = DeflateOptions()
+         )->Tuple[PerMessageDeflate, PerMessageDeflate]:
+    server, response = negotiate_server(offer, server_options)
+    return server, negotiate_client(response, client_options)
+
+
+def test_offer()->None:
+    assert make_offer(DeflateOptions()) == b'permessage-deflate; client_max_window_bits'
+    assert make_offer(DeflateOptions(server_max_window_bits=10, client_max_window_bits=12,
+                                     server_no_context_takeover=True)) == (
+        b'permessage-deflate; server_no_context_takeover; '
+        b'server_max_window_bits=10; client_max_window_bits=12')
+
+
+def test_negotiate_parameters()->None:
+    state, response = negotiate_server(
+        b'x-webkit-deflate-frame, permessage-deflate; client_max_window_bits; '
+        b'server_max_window_bits="10"; client_no_context_takeover',
+        DeflateOptions(client_max_window_bits=11))
+    assert response == (b'permessage-deflate; client_no_context_takeover; '
+                        b'server_max_window_bits=10; client_max_window_bits=11')
+    assert (state.compress_bits, state.decompress_bits) == (10, 11)
+    assert (state.compress_reset, state.decompress_reset) == (False, True)
+
+    client = negotiate_client(response, DeflateOptions())
+    assert (client.compress_bits, client.decompress_bits) == (11, 10)
+    assert (client.compress_reset, client.decompress_reset) == (True, False)
+
+    # the client did not offer client_max_window_bits. the server cannot limit it
+    state, response = negotiate_server(b'permessage-deflate', DeflateOptions(client_max_window_bits=9))
+    assert response == b'permessage-deflate'
+    assert state.decompress_bits == 15
+
+    assert negotiate_server(b'x-other', DeflateOptions()) == (None, None)
+    assert negotiate_server(None, DeflateOptions()) == (None, None)
+    assert negotiate_client(None, DeflateOptions()) is None
+    with pytest.raises(AsyncWebsocketError):
+        negotiate_client(b'x-other', DeflateOptions())
+
+
+def test_decline_8_bits_window()->None:
+    # zlib cannot compress raw deflate with 8 bits. the next offer is taken
+    state, response = negotiate_server(
+        b'permessage-deflate; server_max_window_bits=8, permessage-deflate; server_max_window_bits=9',
+        DeflateOptions())
+    assert response == b'permessage-deflate; server_max_window_bits=9'
+    assert negotiate_server(b'permessage-deflate; server_max_window_bits=8',
+                            DeflateOptions()) == (None, None)
+    # 8 bits to decompress is fine
+    state, response = negotiate_server(b'permessage-deflate; client_max_window_bits=8', DeflateOptions())
+    assert state.decompress_bits == 8
+
+    with pytest.raises(AsyncWebsocketError):
+        check_client_options(DeflateOptions(client_max_window_bits=8))
+    with pytest.raises(AsyncWebsocketError):
+        make_offer(DeflateOptions(client_max_window_bits=8))
+    with pytest.raises(AsyncWebsocketError):
+        negotiate_client(b'permessage-deflate; client_max_window_bits=8', DeflateOptions())
+
+
+def test_min_size()->None:
+    server, _ = pair(b'permessage-deflate', DeflateOptions(min_size=100))
+    assert not server.should_compress(bytes(99))
+    assert server.should_compress(bytes(100))
+
+
+@pytest.mark.parametrize('offer', [
+    b'permessage-deflate',
+    b'permessage-deflate; server_no_context_takeover; client_no_context_takeover',
+    b'permessage-deflate; server_max_window_bits=9; client_max_window_bits=9'])
+def test_round_trip(offer: bytes)->None:
+    server, client = pair(offer)
+    messages = [os.urandom(100) * 20, b'hello' * 100, b'hello' * 100, bytes(100000)]
+    for sender, receiver in [(server, client), (client, server)]:
+        compressed = [sender.compress(x) for x in messages]
+        assert [receiver.decompress(x) for x in compressed] == messages
+        if sender.compress_reset:
+            assert compressed[1] == compressed[2]
+        else:
+            # the second one refers to the first
+            assert len(compressed[2]) < len(compressed[1])
+
+
+def test_chunks_round_trip()->None:
+    server, client = pair(b'permessage-deflate')
+    payload = os.urandom(1000) * 50
+    chunks = [server.compress_chunk(payload[i:i + 4096], i + 4096 >= len(payload))
+              for i in range(0, len(payload), 4096)]
+    result = b''.join(client.decompress_chunk(x, i == len(chunks) - 1, len(payload))
+                      for i, x in enumerate(chunks))
+    assert result == payload
+
+
+def test_max_message_size()->None:
+    server, client = pair(b'permessage-deflate', client_options=DeflateOptions(max_message_size=1000))
+    assert client.decompress(server.compress(bytes(1000))) == bytes(1000)
+    with pytest.raises(AsyncWebsocketProtocolError) as info:
+        client.decompress(server.compress(bytes(1001)))
+    assert info.value.status == CLOSESTATUS.MESSAGE_TOO_BIG
+
+
+class Transport(asyncio.WriteTransport):
+    '''
+    keeps what is written. the peer reads nothing while stalled
+    '''
+
+    def __init__(self)->None:
+        super().__init__()
+        self.data = bytearray()
+        self.stalled = 0
+
+    def set_write_buffer_limits(self, high=None, low=None)->None:
+        pass
+
+    def get_write_buffer_size(self)->int:
+        return self.stalled
+
+    def is_closing(self)->bool:
+        return False
+
+    def write(self, data: bytes)->None:
+        self.data += data
+
+    def writelines(self, list_of_data: List[bytes])->None:
+        for data in list_of_data:
+            self.write(data)
+
+
+def received_messages(transport: Transport, client: PerMessageDeflate)->List[bytes]:
+    messages = []
+    for frame in FrameParser().feed(bytes(transport.data)):
+        payload = frame.payload
+        if frame.rsv == CONSTANTS.RSV1:
+            payload = client.decompress(payload)
+        messages.append(payload)
+    return messages
+
+
+@pytest.mark.parametrize('send_policy', [SENDPOLICY.DROP_NEWEST, SENDPOLICY.DROP_OLDEST])
+def test_dropped_messages_keep_the_context(send_policy: SENDPOLICY)->None:
+    '''
+    a dropped message must not go through the compressor. the peer would
+    decompress the next ones with a window it never saw
+    '''
+    async def run_async()->None:
+        transport = Transport()
+        ws = AsyncWebsocketConnection('127.0.0.1', 0, transport, False,
+                                      high_water=4096, send_policy=send_policy)
+        ws.deflate, client = pair(b'permessage-deflate')
+        # each message refers to the common part of the one before
+        common = os.urandom(1000)
+        messages = [common + os.urandom(200 + 10 * i) for i in range(50)]
+        sent = []
+        for i, x in enumerate(messages):
+            if i == 10:
+                transport.stalled = 10000
+                ws.pause_writing()
+            elif i == 30:
+                assert ws.dropped_messages > 0
+                transport.stalled = 0
+                ws.resume_writing()
+                await asyncio.sleep(0.01)
+            if ws.send(x):
+                sent.append(x)
+        await asyncio.sleep(0.01)
+        ws.flush()
+        received = received_messages(transport, client)
+        assert len(received) == 50 - ws.dropped_messages
+        assert all(x in messages for x in received)
+        if send_policy == SENDPOLICY.DROP_NEWEST:
+            assert received == sent
+
+    asyncio.run(run_async())
+
+
+class Closed(AsyncWebsocketCallbackBase):
+    def __init__(self)->None:
+        self.messages = []
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        self.messages.append(bytes(msg))
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_close_on_decompressed_size(use_protocol: bool)->None:
+    async def run_async()->Tuple[List[bytes], bytes]:
+        loop = asyncio.get_running_loop()
+        callbacks = Closed()
+        server = AsyncWebsocketServer(loop, callbacks, HttpService(), use_protocol,
+                                      deflate=DeflateOptions(max_message_size=1000))
+        listener = await server.start_async('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+        writer.write(b'GET / HTTP/1.1\r\n'
+                     b'Host: 127.0.0.1\r\n'
+                     b'Upgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\n'
+                     b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                     b'Sec-WebSocket-Version: 13\r\n'
+                     b'Sec-WebSocket-Extensions: permessage-deflate\r\n'
+                     b'\r\n')
+        response = await reader.readuntil(b'\r\n\r\n')
+        assert b'permessage-deflate' in response
+        _, client = pair(b'permessage-deflate')
+        for payload in [bytes(1000), bytes(100000)]:
+            # a small frame that inflates over the limit
+            compressed = client.compress(payload)
+            writer.write(encode_frame_header(len(compressed), OPCODE.BINARY, True, rsv=CONSTANTS.RSV1)
+                         + KEY + mask(KEY, compressed))
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        listener.close()
+        return callbacks.messages, data
+
+    messages, data = asyncio.run(run_async())
+    assert messages == [bytes(1000)]
+    frame, = FrameParser().feed(data)
+    assert frame.opcode == OPCODE.CLOSE_CONN
+    assert struct.unpack('!H', frame.payload[:2])[0] == CLOSESTATUS.MESSAGE_TOO_BIG
@@ -0,0 +1,154 @@
+'''
+FrameParser and BufferedFrameParser without sockets
+'''
+import os
+from typing import List
+
+import pytest
+
+from async_websocket.constants import CLOSESTATUS, CONSTANTS, OPCODE
+from async_websocket.exception import AsyncWebsocketProtocolError
+from async_websocket.frame import BufferedFrameParser, Frame, FrameParser, encode_frame_header
+from async_websocket.masking import mask
+
+KEY = b'\x11\x22\x33\x44'
+
+
+def encode(payload: bytes, opcode: int = OPCODE.BINARY, masked: bool = True,
+           fin: bool = True, rsv: int = 0)->bytes:
+    header = encode_frame_header(len(payload), opcode, masked, fin, rsv)
+    if masked:
+        return header + KEY + mask(KEY, payload)
+    return header + payload
+
+
+def frames_of(parser: FrameParser, data: bytes)->List[Frame]:
+    # payloads of BufferedFrameParser are views, copy before the next feed
+    return [frame._replace(payload=bytes(frame.payload)) for frame in parser.feed(data)]
+
+
+PARSERS = [FrameParser, BufferedFrameParser]
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+@pytest.mark.parametrize('length', [0, 125, 126, 65535, 65536, 200000])
+def test_lengths(parser_class, length: int)->None:
+    '''
+    7, 16 and 64 bit payload lengths
+    '''
+    payload = os.urandom(length)
+    data = encode(payload)
+    header = 2 if length < 126 else 4 if length < 65536 else 10
+    assert len(data) == header + 4 + length
+
+    frames = frames_of(parser_class(), data)
+    assert frames == [Frame(True, 0, OPCODE.BINARY, True, payload)]
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+@pytest.mark.parametrize('step', [1, 3, 7, 1000])
+def test_split_across_feeds(parser_class, step: int)->None:
+    payload = os.urandom(70000 if step > 1 else 300)
+    data = encode(payload)
+    parser = parser_class()
+    frames = []
+    for i in range(0, len(data), step):
+        frames += frames_of(parser, data[i:i + step])
+        if i + step < len(data):
+            assert not frames
+    assert [x.payload for x in frames] == [payload]
+    assert len(parser) == 0
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_unmasked(parser_class)->None:
+    frames = frames_of(parser_class(), encode(b'server', OPCODE.TEXT, masked=False))
+    assert frames == [Frame(True, 0, OPCODE.TEXT, False, b'server')]
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_many_frames_in_one_chunk(parser_class)->None:
+    data = (encode(b'hello', OPCODE.TEXT)
+            + encode(b'frag', OPCODE.BINARY, fin=False)
+            + encode(b'ping', OPCODE.PING)
+            + encode(b'ment', OPCODE.CONTINUATION)
+            + encode(b'z' * 300, OPCODE.BINARY, rsv=int(CONSTANTS.RSV1)))
+    # with the head of a frame that is not complete yet
+    tail = encode(b'next')
+    parser = parser_class()
+    frames = frames_of(parser, data + tail[:3])
+    assert [(x.fin, x.rsv, x.opcode, x.payload) for x in frames] == [
+        (True, 0, OPCODE.TEXT, b'hello'),
+        (False, 0, OPCODE.BINARY, b'frag'),
+        (True, 0, OPCODE.PING, b'ping'),
+        (True, 0, OPCODE.CONTINUATION, b'ment'),
+        (True, int(CONSTANTS.RSV1), OPCODE.BINARY, b'z' * 300)]
+    assert len(parser) == 3
+    assert [x.payload for x in frames_of(parser, tail[3:])] == [b'next']
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_max_frame_size(parser_class)->None:
+    parser = parser_class()
+    parser.max_frame_size = 1000
+    assert [x.payload for x in frames_of(parser, encode(bytes(1000)))] == [bytes(1000)]
+    # rejected by the header, before the payload is buffered
+    with pytest.raises(AsyncWebsocketProtocolError) as info:
+        frames_of(parser, encode(bytes(1001))[:14])
+    assert info.value.status == CLOSESTATUS.MESSAGE_TOO_BIG
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_stream(parser_class)->None:
+    '''
+    a data frame in chunks as it arrives
+    '''
+    payload = os.urandom(10000)
+    data = encode(payload)
+    parser = parser_class()
+    parser.stream = True
+    chunks = frames_of(parser, data[:5000])
+    assert chunks and all(x.partial for x in chunks)
+    rest = frames_of(parser, data[5000:])
+    assert not rest[-1].partial
+    assert b''.join(x.payload for x in chunks + rest) == payload
+
+
+def test_buffered_parser_reads_into_its_buffer()->None:
+    '''
+    zero copy. get_buffer/buffer_updated like asyncio.BufferedProtocol,
+    payloads are views of the parser buffer unmasked in place
+    '''
+    first = os.urandom(3000)
+    second = os.urandom(100000)
+    data = encode(first) + encode(second, OPCODE.TEXT, masked=False)
+    parser = BufferedFrameParser(read_size=4096)
+    parser.max_frame_size = 1 << 20
+    received = []
+    pos = 0
+    while pos < len(data):
+        buffer = parser.get_buffer(-1)
+        size = min(len(buffer), len(data) - pos, 4096)
+        buffer[:size] = data[pos:pos + size]
+        buffer.release()
+        pos += size
+        for frame in parser.buffer_updated(size):
+            assert isinstance(frame.payload, memoryview)
+            assert frame.payload.obj is parser.buffer
+            received.append((frame.opcode, bytes(frame.payload)))
+            frame.payload.release()
+    assert received == [(OPCODE.BINARY, first), (OPCODE.TEXT, second)]
+    # a frame of known size gets its whole space at once
+    assert len(parser) == 0
+
+
+def test_buffered_parser_unmasks_in_place()->None:
+    payload = os.urandom(100)
+    parser = BufferedFrameParser()
+    buffer = parser.get_buffer(-1)
+    data = encode(payload)
+    buffer[:len(data)] = data
+    buffer.release()
+    frame, = parser.buffer_updated(len(data))
+    assert frame.payload == payload
+    assert bytes(parser.buffer[6:106]) == payload
@@ -0,0 +1,172 @@
+'''
+Heartbeat ping, pong timeout and the timer wheel
+'''
+import asyncio
+from typing import List, Optional
+
+import pytest
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.constants import OPCODE
+from async_websocket.frame import FrameParser, encode_frame_header
+from async_websocket.heartbeat import Heartbeat, TimerWheel
+from async_websocket.masking import mask
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+
+
+def test_timer_wheel()->None:
+    wheel = TimerWheel(1.0, size=8)
+    wheel.schedule('a', 2)
+    wheel.schedule('b', 0.1)
+    # more than a round
+    wheel.schedule('c', 20)
+    assert len(wheel) == 3
+    assert wheel.advance(1) == ['b']
+    assert wheel.advance(1) == ['a']
+    # scheduling again moves the deadline
+    wheel.schedule('a', 3)
+    wheel.schedule('d', 3)
+    wheel.cancel('d')
+    assert wheel.advance(2) == []
+    assert wheel.advance(1) == ['a']
+    assert wheel.advance(10) == []
+    assert wheel.current == 15
+    # a blocked loop expires everything that is due
+    assert wheel.advance(100) == ['c']
+    assert not wheel
+
+
+class Callbacks(AsyncWebsocketCallbackBase):
+    def __init__(self)->None:
+        self.left = asyncio.Event()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        self.left.set()
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_ping_and_pong_timeout(use_protocol: bool)->None:
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        heartbeat = Heartbeat(loop, ping_interval=0.05, pong_timeout=0.1, tick=0.01)
+        callbacks = Callbacks()
+        server = AsyncWebsocketServer(loop, callbacks, HttpService(), use_protocol, heartbeat=heartbeat)
+        listener = await server.start_async('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+        writer.write(HANDSHAKE)
+        await reader.readuntil(b'\r\n\r\n')
+        parser = FrameParser()
+
+        # answered pings keep the connection
+        start = loop.time()
+        pings: List[float] = []
+        while len(pings) < 3:
+            data = await asyncio.wait_for(reader.read(1024), 1)
+            assert data
+            for frame in parser.feed(data):
+                assert frame.opcode == OPCODE.PING
+                pings.append(loop.time() - start)
+                writer.write(encode_frame_header(0, OPCODE.PONG, True) + KEY)
+        # after ping_interval of silence each
+        assert pings[0] >= 0.04
+        assert all(b - a >= 0.04 for a, b in zip(pings, pings[1:]))
+        assert not callbacks.left.is_set()
+
+        # not answered. aborted after pong_timeout
+        data = await asyncio.wait_for(reader.read(1024), 1)
+        ping_time = loop.time()
+        assert [x.opcode for x in parser.feed(data)] == [OPCODE.PING]
+        await asyncio.wait_for(callbacks.left.wait(), 1)
+        assert loop.time() - ping_time >= 0.08
+        try:
+            assert await asyncio.wait_for(reader.read(), 1) == b''
+        except ConnectionResetError:
+            pass
+        writer.close()
+        listener.close()
+        heartbeat.stop()
+
+    asyncio.run(run_async())
+
+
+class Transport:
+    def is_closing(self)->bool:
+        return False
+
+
+class Connection:
+    '''
+    what Heartbeat uses of AsyncWebsocketConnection
+    '''
+
+    def __init__(self)->None:
+        self.transport = Transport()
+        self.last_read = 0.0
+        self.ping_sent: Optional[float] = None
+        self.write_buffered = 0
+        self.write_stalled_since: Optional[float] = None
+        self.pings: List[float] = []
+
+    def send(self, payload: bytes, opcode: OPCODE)->None:
+        assert opcode == OPCODE.PING
+        self.pings.append(asyncio.get_running_loop().time())
+
+
+def test_add_refreshes_the_clock()->None:
+    '''
+    the clock is not updated while no connection is kept.
+    a connection added later must not look idle since then
+    '''
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        heartbeat = Heartbeat(loop, ping_interval=0.2, tick=0.01)
+        await asyncio.sleep(0.3)
+        ws = Connection()
+        added = loop.time()
+        heartbeat.add(ws)
+        assert ws.last_read >= added
+        assert heartbeat.wheel.current == int((heartbeat.now - heartbeat.origin) / 0.01)
+        await asyncio.sleep(0.1)
+        assert ws.pings == []
+        await asyncio.sleep(0.2)
+        assert len(ws.pings) == 1
+        assert ws.pings[0] - added >= 0.19
+
+        # removed. the task stops when the wheel is empty
+        heartbeat.remove(ws)
+        await asyncio.sleep(0.05)
+        assert heartbeat.task is None
+        await asyncio.sleep(0.3)
+        ws = Connection()
+        added = loop.time()
+        heartbeat.add(ws)
+        await asyncio.sleep(0.1)
+        assert ws.pings == []
+        await asyncio.sleep(0.2)
+        assert ws.pings and ws.pings[0] - added >= 0.19
+        heartbeat.stop()
+
+    asyncio.run(run_async())
@@ -0,0 +1,285 @@
+'''
+http keep-alive, Range, conditional requests and content coding of FileSystemMount
+'''
+import asyncio
+import gzip
+import os
+import pathlib
+from typing import List, Optional, Tuple
+
+import pytest
+
+from async_websocket import (AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+                             FileSystemMount, HttpService)
+from async_websocket import http
+from async_websocket.http import HttpResponse, negotiate_encodings, parse_accept_encoding, parse_response
+
+
+class Callbacks(AsyncWebsocketCallbackBase):
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+def request(path: bytes, method: bytes = b'GET', *headers: bytes)->bytes:
+    return b''.join([b'%b %b HTTP/1.1\r\n' % (method, path), b'Host: 127.0.0.1\r\n']
+                    + [x + b'\r\n' for x in headers] + [b'\r\n'])
+
+
+async def read_response_async(reader: asyncio.StreamReader, head: bool = False
+                              )->Tuple[HttpResponse, bytes]:
+    response = parse_response((await reader.readuntil(b'\r\n\r\n'))[:-4])
+    length = int(response.get_header(b'content-length') or 0)
+    if head or response.status_code == 304:
+        return response, b''
+    return response, await reader.readexactly(length)
+
+
+@pytest.fixture
+def www(tmp_path: pathlib.Path)->pathlib.Path:
+    (tmp_path / 'small.bin').write_bytes(os.urandom(1000))
+    # over cache_max_file_size. sent by sendfile
+    (tmp_path / 'large.bin').write_bytes(os.urandom(1024 * 1024))
+    return tmp_path
+
+
+async def open_async(www: pathlib.Path, use_protocol: bool, **kwargs
+                     )->Tuple[asyncio.AbstractServer, asyncio.StreamReader, asyncio.StreamWriter]:
+    http_service = HttpService()
+    http_service.mount(b'/', FileSystemMount(www))
+    server = AsyncWebsocketServer(asyncio.get_running_loop(), Callbacks(), http_service, use_protocol, **kwargs)
+    listener = await server.start_async('127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+    return listener, reader, writer
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_pipelined_requests(www: pathlib.Path, use_protocol: bool)->None:
+    async def run_async()->None:
+        listener, reader, writer = await open_async(www, use_protocol)
+        small = (www / 'small.bin').read_bytes()
+        large = (www / 'large.bin').read_bytes()
+        # all in one write. a HEAD response has no body before the next one
+        writer.write(request(b'/small.bin')
+                     + request(b'/large.bin', b'HEAD')
+                     + request(b'/large.bin')
+                     + request(b'/missing.bin')
+                     + request(b'/small.bin', b'GET', b'Connection: close'))
+        results: List[Tuple[int, Optional[bytes], bytes]] = []
+        for head in [False, True, False, False, False]:
+            response, body = await asyncio.wait_for(read_response_async(reader, head), 5)
+            results.append((response.status_code, response.get_header(b'connection'), body))
+        assert [x[0] for x in results] == [200, 200, 200, 404, 200]
+        assert [x[1] for x in results] == [b'keep-alive'] * 4 + [b'close']
+        assert results[0][2] == small
+        assert results[1][2] == b''
+        assert results[2][2] == large
+        assert results[4][2] == small
+        # closed after Connection: close
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_max_keep_alive_requests(www: pathlib.Path, use_protocol: bool)->None:
+    async def run_async()->None:
+        listener, reader, writer = await open_async(www, use_protocol, max_keep_alive_requests=2)
+        writer.write(request(b'/small.bin') * 3)
+        for connection in [b'keep-alive', b'close']:
+            response, _ = await asyncio.wait_for(read_response_async(reader), 5)
+            assert response.get_header(b'connection') == connection
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+@pytest.mark.parametrize('name', ['small.bin', 'large.bin'])
+def test_range(www: pathlib.Path, name: str)->None:
+    async def run_async()->None:
+        listener, reader, writer = await open_async(www, True)
+        data = (www / name).read_bytes()
+        size = len(data)
+        path = b'/' + name.encode()
+        for value, status, content_range, body in [
+                (b'bytes=10-19', 206, b'bytes 10-19/%d' % size, data[10:20]),
+                (b'bytes=-5', 206, b'bytes %d-%d/%d' % (size - 5, size - 1, size), data[-5:]),
+                (b'bytes=900-', 206, b'bytes 900-%d/%d' % (size - 1, size), data[900:]),
+                (b'bytes=%d-' % size, 416, b'bytes */%d' % size, b''),
+                (b'bytes=0-1,5-6', 200, None, data)]:
+            writer.write(request(path, b'GET', b'Range: ' + value))
+            response, received = await asyncio.wait_for(read_response_async(reader), 5)
+            assert response.status_code == status
+            assert response.get_header(b'content-range') == content_range
+            assert received == body
+
+        # If-Range with an old etag gets the whole file
+        writer.write(request(path, b'GET', b'Range: bytes=0-9', b'If-Range: "old"'))
+        response, received = await asyncio.wait_for(read_response_async(reader), 5)
+        assert response.status_code == 200
+        assert received == data
+        writer.write(request(path, b'GET', b'Range: bytes=0-9',
+                             b'If-Range: ' + response.get_header(b'etag')))
+        response, received = await asyncio.wait_for(read_response_async(reader), 5)
+        assert response.status_code == 206
+        assert received == data[:10]
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+def test_not_modified(www: pathlib.Path)->None:
+    async def run_async()->None:
+        listener, reader, writer = await open_async(www, True)
+        writer.write(request(b'/small.bin'))
+        response, _ = await asyncio.wait_for(read_response_async(reader), 5)
+        etag = response.get_header(b'etag')
+        assert etag
+
+        for if_none_match, status in [(etag, 304), (b'"other", ' + etag, 304), (b'*', 304),
+                                      (b'"other"', 200)]:
+            writer.write(request(b'/small.bin', b'GET', b'If-None-Match: ' + if_none_match))
+            response, body = await asyncio.wait_for(read_response_async(reader), 5)
+            assert response.status_code == status
+            assert response.get_header(b'etag') == etag
+            if status == 304:
+                assert response.get_header(b'content-length') in (None, b'0')
+        # the connection goes on after 304
+        assert response.get_header(b'connection') == b'keep-alive'
+        assert body == (www / 'small.bin').read_bytes()
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+def test_accept_encoding()->None:
+    assert parse_accept_encoding(b'gzip;q=0.5, BR ; q=1.0, x-gzip;q=0.8, deflate;q=bad, identity') == {
+        b'gzip': 0.8, b'br': 1.0, b'deflate': 0.0, b'identity': 1.0}
+    assert parse_accept_encoding(None) == {}
+
+    for value, expected in [
+            (None, []),
+            (b'', []),
+            # equal q. server preference
+            (b'gzip, br', [b'br', b'gzip']),
+            (b'gzip;q=1, br;q=0.5', [b'gzip', b'br']),
+            (b'br;q=0, *', [b'gzip']),
+            (b'*;q=0.1, gzip', [b'gzip', b'br']),
+            (b'*;q=0', []),
+            (b'identity;q=0', []),
+            (b'gzip, identity;q=0', [b'gzip'])]:
+        assert negotiate_encodings(value) == expected, value
+
+
+@pytest.fixture
+def text_www(tmp_path: pathlib.Path)->pathlib.Path:
+    text = b''.join(b'line %d of the script\n' % i for i in range(1000))
+    (tmp_path / 'app.js').write_bytes(text)
+    (tmp_path / 'style.css').write_bytes(text)
+    (tmp_path / 'small.txt').write_bytes(b'small')
+    # prebuilt, not older than the file. the content tells it apart
+    (tmp_path / 'app.js.br').write_bytes(b'prebuilt br')
+    return tmp_path
+
+
+def test_content_encoding(text_www: pathlib.Path)->None:
+    async def run_async()->None:
+        listener, reader, writer = await open_async(text_www, True)
+        text = (text_www / 'app.js').read_bytes()
+
+        async def get_async(path: bytes, *headers: bytes)->Tuple[HttpResponse, bytes]:
+            writer.write(request(path, b'GET', *headers))
+            return await asyncio.wait_for(read_response_async(reader), 5)
+
+        # the prebuilt variant
+        response, body = await get_async(b'/app.js', b'Accept-Encoding: gzip, br')
+        assert response.get_header(b'content-encoding') == b'br'
+        assert body == b'prebuilt br'
+
+        # compressed in the executor and cached
+        for _ in range(2):
+            response, body = await get_async(b'/app.js', b'Accept-Encoding: br;q=0.5, gzip')
+            assert response.get_header(b'content-encoding') == b'gzip'
+            assert response.get_header(b'vary') == b'Accept-Encoding'
+            assert response.get_header(b'etag').endswith(b'-gzip"')
+            assert gzip.decompress(body) == text
+        gzip_etag = response.get_header(b'etag')
+
+        # a compressible file is Vary: Accept-Encoding also when sent as is
+        for accept_encoding in [None, b'identity', b'identity;q=0', b'gzip;q=0, br;q=0', b'*;q=0']:
+            headers = [b'Accept-Encoding: ' + accept_encoding] if accept_encoding is not None else []
+            response, body = await get_async(b'/app.js', *headers)
+            assert response.get_header(b'content-encoding') is None, accept_encoding
+            assert response.get_header(b'vary') == b'Accept-Encoding'
+            assert body == text
+
+        # br without the brotli module nor a prebuilt variant
+        if not http.brotli:
+            response, body = await get_async(b'/style.css', b'Accept-Encoding: br')
+            assert response.get_header(b'content-encoding') is None
+            assert body == text
+
+        # too small to compress. nothing varies
+        response, body = await get_async(b'/small.txt', b'Accept-Encoding: gzip')
+        assert response.get_header(b'content-encoding') is None
+        assert response.get_header(b'vary') is None
+        assert body == b'small'
+
+        # the etag of each coding
+        response, body = await get_async(b'/app.js', b'Accept-Encoding: gzip', b'If-None-Match: ' + gzip_etag)
+        assert response.status_code == 304
+        assert response.get_header(b'vary') == b'Accept-Encoding'
+        response, body = await get_async(b'/app.js', b'If-None-Match: ' + gzip_etag)
+        assert response.status_code == 200
+        assert body == text
+
+        # ranges of the file as is
+        response, body = await get_async(b'/app.js', b'Accept-Encoding: gzip', b'Range: bytes=0-9')
+        assert response.status_code == 206
+        assert response.get_header(b'content-encoding') is None
+        assert body == text[:10]
+
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+def test_old_variant_is_ignored(text_www: pathlib.Path)->None:
+    stat = (text_www / 'app.js').stat()
+    os.utime(text_www / 'app.js.br', ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 9))
+
+    async def run_async()->None:
+        listener, reader, writer = await open_async(text_www, True)
+        writer.write(request(b'/app.js', b'GET', b'Accept-Encoding: br, gzip;q=0.5'))
+        response, body = await asyncio.wait_for(read_response_async(reader), 5)
+        if http.brotli:
+            assert response.get_header(b'content-encoding') == b'br'
+            assert body != b'prebuilt br'
+        else:
+            assert response.get_header(b'content-encoding') == b'gzip'
+            assert gzip.decompress(body) == (text_www / 'app.js').read_bytes()
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
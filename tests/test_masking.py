@@ -0,0 +1,46 @@
+'''
+every masking backend against the bytewise reference
+'''
+import os
+
+import pytest
+
+from async_websocket.masking import MASK_BACKENDS, MASK_INPLACE_BACKENDS, mask_bytewise
+
+MASKS = b'\x01\x82\x33\xf4'
+LENGTHS = [0, 1, 3, 4, 7, 8, 9, 15, 16, 17, 125, 1023, 1024, 1031, 70001]
+
+
+def inputs(data: bytes):
+    yield data
+    yield bytearray(data)
+    yield memoryview(data)
+    # a view that does not start at the beginning of its buffer
+    yield memoryview(b'xyz' + data)[3:]
+
+
+@pytest.mark.parametrize('name', sorted(MASK_BACKENDS))
+@pytest.mark.parametrize('length', LENGTHS)
+def test_mask(name: str, length: int)->None:
+    data = os.urandom(length)
+    expected = mask_bytewise(MASKS, data)
+    for payload in inputs(data):
+        assert bytes(MASK_BACKENDS[name](MASKS, payload)) == expected
+    # masking twice restores the payload
+    assert bytes(MASK_BACKENDS[name](MASKS, expected)) == data
+
+
+@pytest.mark.parametrize('name', sorted(MASK_INPLACE_BACKENDS))
+@pytest.mark.parametrize('length', LENGTHS)
+def test_mask_inplace(name: str, length: int)->None:
+    data = os.urandom(length)
+    expected = mask_bytewise(MASKS, data)
+
+    buffer = bytearray(data)
+    MASK_INPLACE_BACKENDS[name](MASKS, buffer)
+    assert buffer == expected
+
+    # a writable view inside a larger buffer
+    buffer = bytearray(b'xyz' + data + b'!')
+    MASK_INPLACE_BACKENDS[name](MASKS, memoryview(buffer)[3:3 + length])
+    assert buffer == b'xyz' + expected + b'!'
@@ -0,0 +1,111 @@
+'''
+Metrics counters and stage timing
+'''
+import asyncio
+
+import pytest
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService, Metrics
+from async_websocket.constants import OPCODE
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+from async_websocket.metrics import STAGE_CALLBACK, STAGE_PARSE, STAGE_UNMASK
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+
+
+def test_connection_stats_after_disconnect()->None:
+    metrics = Metrics()
+    ws = object()
+    metrics.on_frame_sent(ws, 10)
+    assert metrics.frames_sent == 1
+    assert not metrics.connections
+
+    metrics.on_connected(ws)
+    metrics.on_frame_sent(ws, 10)
+    metrics.on_data_received(ws, 20)
+    metrics.on_frame_received(ws, OPCODE.BINARY, 20)
+    metrics.on_message_received(ws, OPCODE.BINARY, 20)
+    metrics.on_message_dropped(ws)
+    metrics.on_stage(ws, STAGE_CALLBACK, 0.5)
+    metrics.on_throttled(ws, 0.25)
+    stats = metrics.connections[ws]
+    assert (stats.bytes_sent, stats.bytes_received, stats.frames_received, stats.messages_received,
+            stats.messages_dropped, stats.callback_seconds, stats.throttled_seconds) == (
+        10, 20, 1, 1, 1, 0.5, 0.25)
+
+    # the close frame and queued callbacks come after on_disconnected
+    metrics.on_disconnected(ws)
+    metrics.on_frame_sent(ws, 10)
+    metrics.on_message_dropped(ws)
+    metrics.on_stage(ws, STAGE_CALLBACK, 0.5)
+    metrics.on_throttled(ws, 0.25)
+    metrics.on_data_received(ws, 20)
+    metrics.on_frame_received(ws, OPCODE.BINARY, 20)
+    metrics.on_message_received(ws, OPCODE.BINARY, 20)
+    assert not metrics.connections
+    assert metrics.frames_sent == 3
+    assert metrics.messages_received == 2
+
+
+class Closed(AsyncWebsocketCallbackBase):
+    def __init__(self)->None:
+        self.closed = asyncio.Event()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        self.closed.set()
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        ws.send(bytes(msg))
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+@pytest.mark.parametrize('zero_copy', [True, False])
+def test_stages(use_protocol: bool, zero_copy: bool)->None:
+    async def run_async()->Metrics:
+        loop = asyncio.get_running_loop()
+        metrics = Metrics()
+        callbacks = Closed()
+        server = AsyncWebsocketServer(loop, callbacks, HttpService(), use_protocol,
+                                      metrics=metrics, zero_copy=zero_copy)
+        listener = await server.start_async('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+        writer.write(HANDSHAKE)
+        await reader.readuntil(b'\r\n\r\n')
+        for payload in [b'hello', bytes(100000)]:
+            writer.write(encode_frame_header(len(payload), OPCODE.BINARY, True) + KEY + mask(KEY, payload))
+        writer.write(encode_frame_header(0, OPCODE.CLOSE_CONN, True) + KEY)
+        await writer.drain()
+        await asyncio.wait_for(callbacks.closed.wait(), 5)
+        await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        listener.close()
+        return metrics
+
+    metrics = asyncio.run(run_async())
+    assert metrics.messages_received == 2
+    assert metrics.frames_sent >= 2
+    # every masked frame is unmasked, in place with zero_copy
+    assert metrics.stage_seconds[STAGE_UNMASK].count == 3
+    assert metrics.stage_seconds[STAGE_PARSE].count == 3
+    assert metrics.connections_closed == 1
+    assert not metrics.connections
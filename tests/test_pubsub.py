@@ -0,0 +1,180 @@
+'''
+TopicRouter with several nodes on localhost
+'''
+import asyncio
+import os
+import tempfile
+from typing import List
+
+from async_websocket import (AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+                             Backoff, HttpService, Metrics, TopicRouter, client_connect_async)
+from async_websocket import pubsub
+
+
+class Node(AsyncWebsocketCallbackBase):
+    '''
+    sub:topic subscribes, pub:topic:message publishes
+    '''
+
+    def __init__(self, router: TopicRouter)->None:
+        self.router = router
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        self.router.unsubscribe_all(ws)
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        command, topic, *rest = msg.split(':', 2)
+        if command == 'sub':
+            self.router.subscribe(ws, topic)
+            ws.send_text('ok')
+        else:
+            self.router.publish(topic, rest[0])
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+class Client(Node):
+    def __init__(self)->None:
+        self.ws = None
+        self.opened = asyncio.Event()
+        self.subscribed = asyncio.Event()
+        self.received: List[str] = []
+        self.changed = asyncio.Event()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        self.ws = ws
+        self.opened.set()
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        if msg == 'ok':
+            self.subscribed.set()
+        else:
+            self.received.append(msg)
+            self.changed.set()
+
+    async def wait_async(self, count: int)->List[str]:
+        while len(self.received) < count:
+            self.changed.clear()
+            await asyncio.wait_for(self.changed.wait(), 5)
+        return sorted(self.received)
+
+
+async def wait_links_async(router: TopicRouter, count: int)->None:
+    for _ in range(500):
+        if len(router.links) == count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('%d links, expected %d' % (len(router.links), count))
+
+
+def test_publish_relay_and_reconnect()->None:
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        path = os.path.join(tempfile.mkdtemp(), 'hub.sock')
+        # a star. the hub relays between the tcp and the unix node
+        routers = [TopicRouter(loop, relay=(i == 0), backoff=Backoff(0.01, 0.05)) for i in range(3)]
+        hub = await routers[0].listen_async('127.0.0.1', 0)
+        await routers[0].listen_unix_async(path)
+        await routers[1].connect_async('127.0.0.1', hub.sockets[0].getsockname()[1])
+        await routers[2].connect_unix_async(path)
+        await wait_links_async(routers[0], 2)
+
+        listeners = []
+        clients = []
+        tasks = []
+        for router in routers:
+            server = AsyncWebsocketServer(loop, Node(router), HttpService(), True)
+            listener = await server.start_async('127.0.0.1', 0)
+            listeners.append(listener)
+            client = Client()
+            tasks.append(asyncio.ensure_future(client_connect_async(
+                loop, client, '127.0.0.1', listener.sockets[0].getsockname()[1], '/',
+                use_protocol=True)))
+            await asyncio.wait_for(client.opened.wait(), 5)
+            client.ws.send_text('sub:news')
+            await asyncio.wait_for(client.subscribed.wait(), 5)
+            clients.append(client)
+
+        for i, client in enumerate(clients):
+            client.ws.send_text('pub:news:from%d' % i)
+        for client in clients:
+            assert await client.wait_async(3) == ['from0', 'from1', 'from2']
+        # other topics stay local
+        assert routers[1].publish('weather', 'rain') == 0
+
+        # the hub drops its links. the nodes reconnect
+        for link in list(routers[0].links):
+            link.close()
+        await asyncio.sleep(0.05)
+        await wait_links_async(routers[0], 2)
+        await wait_links_async(routers[1], 1)
+        await wait_links_async(routers[2], 1)
+        clients[2].ws.send_text('pub:news:again')
+        for client in clients:
+            assert 'again' in await client.wait_async(4)
+
+        for client in clients:
+            client.ws.send_close()
+            client.ws.transport.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for listener in listeners:
+            listener.close()
+        for router in routers:
+            await router.close_async()
+        assert all(router.dropped_messages == 0 for router in routers)
+
+    asyncio.run(run_async())
+
+
+def test_slow_link_drops_messages(monkeypatch)->None:
+    monkeypatch.setattr(pubsub, 'LINK_MAX_BUFFERED', 1024 * 1024)
+
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        connected = asyncio.Event()
+        peers = []
+
+        def on_accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter)->None:
+            # a node that never reads
+            writer.transport.pause_reading()
+            peers.append(writer)
+            connected.set()
+
+        stalled = await asyncio.start_server(on_accept, '127.0.0.1', 0)
+        metrics = Metrics()
+        router = TopicRouter(loop, metrics=metrics)
+        await router.connect_async('127.0.0.1', stalled.sockets[0].getsockname()[1])
+        await asyncio.wait_for(connected.wait(), 5)
+        link = next(iter(router.links))
+
+        payload = bytes(64 * 1024)
+        for _ in range(200):
+            for _ in range(10):
+                router.publish('news', payload)
+            await asyncio.sleep(0)
+            # the link waits for drain instead of writing everything to the transport
+            assert link.buffered_bytes <= pubsub.LINK_MAX_BUFFERED + 2 * len(payload)
+
+        assert router.dropped_messages > 0
+        assert link.dropped_messages == router.dropped_messages
+        assert metrics.link_messages_dropped == router.dropped_messages
+
+        await router.close_async()
+        for writer in peers:
+            writer.close()
+        stalled.close()
+
+    asyncio.run(run_async())
@@ -0,0 +1,178 @@
+'''
+token buckets and RateLimiter
+'''
+import asyncio
+from typing import List
+
+import pytest
+
+from async_websocket import (AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer,
+                             HttpService, Metrics, RateLimiter)
+from async_websocket.constants import OPCODE
+from async_websocket.frame import encode_frame_header
+from async_websocket.masking import mask
+from async_websocket.ratelimit import TokenBucket
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+
+
+def test_token_bucket()->None:
+    bucket = TokenBucket(10.0, 5.0, now=100.0)
+    # the burst at once
+    for _ in range(5):
+        assert bucket.consume(1, 100.0) == 0.0
+    # in debt. the wait to get back to zero
+    assert bucket.consume(2, 100.0) == pytest.approx(0.2)
+    # refilled at rate
+    assert bucket.consume(1, 100.5) == 0.0
+    assert bucket.tokens == pytest.approx(2.0)
+    # up to burst only
+    assert bucket.consume(0, 200.0) == 0.0
+    assert bucket.tokens == 5.0
+
+
+class Transport:
+    def is_closing(self)->bool:
+        return False
+
+
+class Connection:
+    '''
+    what RateLimiter uses of AsyncWebsocketConnection
+    '''
+
+    def __init__(self, metrics: Metrics)->None:
+        self.transport = Transport()
+        self.metrics = metrics
+        self.rate_state = None
+        self.paused = 0
+
+    def pause_reading(self)->None:
+        self.paused += 1
+
+    def resume_reading(self)->None:
+        self.paused -= 1
+
+
+def test_throttle_and_resume()->None:
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        metrics = Metrics()
+        limiter = RateLimiter(loop, messages_per_second=100, burst=0.1)
+        ws = Connection(metrics)
+        metrics.on_connected(ws)
+        limiter.add(ws)
+
+        # burst of 10 messages
+        limiter.consume(ws, 10, 1000)
+        assert ws.paused == 0
+        limiter.consume(ws, 5, 500)
+        assert ws.paused == 1
+        state = ws.rate_state
+        assert (state.messages_received, state.bytes_received) == (15, 1500)
+        assert state.throttled == limiter.throttled == 1
+        assert state.throttled_seconds == pytest.approx(0.05, abs=0.01)
+        # paused already. counted, not throttled again
+        limiter.consume(ws, 1, 100)
+        assert ws.paused == 1
+        assert limiter.throttled == 1
+
+        assert metrics.throttled == 1
+        assert metrics.throttled_seconds == state.throttled_seconds
+        assert metrics.connections[ws].throttled_seconds == state.throttled_seconds
+
+        await asyncio.sleep(0.1)
+        assert ws.paused == 0
+        assert state.resume_handle is None
+
+        # remove cancels the resume
+        limiter.consume(ws, 10, 100)
+        assert ws.paused == 1
+        limiter.remove(ws)
+        await asyncio.sleep(0.2)
+        assert ws.paused == 1
+
+    asyncio.run(run_async())
+
+
+def test_total_limit()->None:
+    '''
+    the total buckets are shared by the connections
+    '''
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        limiter = RateLimiter(loop, total_bytes_per_second=1000)
+        connections = [Connection(Metrics()) for _ in range(2)]
+        for ws in connections:
+            limiter.add(ws)
+        limiter.consume(connections[0], 1, 800)
+        limiter.consume(connections[1], 1, 800)
+        assert [ws.paused for ws in connections] == [0, 1]
+        assert connections[1].rate_state.throttled_seconds == pytest.approx(0.6, abs=0.01)
+        for ws in connections:
+            limiter.remove(ws)
+
+    asyncio.run(run_async())
+
+
+class Received(AsyncWebsocketCallbackBase):
+    def __init__(self, count: int)->None:
+        self.count = count
+        self.times: List[float] = []
+        self.done = asyncio.Event()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        self.times.append(asyncio.get_running_loop().time())
+        if len(self.times) == self.count:
+            self.done.set()
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_server_rate(use_protocol: bool)->None:
+    async def run_async()->None:
+        loop = asyncio.get_running_loop()
+        limiter = RateLimiter(loop, messages_per_second=100, burst=0.1)
+        callbacks = Received(40)
+        server = AsyncWebsocketServer(loop, callbacks, HttpService(), use_protocol, rate_limiter=limiter)
+        listener = await server.start_async('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+        writer.write(HANDSHAKE)
+        await reader.readuntil(b'\r\n\r\n')
+        start = loop.time()
+        for i in range(40):
+            if i == 30:
+                # 20 over the burst. reading waits 0.2 seconds
+                await asyncio.sleep(0.05)
+                assert len(callbacks.times) == 30
+                assert limiter.throttled >= 1
+            payload = b'%d' % i
+            writer.write(encode_frame_header(len(payload), OPCODE.BINARY, True) + KEY + mask(KEY, payload))
+            await writer.drain()
+        await asyncio.wait_for(callbacks.done.wait(), 5)
+        assert callbacks.times[30] - start >= 0.15
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
@@ -0,0 +1,281 @@
+'''
+send_stream_async and streaming receive
+'''
+import asyncio
+import os
+import struct
+from typing import AsyncIterator, List, Optional, Tuple
+
+import pytest
+
+from async_websocket import AsyncWebsocketCallbackBase, AsyncWebsocketConnection, AsyncWebsocketServer, HttpService
+from async_websocket.constants import CLOSESTATUS, CONSTANTS, OPCODE
+from async_websocket.deflate import DeflateOptions, negotiate_client, negotiate_server
+from async_websocket.frame import FrameParser, encode_frame_header
+from async_websocket.masking import mask
+from async_websocket.stream import MessageStream
+
+
+class Transport(asyncio.WriteTransport):
+    '''
+    keeps what is written
+    '''
+
+    def __init__(self)->None:
+        super().__init__()
+        self.data = bytearray()
+
+    def set_write_buffer_limits(self, high=None, low=None)->None:
+        pass
+
+    def get_write_buffer_size(self)->int:
+        return 0
+
+    def is_closing(self)->bool:
+        return False
+
+    def write(self, data: bytes)->None:
+        self.data += data
+
+    def writelines(self, list_of_data: List[bytes])->None:
+        for data in list_of_data:
+            self.write(data)
+
+
+@pytest.mark.parametrize('deflate', [True, False])
+def test_send_during_stream(deflate: bool)->None:
+    '''
+    messages sent while a fragmented message is being sent follow it.
+    with permessage-deflate they are compressed after the last fragment,
+    the compressor is in the middle of the stream until then
+    '''
+    async def run_async()->None:
+        transport = Transport()
+        ws = AsyncWebsocketConnection('127.0.0.1', 0, transport, False)
+        client = None
+        if deflate:
+            ws.deflate, response = negotiate_server(b'permessage-deflate', DeflateOptions())
+            client = negotiate_client(response, DeflateOptions())
+
+        common = os.urandom(1000)
+        chunks = [common + os.urandom(100) for _ in range(5)]
+
+        async def source_async()->AsyncIterator[bytes]:
+            for chunk in chunks:
+                yield chunk
+                await asyncio.sleep(0)
+
+        task = asyncio.ensure_future(ws.send_stream_async(source_async(), fragment_size=4096))
+        await asyncio.sleep(0)
+        others = [common + b'one', common + b'two']
+        for x in others:
+            assert ws.stream_sending
+            assert ws.send(x)
+            await asyncio.sleep(0)
+        await task
+        ws.flush()
+
+        messages = []
+        current = []
+        compressed = False
+        for frame in FrameParser().feed(bytes(transport.data)):
+            if frame.opcode != OPCODE.CONTINUATION:
+                compressed = frame.rsv == CONSTANTS.RSV1
+            payload = frame.payload
+            if compressed:
+                payload = client.decompress_chunk(payload, frame.fin, 1 << 20)
+            current.append(payload)
+            if frame.fin:
+                messages.append(b''.join(current))
+                current = []
+        assert messages == [b''.join(chunks)] + others
+
+    asyncio.run(run_async())
+
+
+HANDSHAKE = (b'GET / HTTP/1.1\r\n'
+             b'Host: 127.0.0.1\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             b'Sec-WebSocket-Version: 13\r\n'
+             b'\r\n')
+KEY = b'\x01\x02\x03\x04'
+
+
+def encode(payload: bytes, opcode: int, fin: bool = True)->bytes:
+    return encode_frame_header(len(payload), opcode, True, fin) + KEY + mask(KEY, payload)
+
+
+class Streams(AsyncWebsocketCallbackBase):
+    '''
+    keeps the chunks of each stream and how it ended
+    '''
+
+    def __init__(self)->None:
+        self.streams: List[Tuple[OPCODE, List[bytes], Optional[Exception]]] = []
+        self.ended = asyncio.Event()
+        self.left = asyncio.Event()
+
+    def on_client_connected(self, ws: AsyncWebsocketConnection)->None:
+        pass
+
+    def on_client_left(self, ws: AsyncWebsocketConnection)->None:
+        self.left.set()
+
+    def on_stream_received(self, ws: AsyncWebsocketConnection, stream: MessageStream)->None:
+        async def consume_async()->None:
+            chunks = []
+            error = None
+            try:
+                async for chunk in stream:
+                    chunks.append(chunk)
+            except ConnectionResetError as ex:
+                error = ex
+            self.streams.append((stream.opcode, chunks, error))
+            self.ended.set()
+
+        asyncio.ensure_future(consume_async())
+
+    def on_bytes_message_received(self, ws: AsyncWebsocketConnection, msg: bytes)->None:
+        pass
+
+    def on_text_message_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_ping_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+    def on_pong_received(self, ws: AsyncWebsocketConnection, msg: str)->None:
+        pass
+
+
+async def connect_async(callbacks: Streams, use_protocol: bool, **kwargs
+                        )->Tuple[asyncio.AbstractServer, asyncio.StreamReader, asyncio.StreamWriter]:
+    loop = asyncio.get_running_loop()
+    server = AsyncWebsocketServer(loop, callbacks, HttpService(), use_protocol,
+                                  streaming=True, **kwargs)
+    listener = await server.start_async('127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+    writer.write(HANDSHAKE)
+    await reader.readuntil(b'\r\n\r\n')
+    return listener, reader, writer
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_stream_chunks(use_protocol: bool)->None:
+    async def run_async()->None:
+        callbacks = Streams()
+        listener, reader, writer = await connect_async(callbacks, use_protocol)
+        payload = os.urandom(300000)
+        data = (encode(payload[:100000], OPCODE.BINARY, False)
+                + encode(b'ping', OPCODE.PING)
+                + encode(payload[100000:], OPCODE.CONTINUATION))
+        # frames arrive split at any byte
+        for i in range(0, len(data), 50001):
+            writer.write(data[i:i + 50001])
+            await writer.drain()
+            await asyncio.sleep(0.005)
+        await asyncio.wait_for(callbacks.ended.wait(), 5)
+        (opcode, chunks, error), = callbacks.streams
+        assert opcode == OPCODE.BINARY
+        assert error is None
+        assert len(chunks) > 2
+        assert b''.join(chunks) == payload
+
+        callbacks.ended.clear()
+        writer.write(encode(b'te', OPCODE.TEXT, False) + encode(b'xt', OPCODE.CONTINUATION))
+        await asyncio.wait_for(callbacks.ended.wait(), 5)
+        assert callbacks.streams[1] == (OPCODE.TEXT, [b'te', b'xt'], None)
+
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_stream_aborted(use_protocol: bool)->None:
+    '''
+    the connection is lost in the middle of the message
+    '''
+    async def run_async()->None:
+        callbacks = Streams()
+        listener, reader, writer = await connect_async(callbacks, use_protocol)
+        writer.write(encode(b'first', OPCODE.BINARY, False) + encode(b'second', OPCODE.CONTINUATION, False))
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        writer.close()
+        await asyncio.wait_for(callbacks.ended.wait(), 5)
+        (_, chunks, error), = callbacks.streams
+        # the received chunks, then the error
+        assert chunks == [b'first', b'second']
+        assert isinstance(error, ConnectionResetError)
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+@pytest.mark.parametrize('use_protocol', [True, False])
+def test_stream_max_message_size(use_protocol: bool)->None:
+    async def run_async()->None:
+        callbacks = Streams()
+        listener, reader, writer = await connect_async(callbacks, use_protocol, max_message_size=1000)
+        writer.write(encode(bytes(600), OPCODE.BINARY, False) + encode(bytes(600), OPCODE.CONTINUATION))
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), 5)
+        await asyncio.wait_for(callbacks.ended.wait(), 5)
+        (_, chunks, error), = callbacks.streams
+        assert b''.join(chunks) == bytes(600)
+        assert isinstance(error, ConnectionResetError)
+        frame, = FrameParser().feed(data)
+        assert frame.opcode == OPCODE.CLOSE_CONN
+        assert struct.unpack('!H', frame.payload[:2])[0] == CLOSESTATUS.MESSAGE_TOO_BIG
+        writer.close()
+        listener.close()
+
+    asyncio.run(run_async())
+
+
+class Reader:
+    '''
+    counts pause_reading and resume_reading of MessageStream
+    '''
+
+    def __init__(self)->None:
+        self.paused = 0
+
+    def pause_reading(self)->None:
+        self.paused += 1
+
+    def resume_reading(self)->None:
+        self.paused -= 1
+
+
+def test_message_stream_buffer()->None:
+    async def run_async()->None:
+        ws = Reader()
+        stream = MessageStream(ws, OPCODE.BINARY, max_buffered=100)
+        for _ in range(4):
+            stream.put(bytes(40), False)
+        # over max_buffered until the consumer takes half
+        assert ws.paused == 1
+        for _ in range(2):
+            assert len(await stream.__anext__()) == 40
+            assert ws.paused == 1
+        assert len(await stream.__anext__()) == 40
+        assert ws.paused == 0
+        stream.put(b'end', True)
+        assert await stream.read() == bytes(40) + b'end'
+        # a finished stream is not aborted
+        stream.abort()
+        assert stream.error is None
+
+        stream = MessageStream(ws, OPCODE.BINARY)
+        stream.put(b'part', False)
+        stream.abort(ValueError('stop'))
+        assert await stream.__anext__() == b'part'
+        with pytest.raises(ValueError):
+            await stream.__anext__()
+
+    asyncio.run(run_async())